@@ -1,18 +1,33 @@
-from flask import Flask, render_template, send_from_directory, request, jsonify
-import google.generativeai as genai
+from flask import Flask, Response, g, render_template, send_from_directory, request, jsonify
+import json
 import os
-import socket
-from food_classifier import classify_food, get_nutrition_info
-from database import get_db, init_db, test_connection, User, Conversation, FoodLog
+import time
+import uuid
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from food_classifier import classify_food, get_nutrition_info, NUTRITION_MAP, batcher, classification_cache, get_model, start_warmup, model_status
+from database import SessionLocal, session_scope, get_pool_stats, init_db, test_connection, User, FoodLog, Conversation
+from llm_client import llm
+from response_cache import PromptResponseCache
+from intent_router import router
+from history_cache import history_cache
+from context_builder import context_builder, log_prompt_tokens
+from conversation_writer import conversation_writer
+from greeting_materializer import GreetingMaterializer
+import nutrition_stats
+from pagination import InvalidCursor, keyset_page, parse_limit
+from image_ingest import ImageRejected, MAX_UPLOAD_BYTES
+from esp32_manager import device_manager, ESP32_FLASH_SECONDS, HAPPY
+from partitions import partition_maintainer, status as partition_status
+from push_channel import issue_push_token, push_health, push_reply_chunk, push_reply_done
+import metrics
 
 app = Flask(__name__, 
             static_folder='../frontend',
             template_folder='../frontend')
 
-# Configure Gemini API
-GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
-if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
+# Refuse oversized request bodies before they're buffered (the image limit plus room for form fields)
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES + 64 * 1024
 
 # Initialize database on startup
 with app.app_context():
@@ -20,17 +35,122 @@ with app.app_context():
         init_db()
         print("[DEBUG] Flask app connected to PostgreSQL")
 
+def get_request_db():
+    """Session for the current request; returned to the pool when the request ends"""
+    if 'db' not in g:
+        g.db = SessionLocal()
+    return g.db
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get('request_started')
+    if started is not None:
+        # Label by URL rule, not raw path, to keep the number of series bounded
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.request_duration.observe(time.perf_counter() - started, request.method, route, str(response.status_code))
+    return response
+
+@app.teardown_appcontext
+def close_request_db(exc):
+    db = g.pop('db', None)
+    if db is not None:
+        if exc is not None:
+            db.rollback()
+        db.close()
+
+# Pre-fork servers (gunicorn.conf.py) load the model once in the master so workers
+# share its pages; otherwise warm it in the background so startup stays fast
+if os.environ.get('MODEL_PRELOAD') == '1':
+    get_model()
+elif os.environ.get('MODEL_WARMUP', '1') == '1':
+    start_warmup()
+
+# Pre-forked workers start their own ESP32 scheduler and partition maintenance (gunicorn.conf.py post_worker_init)
+if os.environ.get('MODEL_PRELOAD') != '1':
+    device_manager.start()
+    partition_maintainer.start()
+
 # Common prompt constraints
 PROMPT_CONSTRAINTS = "Do NOT use any emoji. Use text emoticons like ^_^, :3, or :) in your own replies, but never use emoji. Do not describe actions in asterisks (e.g., *squeaks*). Avoid using asterisks for actions. Do not use the word 'fun' in your response."
 PROMPT_CONSTRAINTS_NO_TUMMY = PROMPT_CONSTRAINTS + " Do not use the word 'tummy' or any of its synonyms (like stomach, belly, gut, abdomen, etc.) in your response."
 
+# Helper function to add the shared length/style constraints to a prompt
+def build_llm_prompt(prompt, word_limit=30):
+    return f"{prompt} Limit your response to {word_limit} words. {PROMPT_CONSTRAINTS}"
+
 # Helper function to generate LLM response
 def generate_llm_response(prompt, word_limit=30):
     """Generate response from Gemini with consistent settings"""
-    full_prompt = f"{prompt} Limit your response to {word_limit} words. {PROMPT_CONSTRAINTS}"
-    model = genai.GenerativeModel('gemini-2.5-flash')
-    response = model.generate_content(full_prompt)
-    return response.text.strip() if hasattr(response, 'text') else str(response)
+    full_prompt = build_llm_prompt(prompt, word_limit)
+    log_prompt_tokens(full_prompt)
+    return llm.generate(full_prompt)
+
+# Cache for replies determined by a small input space (feed verdicts, greetings)
+response_cache = PromptResponseCache()
+
+# Returning-user greetings, regenerated in the background after feed and chat events
+greetings = GreetingMaterializer(lambda prompt: generate_llm_response(prompt, word_limit=50))
+
+def health_bucket(health_score):
+    """Feed verdict bucket for a 1-5 health score"""
+    if health_score >= 4:
+        return 'healthy'
+    if health_score == 3:
+        return 'moderate'
+    return 'unhealthy'
+
+def build_feed_prompt(food_name, category, health_score):
+    """Prompt for reacting to a food picture; depends only on food, category and health bucket"""
+    bucket = health_bucket(health_score)
+    if bucket == 'healthy':
+        return f"You are Gachirat, a friendly digital pet rat. The user showed you a picture of {food_name} (a {category}). This is very healthy food! Respond excitedly and praise them for eating healthy. Keep it brief and encouraging. Mention the specific food. {PROMPT_CONSTRAINTS_NO_TUMMY}"
+    elif bucket == 'moderate':
+        return f"You are Gachirat, a friendly digital pet rat. The user showed you a picture of {food_name} (a {category}). This is moderately healthy. Respond positively but suggest balance. Keep it brief and friendly. Mention the specific food. {PROMPT_CONSTRAINTS_NO_TUMMY}"
+    return f"You are Gachirat, a friendly digital pet rat. The user showed you a picture of {food_name} (a {category}). This is not very healthy. Respond playfully but gently suggest healthier options next time. Keep it brief, non-judgmental, and friendly. Mention the specific food. {PROMPT_CONSTRAINTS_NO_TUMMY}"
+
+def get_feed_response(food_name, category, health_score):
+    key = ('feed', food_name.lower(), category, health_bucket(health_score))
+    prompt = build_feed_prompt(food_name, category, health_score)
+    return response_cache.get(key, lambda: generate_llm_response(prompt))
+
+# Placeholder the model is asked to use instead of a real username, so one
+# cached greeting works for every new user
+USERNAME_PLACEHOLDER = 'USERNAME'
+
+NEW_USER_GREETING_PROMPT = f"""You are Gachirat, a friendly digital pet rat. {USERNAME_PLACEHOLDER} is a new user. Refer to them only as {USERNAME_PLACEHOLDER}, written exactly like that.
+
+Generate a warm welcome message that:
+1. Introduces yourself as Gachirat
+2. Explains you can chat, track food, and give health advice
+3. Encourages them to share what they eat to help manage their health
+
+Keep it under 50 words, friendly and enthusiastic. Use text emoticons like :3 or ^_^. Do NOT use emoji or asterisks for actions."""
+
+def generate_new_user_greeting():
+    return generate_llm_response(NEW_USER_GREETING_PROMPT, word_limit=50)
+
+def get_new_user_greeting(username):
+    template = response_cache.get(('new_user_greeting',), generate_new_user_greeting)
+    return template.replace(USERNAME_PLACEHOLDER, username)
+
+def prewarm_response_cache(background=True):
+    """Generate feed verdicts for every NUTRITION_MAP food, plus the new-user greeting"""
+    items = [(('new_user_greeting',), generate_new_user_greeting)]
+    for food_name, nutrition in NUTRITION_MAP.items():
+        if food_name == 'unknown':
+            continue
+        key = ('feed', food_name, nutrition['category'], health_bucket(nutrition['health_score']))
+        prompt = build_feed_prompt(food_name, nutrition['category'], nutrition['health_score'])
+        items.append((key, lambda prompt=prompt: generate_llm_response(prompt)))
+    return response_cache.prewarm(items, background=background)
+
+if os.environ.get('RESPONSE_CACHE_PREWARM') == '1':
+    # Pre-fork masters fill the cache before forking so every worker inherits it
+    prewarm_response_cache(background=os.environ.get('MODEL_PRELOAD') != '1')
 
 # Helper function to get or create user by username
 def get_or_create_user(db, username='default_user'):
@@ -60,32 +180,11 @@ def get_relevant_history(db, user_id, conversation_type='general', limit=10):
     - 'food': food-related conversations (food_discussion, food_image_request)
     - 'general': general chat conversations (general_chat)
     - 'financial': financial advice conversations (financial_advice)
-    """
-    if conversation_type == 'food':
-        states = ['food_discussion', 'food_image_request']
-    elif conversation_type == 'financial':
-        states = ['financial_advice']
-    else:
-        states = ['general_chat']
-    
-    conversations = db.query(Conversation).filter(
-        Conversation.user_id == user_id,
-        Conversation.conversation_state.in_(states)
-    ).order_by(Conversation.timestamp.desc()).limit(limit).all()
     
-    # Reverse to show oldest first (chronological order)
-    conversations.reverse()
-    
-    # Format as context string
-    if not conversations:
-        return ""
-    
-    context_lines = []
-    for conv in conversations:
-        context_lines.append(f"User: {conv.user_message}")
-        context_lines.append(f"Gachirat: {conv.bot_response}")
-    
-    return "\n".join(context_lines)
+    Returns the rolling summary of older turns plus up to `limit` recent turns,
+    within the context token budget (see context_builder.py).
+    """
+    return context_builder.build(db, user_id, conversation_type, recent_turns=limit)
 
 @app.route('/api/login', methods=['POST'])
 def login():
@@ -96,41 +195,17 @@ def login():
         return jsonify({'success': False, 'message': 'Username is required'}), 400
     
     try:
-        db = next(get_db())
+        db = get_request_db()
         user = db.query(User).filter(User.username == username).first()
         
         if user:
             # Existing user - generate two greetings
-            # Get recent food logs
-            recent_foods = db.query(FoodLog).filter(
-                FoodLog.user_id == user.id
-            ).order_by(FoodLog.timestamp.desc()).limit(3).all()
-            
-            # Build context for greeting
-            context = f"User {username} is returning. Health: {user.health}/20."
-            if recent_foods:
-                avg_health_score = sum(f.health_score for f in recent_foods) / len(recent_foods)
-                context += f" Recent food health average: {avg_health_score:.1f}/5."
-                food_list = ", ".join([f.food_name for f in recent_foods])
-                context += f" Recent foods: {food_list}."
-            
             # Simple login screen greeting
             login_greeting = f"Welcome back, {username}!"
             
-            # Generate DETAILED chat window greeting
-            chat_prompt = f"""You are Gachirat, a friendly digital pet rat. {context}
-
-Generate a warm welcome message that:
-1. Greets {username} by name
-2. Briefly explains what you can help with (chat, food tracking, health advice)
-3. Personalizes the end based on their recent behavior:
-   - If health is high (11+) and recent foods were healthy (avg 4+): Praise and encourage them
-   - If health is medium (7-10) or mixed foods: Gently motivate balance
-   - If health is low (<7) or unhealthy foods: Motivate change with empathy
-
-Keep it under 50 words, friendly, and use text emoticons like :3 or ^_^. Do NOT use emoji or asterisks for actions."""
-
-            chat_greeting = generate_llm_response(chat_prompt, word_limit=50)
+            # DETAILED chat window greeting: materialized after the user's last
+            # feed/chat, generated here only if missing or stale
+            chat_greeting = greetings.get(db, user)
             
             print(f"[DEBUG] Login: {username} (existing user, ID: {user.id})")
             return jsonify({
@@ -138,6 +213,7 @@ Keep it under 50 words, friendly, and use text emoticons like :3 or ^_^. Do NOT
                 'message': login_greeting,
                 'chat_greeting': chat_greeting,
                 'user_id': user.id,
+                'push_token': issue_push_token(username),
                 'health': user.health,
                 'is_new': False
             })
@@ -150,17 +226,8 @@ Keep it under 50 words, friendly, and use text emoticons like :3 or ^_^. Do NOT
             # Simple login screen greeting
             login_greeting = f"Account created. Welcome, {username}!"
             
-            # Generate DETAILED chat window greeting
-            chat_prompt = f"""You are Gachirat, a friendly digital pet rat. {username} is a new user.
-
-Generate a warm welcome message that:
-1. Introduces yourself as Gachirat
-2. Explains you can chat, track food, and give health advice
-3. Encourages them to share what they eat to help manage their health
-
-Keep it under 50 words, friendly and enthusiastic. Use text emoticons like :3 or ^_^. Do NOT use emoji or asterisks for actions."""
-
-            chat_greeting = generate_llm_response(chat_prompt, word_limit=50)
+            # Generate DETAILED chat window greeting (cached with the username templated out)
+            chat_greeting = get_new_user_greeting(username)
             
             print(f"[DEBUG] Login: {username} (new user created, ID: {new_user.id})")
             return jsonify({
@@ -168,14 +235,102 @@ Keep it under 50 words, friendly and enthusiastic. Use text emoticons like :3 or
                 'message': login_greeting,
                 'chat_greeting': chat_greeting,
                 'user_id': new_user.id,
+                'push_token': issue_push_token(username),
                 'health': new_user.health,
                 'is_new': True
             })
     except Exception as e:
         print(f"✗ Login error: {str(e)}")
         return jsonify({'success': False, 'message': f'Error: {str(e)}'}), 500
-    finally:
-        db.close()
+
+# Helper function to log a chat turn
+def save_conversation(db, user_id, user_message, bot_response, conversation_state):
+    """
+    Persist a chat turn and write it through to the history cache.
+    
+    Inline commit by default; batched on a background thread with
+    CONVERSATION_WRITE_BEHIND=1 (see conversation_writer.py). Returns the
+    Conversation, or None when it is only queued (async durability).
+    """
+    conversation = conversation_writer.write(db, user_id, user_message, bot_response, conversation_state)
+    greetings.chat_logged(user_id)
+    return conversation
+
+# Helper function to decide how to answer a chat message
+def plan_chat_reply(db, user, user_input, conversation_state):
+    """
+    Pick the prompt for a chat message based on its intents and the client's
+    conversation state.
+    
+    Returns (prompt, word_limit, log_state, payload): log_state is the
+    conversation_state the turn is saved under, payload the extra response
+    fields (is_food_query, conversation_state, show_upload/hide_upload).
+    """
+    # One pass over the message finds every intent it mentions (see intents.json)
+    intents = router.match(user_input)
+    is_food_query = 'food' in intents
+    is_finance_query = 'finance' in intents
+    is_last_ate_query = 'last_ate' in intents
+    is_decline = 'decline' in intents
+
+    if is_last_ate_query:
+        # Retrieve the last food log for this user
+        last_food = db.query(FoodLog).filter(FoodLog.user_id == user.id).order_by(FoodLog.timestamp.desc()).first()
+        if last_food:
+            last_food_str = f"The last thing you ate was {last_food.food_name} (category: {last_food.category}, health score: {last_food.health_score})."
+        else:
+            last_food_str = "I don't have any record of your last meal."
+        prompt = f"You are Gachirat, a friendly digital pet rat. The user asked: '{user_input}'. {last_food_str} Answer the user's question using this information. Keep it brief and in character."
+        return prompt, 30, 'food_log_lookup', {'is_food_query': False, 'conversation_state': 'initial'}
+    
+    if is_food_query and conversation_state == 'initial':
+        # Retrieve past food-related conversations for context
+        history = get_relevant_history(db, user.id, conversation_type='food', limit=5)
+        context_prompt = f"\n\nPrevious food conversations:\n{history}\n\n" if history else ""
+        
+        # First step: Ask user to describe the food
+        prompt = f"You are Gachirat, a friendly digital pet rat who loves food.{context_prompt}The user said: '{user_input}'. Respond enthusiastically and ask them to describe what they ate or are eating. Avoid asking what the food is directly. Keep it brief and in character as a curious rat. Ask questions like how it tastes, etc. {PROMPT_CONSTRAINTS_NO_TUMMY}"
+        return prompt, 30, 'food_discussion', {'is_food_query': True, 'conversation_state': 'awaiting_description'}
+    elif conversation_state == 'awaiting_description':
+        # Check if user is declining to share
+        if is_decline:
+            # User declined, respond normally and reset state
+            prompt = f"You are Gachirat, a friendly digital pet rat. The user said: '{user_input}'. They seem to not want to share right now. Respond kindly and understandingly, maybe a bit disappointed but still friendly. Keep it brief."
+            return prompt, 30, 'general_chat', {'is_food_query': False, 'conversation_state': 'initial', 'hide_upload': True}
+        
+        # Retrieve past food conversations for context
+        history = get_relevant_history(db, user.id, conversation_type='food', limit=5)
+        context_prompt = f"\n\nPrevious food conversations:\n{history}\n\n" if history else ""
+        
+        # Second step: After description, ask to see the image
+        prompt = f"You are Gachirat, a friendly digital pet rat.{context_prompt}The user described their food: '{user_input}'. Respond with excitement and curiosity, then say something like 'Let me see!' or 'Show me!' to prompt them to upload an image. Keep it brief and enthusiastic. {PROMPT_CONSTRAINTS_NO_TUMMY}"
+        return prompt, 30, 'food_image_request', {'is_food_query': True, 'show_upload': True, 'conversation_state': 'awaiting_image'}
+    elif conversation_state == 'awaiting_image':
+        # Check if user is declining to upload image
+        if is_decline:
+            # User declined to upload, respond and reset
+            prompt = f"You are Gachirat, a friendly digital pet rat. The user said: '{user_input}' when you asked to see their food. Respond understandingly but a bit sad. Keep it brief and friendly."
+            return prompt, 30, 'general_chat', {'is_food_query': False, 'conversation_state': 'initial', 'hide_upload': True}
+        
+        # User said something else, remind them gently to upload
+        prompt = f"You are Gachirat, a friendly digital pet rat. You asked to see the user's food and they responded: '{user_input}'. Gently remind them to upload an image if they have one, or acknowledge what they said. Keep it brief and friendly."
+        return prompt, 30, 'food_image_request', {'is_food_query': True, 'show_upload': True, 'conversation_state': 'awaiting_image'}
+    elif is_finance_query:
+        # Retrieve past financial advice conversations for context
+        history = get_relevant_history(db, user.id, conversation_type='financial', limit=5)
+        context_prompt = f"\n\nPrevious financial conversations:\n{history}\n\n" if history else ""
+        
+        # Financial advice feature with RAG context
+        prompt = f"You are Gachirat, a street-smart digital pet rat with surprising financial wisdom from living in the urban jungle.{context_prompt}The user asked: '{user_input}'. Give them practical, savvy financial advice in character - be enthusiastic and confident like a rat who knows how to find the best deals and stash resources wisely. Keep it brief and actionable."
+        return prompt, 50, 'financial_advice', {'is_food_query': False, 'conversation_state': 'initial'}
+    
+    # Retrieve past general conversations for context
+    history = get_relevant_history(db, user.id, conversation_type='general', limit=5)
+    context_prompt = f"\n\nPrevious conversations:\n{history}\n\n" if history else ""
+    
+    # Normal conversation
+    prompt = f"You are Gachirat, a friendly digital pet rat.{context_prompt}The user said: '{user_input}'. Respond in character."
+    return prompt, 30, 'general_chat', {'is_food_query': False, 'conversation_state': 'initial'}
 
 @app.route('/api/gemini', methods=['POST'])
 def gemini_response():
@@ -191,219 +346,166 @@ def gemini_response():
         return jsonify({'response': 'No input provided.'}), 400
     
     # Single database session for entire request
-    db = next(get_db())
+    db = get_request_db()
     
     try:
         # Get or create user
         user = get_or_create_user(db, username)
         print(f"Processing request for user: {username} (ID: {user.id})")
         
-        # Check if this is a food-related query
-        food_keywords = ['hungry', 'eat', 'food', 'feed', 'meal', 'breakfast', 'lunch', 'dinner', 'snack', 'healthy', 'nutrition', 'calories', 'diet', 'ate']
-        is_food_query = any(keyword in user_input.lower() for keyword in food_keywords)
+        prompt, word_limit, log_state, payload = plan_chat_reply(db, user, user_input, conversation_state)
+        text = generate_llm_response(prompt, word_limit=word_limit)
         
-        # Check if this is a financial advice query
-        finance_keywords = ['sell','buy', 'money', 'finance', 'financial', 'invest', 'investment', 'stock', 'stocks', 'crypto', 'cryptocurrency', 'bitcoin', 'save', 'savings', 'budget', 'expense', 'debt', 'loan', 'credit', 'bank', 'portfolio', 'retirement', '401k', 'ira', 'dividend', 'etf', 'bond', 'mutual fund', 'tax', 'wealth', 'rich', 'poor', 'afford', 'cost', 'price', 'dollar', 'euro', 'yen']
-        is_finance_query = any(keyword in user_input.lower() for keyword in finance_keywords)
-
-        # Check if user is asking about what they last ate
-        last_ate_keywords = [
-            'what did i eat',
-            'what was the last thing i ate',
-            'what did i last eat',
-            'last food',
-            'last meal',
-            'last thing i ate',
-            'last thing eaten',
-            'last thing you saw me eat',
-            'last thing i showed you',
-            'last food log',
-            'last food entry',
-            'last food classification',
-            'what did i show you',
-            'what did i upload',
-            'what was my last upload',
-            'what was my last food',
-            'what was my last meal',
-        ]
-        is_last_ate_query = any(kw in user_input.lower() for kw in last_ate_keywords)
-
-        if is_last_ate_query:
-            # Retrieve the last food log for this user
-            last_food = db.query(FoodLog).filter(FoodLog.user_id == user.id).order_by(FoodLog.timestamp.desc()).first()
-            if last_food:
-                last_food_str = f"The last thing you ate was {last_food.food_name} (category: {last_food.category}, health score: {last_food.health_score})."
-            else:
-                last_food_str = "I don't have any record of your last meal."
-            prompt = f"You are Gachirat, a friendly digital pet rat. The user asked: '{user_input}'. {last_food_str} Answer the user's question using this information. Keep it brief and in character."
-            text = generate_llm_response(prompt)
-            # Log conversation
-            conversation = Conversation(
-                user_id=user.id,
-                user_message=user_input,
-                bot_response=text,
-                conversation_state='food_log_lookup'
-            )
-            db.add(conversation)
-            db.commit()
-            print(f"[DEBUG] Saved conversation for {username} (food_log_lookup)")
-            return jsonify({'response': text, 'is_food_query': False, 'conversation_state': 'initial'})
+        # Log conversation to database
+        save_conversation(db, user.id, user_input, text, log_state)
+        print(f"[DEBUG] Saved conversation for {username} ({log_state})")
         
-        # Check if user is describing food (after initial food query)
-        show_upload = False
-        
-        # Reset conversation state keywords if user declines
-        decline_keywords = ['no', 'nah', 'nope', 'not', "don't", "dont", 'never mind', 'nevermind', 'maybe later', 'later', "can't", 'cant']
-        
-        if is_food_query and conversation_state == 'initial':
-            # Retrieve past food-related conversations for context
-            history = get_relevant_history(db, user.id, conversation_type='food', limit=5)
-            context_prompt = f"\n\nPrevious food conversations:\n{history}\n\n" if history else ""
-            
-            # First step: Ask user to describe the food
-            prompt = f"You are Gachirat, a friendly digital pet rat who loves food.{context_prompt}The user said: '{user_input}'. Respond enthusiastically and ask them to describe what they ate or are eating. Avoid asking what the food is directly. Keep it brief and in character as a curious rat. Ask questions like how it tastes, etc. {PROMPT_CONSTRAINTS_NO_TUMMY}"
-            text = generate_llm_response(prompt)
-            
-            # Log conversation to database
-            conversation = Conversation(
-                user_id=user.id,
-                user_message=user_input,
-                bot_response=text,
-                conversation_state='food_discussion'
-            )
-            db.add(conversation)
-            db.commit()
-            print(f"[DEBUG] Saved conversation for {username}")
-            
-            return jsonify({'response': text, 'is_food_query': True, 'conversation_state': 'awaiting_description'})
-        elif conversation_state == 'awaiting_description':
-            # Check if user is declining to share
-            is_decline = any(keyword in user_input.lower() for keyword in decline_keywords)
-            
-            if is_decline:
-                # User declined, respond normally and reset state
-                prompt = f"You are Gachirat, a friendly digital pet rat. The user said: '{user_input}'. They seem to not want to share right now. Respond kindly and understandingly, maybe a bit disappointed but still friendly. Keep it brief."
-                text = generate_llm_response(prompt)
-                
-                # Log with general_chat state
-                conversation = Conversation(
-                    user_id=user.id,
-                    user_message=user_input,
-                    bot_response=text,
-                    conversation_state='general_chat'
-                )
-                db.add(conversation)
-                db.commit()
-                print(f"[DEBUG] Saved conversation for {username}")
-                
-                return jsonify({'response': text, 'is_food_query': False, 'conversation_state': 'initial', 'hide_upload': True})
-            else:
-                # Retrieve past food conversations for context
-                history = get_relevant_history(db, user.id, conversation_type='food', limit=5)
-                context_prompt = f"\n\nPrevious food conversations:\n{history}\n\n" if history else ""
-                
-                # Second step: After description, ask to see the image
-                prompt = f"You are Gachirat, a friendly digital pet rat.{context_prompt}The user described their food: '{user_input}'. Respond with excitement and curiosity, then say something like 'Let me see!' or 'Show me!' to prompt them to upload an image. Keep it brief and enthusiastic. {PROMPT_CONSTRAINTS_NO_TUMMY}"
-                text = generate_llm_response(prompt)
-                show_upload = True
-                
-                # Log with food_image_request state
-                conversation = Conversation(
-                    user_id=user.id,
-                    user_message=user_input,
-                    bot_response=text,
-                    conversation_state='food_image_request'
-                )
-                db.add(conversation)
-                db.commit()
-                print(f"[DEBUG] Saved conversation for {username}")
-                
-            return jsonify({'response': text, 'is_food_query': True, 'show_upload': show_upload, 'conversation_state': 'awaiting_image'})
-        elif conversation_state == 'awaiting_image':
-            # Check if user is declining to upload image
-            is_decline = any(keyword in user_input.lower() for keyword in decline_keywords)
-            
-            if is_decline:
-                # User declined to upload, respond and reset
-                prompt = f"You are Gachirat, a friendly digital pet rat. The user said: '{user_input}' when you asked to see their food. Respond understandingly but a bit sad. Keep it brief and friendly."
-                text = generate_llm_response(prompt)
-                
-                # Log with general_chat state
-                conversation = Conversation(
-                    user_id=user.id,
-                    user_message=user_input,
-                    bot_response=text,
-                    conversation_state='general_chat'
-                )
-                db.add(conversation)
-                db.commit()
-                print(f"[DEBUG] Saved conversation for {username}")
-                
-                return jsonify({'response': text, 'is_food_query': False, 'conversation_state': 'initial', 'hide_upload': True})
-            else:
-                # User said something else, remind them gently to upload
-                prompt = f"You are Gachirat, a friendly digital pet rat. You asked to see the user's food and they responded: '{user_input}'. Gently remind them to upload an image if they have one, or acknowledge what they said. Keep it brief and friendly."
-                text = generate_llm_response(prompt)
-                
-                # Log with food_image_request state
-                conversation = Conversation(
-                    user_id=user.id,
-                    user_message=user_input,
-                    bot_response=text,
-                    conversation_state='food_image_request'
-                )
-                db.add(conversation)
-                db.commit()
-                print(f"[DEBUG] Saved conversation for {username}")
-                
-                return jsonify({'response': text, 'is_food_query': True, 'show_upload': True, 'conversation_state': 'awaiting_image'})
-        elif is_finance_query:
-            # Retrieve past financial advice conversations for context
-            history = get_relevant_history(db, user.id, conversation_type='financial', limit=5)
-            context_prompt = f"\n\nPrevious financial conversations:\n{history}\n\n" if history else ""
-            
-            # Financial advice feature with RAG context
-            prompt = f"You are Gachirat, a street-smart digital pet rat with surprising financial wisdom from living in the urban jungle.{context_prompt}The user asked: '{user_input}'. Give them practical, savvy financial advice in character - be enthusiastic and confident like a rat who knows how to find the best deals and stash resources wisely. Keep it brief and actionable."
-            text = generate_llm_response(prompt, word_limit=50)
-            
-            # Log conversation to database
-            conversation = Conversation(
-                user_id=user.id,
-                user_message=user_input,
-                bot_response=text,
-                conversation_state='financial_advice'
-            )
-            db.add(conversation)
-            db.commit()
-            print(f"[DEBUG] Saved financial advice conversation for {username}")
-            
-            return jsonify({'response': text, 'is_food_query': False, 'conversation_state': 'initial'})
-        else:
-            # Retrieve past general conversations for context
-            history = get_relevant_history(db, user.id, conversation_type='general', limit=5)
-            context_prompt = f"\n\nPrevious conversations:\n{history}\n\n" if history else ""
-            
-            # Normal conversation
-            prompt = f"You are Gachirat, a friendly digital pet rat.{context_prompt}The user said: '{user_input}'. Respond in character."
-            text = generate_llm_response(prompt)
-            
-            # Log conversation to database
-            conversation = Conversation(
-                user_id=user.id,
-                user_message=user_input,
-                bot_response=text,
-                conversation_state='general_chat'
-            )
-            db.add(conversation)
-            db.commit()
-            print(f"[DEBUG] Saved conversation for {username}")
-            
-            return jsonify({'response': text, 'is_food_query': False, 'conversation_state': 'initial'})
+        return jsonify({'response': text, **payload})
     except Exception as e:
         print(f"✗ Gemini error: {str(e)}")
         return jsonify({'response': f'Error: {str(e)}'}), 500
+
+def sse_event(data, event=None):
+    """Format one Server-Sent Events message"""
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(data)}\n\n"
+
+@app.route('/api/gemini/stream', methods=['POST'])
+def gemini_response_stream():
+    """
+    Streaming variant of /api/gemini (Server-Sent Events).
+    
+    Sends a `token` event per chunk as Gemini generates it, then a `done` event
+    carrying the same fields /api/gemini returns. The complete reply is saved
+    to Conversation once the stream finishes. The same chunks are pushed to the
+    user's Socket.IO room as `reply_chunk` / `reply_done` under `stream_id`.
+    """
+    data = request.get_json()
+    user_input = data.get('input', '')
+    conversation_state = data.get('conversation_state', 'initial')
+    username = data.get('username')
+    stream_id = data.get('stream_id') or uuid.uuid4().hex
+    
+    if not username:
+        return jsonify({'response': 'Username required'}), 400
+    
+    if not user_input:
+        return jsonify({'response': 'No input provided.'}), 400
+    
+    db = get_request_db()
+    try:
+        user = get_or_create_user(db, username)
+        user_id = user.id
+        prompt, word_limit, log_state, payload = plan_chat_reply(db, user, user_input, conversation_state)
+        # Persist a newly created user before the session is released
+        db.commit()
+    except Exception as e:
+        print(f"✗ Gemini error: {str(e)}")
+        return jsonify({'response': f'Error: {str(e)}'}), 500
+    
+    def generate():
+        chunks = []
+        try:
+            full_prompt = build_llm_prompt(prompt, word_limit)
+            log_prompt_tokens(full_prompt, 'chat_stream')
+            for chunk in llm.stream(full_prompt):
+                chunks.append(chunk)
+                yield sse_event({'token': chunk}, event='token')
+                push_reply_chunk(username, stream_id, chunk)
+        except Exception as e:
+            print(f"✗ Gemini stream error: {str(e)}")
+            yield sse_event({'response': f'Error: {str(e)}'}, event='error')
+            return
+        
+        text = "".join(chunks).strip()
+        # The request's session is already released once streaming starts
+        try:
+            with session_scope() as stream_db:
+                save_conversation(stream_db, user_id, user_input, text, log_state)
+            print(f"[DEBUG] Saved streamed conversation for {username} ({log_state})")
+        except Exception as e:
+            print(f"✗ Failed to save streamed conversation: {str(e)}")
+        
+        push_reply_done(username, stream_id, {'response': text, **payload})
+        yield sse_event({'response': text, **payload}, event='done')
+    
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # let nginx pass tokens through unbuffered
+    })
+
+# Helper function to apply a food's health effect and log it
+def record_food(db, username, food_name, category, health_score, confidence, origin=None):
+    """
+    Update the user's health for a food and insert its FoodLog. Returns (new_health, health_change).
+    
+    `origin` is the browser tab that sent the food, so its own push events can be ignored there.
+    """
+    user = get_or_create_user(db, username)
+    
+    # Calculate health change based on food category
+    # Fruits/Vegetables (health_score 4-5): add health_score
+    # Neutral foods (health_score 3): no change
+    # Unhealthy foods (health_score 1-2): subtract (6 - health_score) to penalize more
+    if category in ['fruit', 'vegetable'] and health_score >= 4:
+        health_change = health_score
+    elif health_score >= 3:
+        health_change = 0
+    else:
+        health_change = -(6 - health_score)  # -5 for score 1, -4 for score 2
+    
+    # Update user health (0-20 range)
+    old_health = user.health
+    user.health = max(0, min(20, user.health + health_change))
+    new_health = user.health
+    
+    print(f"Health update for {username}: {old_health} -> {new_health} (change: {health_change})")
+    
+    food_log = FoodLog(
+        user_id=user.id,
+        food_name=food_name,
+        category=category,
+        health_score=health_score,
+        confidence=confidence,
+        # Stamped here so the daily rollup bucket matches the row
+        timestamp=datetime.utcnow()
+    )
+    db.add(food_log)
+    # Rollups move with the log in one transaction
+    nutrition_stats.record(db, user.id, category, health_score, food_log.timestamp)
+    # The stored login greeting no longer reflects this user's foods
+    greetings.food_logged(db, user.id)
+    db.commit()
+    greetings.schedule(user.id)
+    # Only a change of emotion reaches the user's ESP32
+    device_manager.health_changed(user.id, old_health, new_health, db)
+    if nutrition_stats.is_healthy(category, health_score) and new_health <= 10:
+        # Still sad after a healthy meal: a few seconds of happy, like the page shows
+        device_manager.flash(user.id, HAPPY, ESP32_FLASH_SECONDS, db)
+    # Other open tabs learn about the change without polling
+    push_health(username, old_health, new_health, health_change, origin)
+    return new_health, health_change
+
+# Thread pool for running a request's independent stages side by side
+STAGE_POOL_SIZE = int(os.environ.get('STAGE_POOL_SIZE', 16))
+_stage_executor = None
+_stage_executor_pid = None
+
+def get_stage_executor():
+    """Per-process pool (re-created after fork)"""
+    global _stage_executor, _stage_executor_pid
+    if _stage_executor is None or _stage_executor_pid != os.getpid():
+        _stage_executor = ThreadPoolExecutor(max_workers=STAGE_POOL_SIZE, thread_name_prefix='request-stage')
+        _stage_executor_pid = os.getpid()
+    return _stage_executor
+
+def timed(timings, stage, func, *args):
+    """Run func(*args) and record its duration in ms under timings[stage]"""
+    started = time.perf_counter()
+    try:
+        return func(*args)
     finally:
-        db.close()
+        timings[stage] = round((time.perf_counter() - started) * 1000, 1)
 
 @app.route('/api/feed', methods=['POST'])
 def feed_animal():
@@ -414,66 +516,47 @@ def feed_animal():
     if image_file.filename == '':
         return jsonify({'response': 'No image selected.'}), 400
     
+    username = request.form.get('username')
+    if not username:
+        return jsonify({'response': 'Username required'}), 400
+    
+    timings = {}
+    started = time.perf_counter()
     try:
         # Reset file pointer to beginning before classification
         image_file.seek(0)
         
         # Classify the food
-        food_name, confidence = classify_food(image_file)
+        try:
+            food_name, confidence = timed(timings, 'classify_ms', classify_food, image_file)
+        except ImageRejected as e:
+            return jsonify({'response': str(e)}), e.status
         
         # Get nutrition info
         nutrition = get_nutrition_info(food_name)
-        
-        # Generate response based on health score
         health_score = nutrition['health_score']
         category = nutrition['category']
         
-        # Create personalized response using Gemini
-        if health_score >= 4:
-            prompt = f"You are Gachirat, a friendly digital pet rat. The user showed you a picture of {food_name} (a {category}). This is very healthy food! Respond excitedly and praise them for eating healthy. Keep it brief and encouraging. Mention the specific food. {PROMPT_CONSTRAINTS_NO_TUMMY}"
-        elif health_score == 3:
-            prompt = f"You are Gachirat, a friendly digital pet rat. The user showed you a picture of {food_name} (a {category}). This is moderately healthy. Respond positively but suggest balance. Keep it brief and friendly. Mention the specific food. {PROMPT_CONSTRAINTS_NO_TUMMY}"
-        else:
-            prompt = f"You are Gachirat, a friendly digital pet rat. The user showed you a picture of {food_name} (a {category}). This is not very healthy. Respond playfully but gently suggest healthier options next time. Keep it brief, non-judgmental, and friendly. Mention the specific food. {PROMPT_CONSTRAINTS_NO_TUMMY}"
-        
-        text = generate_llm_response(prompt)
-        
-        # Log food entry to database
-        username = request.form.get('username')
-        if not username:
-            return jsonify({'response': 'Username required'}), 400
-        
-        db = next(get_db())
-        user = get_or_create_user(db, username)
-        
-        # Calculate health change based on food category
-        # Fruits/Vegetables (health_score 4-5): add health_score
-        # Neutral foods (health_score 3): no change
-        # Unhealthy foods (health_score 1-2): subtract (6 - health_score) to penalize more
-        if category in ['fruit', 'vegetable'] and health_score >= 4:
-            health_change = health_score
-        elif health_score >= 3:
-            health_change = 0
-        else:
-            health_change = -(6 - health_score)  # -5 for score 1, -4 for score 2
-        
-        # Update user health (0-20 range)
-        old_health = user.health
-        user.health = max(0, min(20, user.health + health_change))
-        new_health = user.health
-        
-        print(f"Health update for {username}: {old_health} -> {new_health} (change: {health_change})")
+        # The reply and the DB update only depend on the classification, so run
+        # them side by side: Gemini text in the stage pool, DB work right here
+        response_future = get_stage_executor().submit(
+            timed, timings, 'response_ms', get_feed_response, food_name, category, health_score
+        )
         
-        food_log = FoodLog(
-            user_id=user.id,
-            food_name=food_name,
-            category=category,
-            health_score=health_score,
-            confidence=confidence
+        db = get_request_db()
+        new_health, health_change = timed(
+            timings, 'db_ms', record_food, db, username, food_name, category, health_score, confidence,
+            request.form.get('tab_id')
         )
-        db.add(food_log)
-        db.commit()
-        db.close()
+        
+        try:
+            text = response_future.result()
+        except Exception as e:
+            # The food is already logged, so don't fail the whole request over the reply
+            print(f"✗ Feed response error: {str(e)}")
+            text = f"Ooh, {food_name}! Thanks for showing me :3"
+        timings['total_ms'] = round((time.perf_counter() - started) * 1000, 1)
+        print(f"[DEBUG] Feed timings for {username}: {timings}")
         
         # Check if food is healthy (fruits/vegetables with score 4-5)
         is_healthy_food = category in ['fruit', 'vegetable'] and health_score >= 4
@@ -487,14 +570,198 @@ def feed_animal():
             'health': new_health,
             'health_change': health_change,
             'is_healthy_food': is_healthy_food,
-            'hide_upload': True
+            'hide_upload': True,
+            'timings': timings
         })
     except Exception as e:
         return jsonify({'response': f'Error: {str(e)}'}), 500
 
+@app.errorhandler(413)
+def request_too_large(e):
+    return jsonify({'response': f'Upload is larger than {MAX_UPLOAD_BYTES // (1024 * 1024)} MB.'}), 413
+
+def history_page(username, model, serialize):
+    """Keyset-paginated rows of one user's history table as {items, next_cursor}"""
+    db = get_request_db()
+    user = db.query(User).filter(User.username == username).first()
+    if user is None:
+        return jsonify({'response': 'User not found'}), 404
+    try:
+        rows, next_cursor = keyset_page(
+            db.query(model).filter(model.user_id == user.id), model,
+            cursor=request.args.get('cursor'), limit=parse_limit(request.args.get('limit'))
+        )
+    except InvalidCursor as e:
+        return jsonify({'response': str(e)}), 400
+    return jsonify({'items': [serialize(row) for row in rows], 'next_cursor': next_cursor})
+
+@app.route('/api/users/<username>/foods', methods=['GET'])
+def user_foods(username):
+    """A user's food logs, newest first (?limit=, ?cursor= from the previous page)"""
+    return history_page(username, FoodLog, lambda f: {
+        'id': f.id, 'food_name': f.food_name, 'category': f.category, 'health_score': f.health_score,
+        'confidence': f.confidence, 'timestamp': f.timestamp.isoformat() if f.timestamp else None
+    })
+
+@app.route('/api/users/<username>/conversations', methods=['GET'])
+def user_conversations(username):
+    """A user's chat turns, newest first (?limit=, ?cursor= from the previous page)"""
+    return history_page(username, Conversation, lambda c: {
+        'id': c.id, 'user_message': c.user_message, 'bot_response': c.bot_response,
+        'conversation_state': c.conversation_state, 'timestamp': c.timestamp.isoformat() if c.timestamp else None
+    })
+
+@app.route('/api/users/<username>/stats', methods=['GET'])
+def user_stats(username):
+    """Nutrition rollups: totals, per-category counts and daily buckets (?days=, default 30)"""
+    db = get_request_db()
+    user = db.query(User).filter(User.username == username).first()
+    if user is None:
+        return jsonify({'response': 'User not found'}), 404
+    try:
+        days = max(1, min(int(request.args.get('days', 30)), 366))
+    except ValueError:
+        return jsonify({'response': 'days must be an integer'}), 400
+    return jsonify({'username': username, 'health': user.health, **nutrition_stats.get_stats(db, user.id, days)})
+
+@app.route('/api/health', methods=['GET'])
+def health_check():
+    """Readiness probe: 200 once the classifier model is loaded, 503 while warming up"""
+    status = model_status()
+    ready = status['state'] == 'ready'
+    return jsonify({'ready': ready, 'model': status}), 200 if ready else 503
+
+@app.route('/api/db/stats', methods=['GET'])
+def db_stats():
+    """Connection pool usage (checkouts, overflow, hold times) for this worker"""
+    return jsonify(get_pool_stats())
+
+@app.route('/api/db/partitions', methods=['GET'])
+def db_partitions():
+    """Monthly partitions of conversations / food_logs with estimated rows and size"""
+    return jsonify({
+        'tables': partition_status(),
+        'maintenance': {'runs': partition_maintainer.runs, 'last_run': partition_maintainer.last_run,
+                        'last_error': partition_maintainer.last_error},
+    })
+
+@app.route('/api/classifier/stats', methods=['GET'])
+def classifier_stats():
+    """Micro-batching stats (batch sizes, queue wait) for tuning the inference worker"""
+    return jsonify(batcher.get_stats())
+
+@app.route('/api/classifier/cache', methods=['GET'])
+def classifier_cache_stats():
+    """Hit/miss counters for the image classification cache"""
+    return jsonify(classification_cache.get_stats())
+
+@app.route('/api/db/writer', methods=['GET'])
+def conversation_writer_stats():
+    """Queue depth and batch sizes for write-behind Conversation persistence"""
+    return jsonify(conversation_writer.get_stats())
+
+@app.route('/api/greetings/stats', methods=['GET'])
+def greeting_stats():
+    """Hit rate and login latency saved by materialized greetings"""
+    return jsonify(greetings.get_stats())
+
+@app.route('/api/history/cache', methods=['GET'])
+def history_cache_stats():
+    """Hit rate and invalidations for the per-user conversation history cache"""
+    return jsonify(history_cache.get_stats())
+
+@app.route('/api/context/stats', methods=['GET'])
+def context_stats():
+    """Summary updates and token budget for prompt context assembly"""
+    return jsonify(context_builder.get_stats())
+
+@app.route('/api/llm/stats', methods=['GET'])
+def llm_stats():
+    """In-flight, retry and timeout counters for the shared Gemini client"""
+    return jsonify(llm.get_stats())
+
+@app.route('/api/llm/cache', methods=['GET'])
+def llm_cache_stats():
+    """Hit rate and variant counts for the canned-prompt response cache"""
+    return jsonify(response_cache.get_stats())
+
+def register_metric_callbacks():
+    """Expose the stats other modules already keep as scrape-time metrics"""
+    def flatten(stats, keys):
+        return {(key,): stats[key] for key in keys}
+    
+    metrics.registry.callback(
+        'gachirat_classification_cache_events_total', 'Classification cache lookups and stores by result', 'counter',
+        lambda: flatten(classification_cache.get_stats(), ['exact_hits', 'perceptual_hits', 'db_hits', 'misses', 'stores', 'evictions']),
+        labels=('result',)
+    )
+    metrics.registry.callback(
+        'gachirat_response_cache_events_total', 'LLM response cache lookups by result', 'counter',
+        lambda: flatten(response_cache.get_stats(), ['hits', 'misses', 'background_fills', 'fill_errors', 'evictions']),
+        labels=('result',)
+    )
+    metrics.registry.callback(
+        'gachirat_history_cache_events_total', 'Conversation history cache lookups by result', 'counter',
+        lambda: flatten(history_cache.get_stats(), ['hits', 'misses', 'appends', 'invalidations', 'evictions', 'listener_errors']),
+        labels=('result',)
+    )
+    metrics.registry.callback(
+        'gachirat_db_pool_connections', 'Connection pool state for this worker', 'gauge',
+        lambda: flatten(get_pool_stats(), ['checked_out', 'checked_in', 'overflow', 'pool_size', 'peak_checked_out']),
+        labels=('state',)
+    )
+    metrics.registry.callback(
+        'gachirat_db_pool_events_total', 'Connection pool checkouts, timeouts and reconnects', 'counter',
+        lambda: flatten(get_pool_stats(), ['checkouts', 'checkins', 'connects', 'invalidations', 'timeouts']),
+        labels=('event',)
+    )
+    metrics.registry.callback(
+        'gachirat_llm_calls_total', 'Gemini calls by outcome', 'counter',
+        lambda: flatten(llm.get_stats(), ['calls', 'succeeded', 'failed', 'retries', 'timeouts']),
+        labels=('outcome',)
+    )
+    metrics.registry.callback(
+        'gachirat_llm_in_flight', 'Gemini calls currently running', 'gauge',
+        lambda: {(): llm.get_stats()['in_flight']}
+    )
+    metrics.registry.callback(
+        'gachirat_conversation_writes_total', 'Conversation rows by write path (queued, written, inline, overflow, failed)', 'counter',
+        lambda: flatten(conversation_writer.get_stats(), ['queued', 'written', 'inline', 'overflow', 'failed']),
+        labels=('path',)
+    )
+    metrics.registry.callback(
+        'gachirat_conversation_queue_depth', 'Conversation rows waiting for a write-behind flush', 'gauge',
+        lambda: {(): conversation_writer.get_stats()['queue_depth']}
+    )
+    metrics.registry.callback(
+        'gachirat_greeting_logins_total', 'Returning-user logins by greeting source (hits, missing, stale)', 'counter',
+        lambda: flatten(greetings.get_stats(), ['hits', 'missing', 'stale']),
+        labels=('result',)
+    )
+    metrics.registry.callback(
+        'gachirat_greeting_latency_saved_ms_total', 'Greeting generation time served from materialized greetings', 'counter',
+        lambda: {(): greetings.get_stats()['latency_saved_ms']}
+    )
+    metrics.registry.callback(
+        'gachirat_esp32_packets_total', 'UDP packets to ESP32 devices and skipped duplicates', 'counter',
+        lambda: flatten(device_manager.get_stats(), ['sent', 'changes', 'heartbeats', 'deduplicated', 'send_errors']),
+        labels=('event',)
+    )
+    metrics.registry.callback(
+        'gachirat_inference_queue_depth', 'Images waiting for the batched ResNet forward pass', 'gauge',
+        lambda: {(): batcher.get_stats()['queue_depth']}
+    )
+
+register_metric_callbacks()
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus scrape endpoint"""
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
+
 @app.route('/api/esp32', methods=['POST'])
 def send_to_esp32():
-    """Send emotion code to ESP32 via UDP"""
+    """Send one emotion code to an ESP32 via UDP (repeats within a heartbeat interval are skipped)"""
     try:
         data = request.get_json()
         emotion = data.get('emotion')
@@ -504,25 +771,41 @@ def send_to_esp32():
         if emotion is None:
             return jsonify({'success': False, 'message': 'No emotion provided'}), 400
         
-        # Create UDP socket
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.settimeout(1.0)  # 1 second timeout
-        
-        # Send emotion as single byte
-        message = bytes([emotion])
-        sock.sendto(message, (ip, port))
-        sock.close()
+        # Shared non-blocking socket; nothing is created per request
+        sent = device_manager.send_code(ip, port, emotion)
+        print(f"[DEBUG] {'Sent' if sent else 'Skipped repeated'} emotion {emotion} to ESP32 at {ip}:{port}")
+        return jsonify({'success': True, 'emotion': emotion, 'sent': sent})
         
-        print(f"[DEBUG] Sent emotion {emotion} to ESP32 at {ip}:{port}")
-        return jsonify({'success': True, 'emotion': emotion})
-        
-    except socket.timeout:
-        print(f"[ERROR] ESP32 socket timeout")
-        return jsonify({'success': False, 'message': 'ESP32 timeout'}), 500
     except Exception as e:
         print(f"[ERROR] ESP32 communication error: {e}")
         return jsonify({'success': False, 'message': str(e)}), 500
 
+@app.route('/api/esp32/register', methods=['POST'])
+def register_esp32():
+    """Register the user's ESP32; the server then sends emotion changes and heartbeats itself"""
+    data = request.get_json()
+    username = data.get('username')
+    ip = data.get('ip')
+    port = data.get('port', 5005)
+    
+    if not username or not ip:
+        return jsonify({'success': False, 'message': 'Username and ip are required'}), 400
+    
+    try:
+        db = get_request_db()
+        user = get_or_create_user(db, username)
+        device_manager.register(user.id, ip, port, user.health, db)
+        print(f"[DEBUG] Registered ESP32 {ip}:{port} for {username}")
+        return jsonify({'success': True, 'ip': ip, 'port': int(port)})
+    except Exception as e:
+        print(f"[ERROR] ESP32 registration error: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@app.route('/api/esp32/stats', methods=['GET'])
+def esp32_stats():
+    """Registered devices, packets sent and duplicates skipped by the ESP32 manager"""
+    return jsonify(device_manager.get_stats())
+
 @app.route('/')
 def index():
     return render_template('index.html')
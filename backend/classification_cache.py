@@ -0,0 +1,205 @@
+"""
+Classification result cache for repeated food images.
+
+Entries are keyed by an exact content hash (SHA-256 of the upload) plus a
+64-bit difference hash (dHash) of the decoded image. A re-upload of the same
+file hits on the content hash before decoding; a near-identical shot (resized,
+re-encoded, slightly cropped) hits when its dHash is within
+CLASSIFICATION_CACHE_MAX_DISTANCE bits of a cached one. Either way the earlier
+(food_name, confidence) is returned without running ResNet50 or Gemini.
+
+In-memory entries are evicted LRU and by TTL. With CLASSIFICATION_CACHE_PERSIST=1
+results are also written to the `classification_cache` table so they survive
+restarts and are shared by all workers (exact content/dHash matches only).
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from PIL import Image
+
+CLASSIFICATION_CACHE_SIZE = int(os.environ.get('CLASSIFICATION_CACHE_SIZE', 2048))
+CLASSIFICATION_CACHE_TTL = float(os.environ.get('CLASSIFICATION_CACHE_TTL', 7 * 24 * 3600))
+CLASSIFICATION_CACHE_MAX_DISTANCE = int(os.environ.get('CLASSIFICATION_CACHE_MAX_DISTANCE', 6))
+CLASSIFICATION_CACHE_PERSIST = os.environ.get('CLASSIFICATION_CACHE_PERSIST', '0') == '1'
+
+HASH_SIZE = 8
+
+
+def content_hash(image_bytes):
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def dhash(image, hash_size=HASH_SIZE):
+    """64-bit difference hash: brightness gradient signs of a 9x8 grayscale thumbnail"""
+    small = image.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+def _to_signed64(value):
+    # Postgres BIGINT is signed
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def _from_signed64(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+class _Entry:
+    __slots__ = ('food_name', 'confidence', 'phash', 'created_at')
+
+    def __init__(self, food_name, confidence, phash, created_at=None):
+        self.food_name = food_name
+        self.confidence = confidence
+        self.phash = phash
+        self.created_at = created_at or time.time()
+
+
+class ClassificationCache:
+    """LRU + TTL cache of (food_name, confidence) keyed by content hash and dHash"""
+
+    def __init__(self, max_size=CLASSIFICATION_CACHE_SIZE, ttl=CLASSIFICATION_CACHE_TTL,
+                 max_distance=CLASSIFICATION_CACHE_MAX_DISTANCE, persist=CLASSIFICATION_CACHE_PERSIST):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.persist = persist
+        self._entries = OrderedDict()  # content hash -> _Entry, oldest first
+        self._lock = threading.Lock()
+        self._counters = {'exact_hits': 0, 'perceptual_hits': 0, 'db_hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+
+    def _count(self, name):
+        self._counters[name] += 1
+
+    def _expired(self, entry, now):
+        return self.ttl > 0 and now - entry.created_at > self.ttl
+
+    def get_exact(self, key):
+        """Look up by content hash only (no decode needed)"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self._expired(entry, now):
+                    del self._entries[key]
+                    self._count('evictions')
+                else:
+                    self._entries.move_to_end(key)
+                    self._count('exact_hits')
+                    return entry.food_name, entry.confidence
+
+        if self.persist:
+            row = self._db_lookup(key, None)
+            if row is not None:
+                return row
+        return None
+
+    def get_similar(self, key, phash):
+        """Look up the closest cached dHash within max_distance bits"""
+        now = time.time()
+        best_key, best_distance = None, self.max_distance + 1
+        with self._lock:
+            for cached_key, entry in self._entries.items():
+                distance = hamming_distance(phash, entry.phash)
+                if distance < best_distance and not self._expired(entry, now):
+                    best_key, best_distance = cached_key, distance
+                    if distance == 0:
+                        break
+            if best_key is not None:
+                entry = self._entries[best_key]
+                self._entries.move_to_end(best_key)
+                self._count('perceptual_hits')
+                # Remember this exact upload too, so its next re-upload skips decoding
+                self._insert(key, _Entry(entry.food_name, entry.confidence, phash))
+                print(f"[DEBUG] Classification cache near-duplicate hit (distance {best_distance})")
+                return entry.food_name, entry.confidence
+
+        if self.persist:
+            row = self._db_lookup(None, phash)
+            if row is not None:
+                return row
+
+        with self._lock:
+            self._count('misses')
+        return None
+
+    def put(self, key, phash, food_name, confidence):
+        with self._lock:
+            self._insert(key, _Entry(food_name, confidence, phash))
+            self._count('stores')
+        if self.persist:
+            self._db_store(key, phash, food_name, confidence)
+
+    def _insert(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self._count('evictions')
+
+    def _db_lookup(self, key, phash):
+        from database import session_scope, ClassificationCacheEntry
+
+        try:
+            with session_scope() as db:
+                query = db.query(ClassificationCacheEntry)
+                if key is not None:
+                    row = query.filter(ClassificationCacheEntry.content_hash == key).first()
+                else:
+                    row = query.filter(ClassificationCacheEntry.phash == _to_signed64(phash)).first()
+                if row is None:
+                    return None
+                if self.ttl > 0 and time.time() - row.created_at.timestamp() > self.ttl:
+                    return None
+                with self._lock:
+                    self._insert(row.content_hash, _Entry(row.food_name, row.confidence, _from_signed64(row.phash)))
+                    self._count('db_hits')
+                return row.food_name, row.confidence
+        except Exception as e:
+            print(f"[ERROR] Classification cache lookup failed: {e}")
+            return None
+
+    def _db_store(self, key, phash, food_name, confidence):
+        from database import session_scope, ClassificationCacheEntry
+
+        try:
+            with session_scope() as db:
+                if db.query(ClassificationCacheEntry.id).filter(ClassificationCacheEntry.content_hash == key).first() is None:
+                    db.add(ClassificationCacheEntry(
+                        content_hash=key,
+                        phash=_to_signed64(phash),
+                        food_name=food_name,
+                        confidence=confidence
+                    ))
+                    db.commit()
+        except Exception as e:
+            print(f"[ERROR] Classification cache store failed: {e}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['size'] = len(self._entries)
+        lookups = stats['exact_hits'] + stats['perceptual_hits'] + stats['db_hits'] + stats['misses']
+        stats['hit_rate'] = (lookups - stats['misses']) / lookups if lookups else 0.0
+        stats['max_size'] = self.max_size
+        stats['ttl_seconds'] = self.ttl
+        stats['max_distance'] = self.max_distance
+        stats['persist'] = self.persist
+        return stats
@@ -0,0 +1,267 @@
+"""
+Token-budgeted RAG context for chat prompts.
+
+The history section of a prompt is capped at CONTEXT_TOKEN_BUDGET tokens:
+a rolling summary of the user's older turns (conversation_summaries table)
+comes first, then as many of the most recent turns as fit, newest first,
+each clipped to CONTEXT_TURN_MAX_TOKENS. Long messages or chatty users no
+longer make every prompt bigger.
+
+Summaries are updated off the request path. After a turn is saved, a
+background job checks how many turns have fallen out of the verbatim window
+since the last summary and, once SUMMARY_MIN_TURNS have, asks Gemini to fold
+them into the summary. Updates are optimistic (guarded on the previous
+last_conversation_id), so concurrent workers can't clobber each other.
+
+Token counts are estimated at ~4 characters per token (no API round trip);
+close enough for budgeting and for comparing prompt sizes.
+"""
+
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy.dialects.postgresql import insert
+
+from history_cache import history_cache, HISTORY_LOOKBACK_DAYS, HISTORY_TYPES, STATE_TYPES
+from llm_client import llm
+from metrics import prompt_tokens
+
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', 300))
+CONTEXT_RECENT_TURNS = int(os.environ.get('CONTEXT_RECENT_TURNS', 5))
+CONTEXT_TURN_MAX_TOKENS = int(os.environ.get('CONTEXT_TURN_MAX_TOKENS', 60))
+SUMMARY_MAX_WORDS = int(os.environ.get('SUMMARY_MAX_WORDS', 60))
+SUMMARY_MIN_TURNS = int(os.environ.get('SUMMARY_MIN_TURNS', 3))
+SUMMARY_MAX_BATCH = int(os.environ.get('SUMMARY_MAX_BATCH', 20))
+SUMMARY_CACHE_TTL = float(os.environ.get('SUMMARY_CACHE_TTL', 300))
+SUMMARY_CACHE_MAX_ENTRIES = int(os.environ.get('SUMMARY_CACHE_MAX_ENTRIES', 3000))
+SUMMARY_WORKERS = int(os.environ.get('SUMMARY_WORKERS', 2))
+
+CHARS_PER_TOKEN = 4
+
+# Turns are stamped before they're committed, so one stamped slightly earlier can
+# still get a later id than the last folded turn
+SUMMARY_SCAN_SLACK = timedelta(days=1)
+
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN) if text else 0
+
+
+def clip(text, max_tokens):
+    """Cut text to about max_tokens, on a word boundary"""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars].rsplit(' ', 1)[0] + '...'
+
+
+def log_prompt_tokens(prompt, label='chat'):
+    """Record the size of a prompt sent to Gemini"""
+    tokens = estimate_tokens(prompt)
+    prompt_tokens.observe(tokens, label)
+    print(f"[DEBUG] Prompt tokens ({label}): ~{tokens}")
+    return tokens
+
+
+def summary_scan_bounds(last_at):
+    """
+    Timestamp conditions for a summary update's scan of `conversations`.
+
+    Turns newer than the summary start at its last folded turn (less
+    SUMMARY_SCAN_SLACK), and only the history lookback is worth folding, so
+    Postgres can prune every older monthly partition.
+    """
+    from database import Conversation
+
+    now = datetime.utcnow()
+    since = last_at - SUMMARY_SCAN_SLACK if last_at is not None else None
+    if HISTORY_LOOKBACK_DAYS > 0:
+        lookback = now - timedelta(days=HISTORY_LOOKBACK_DAYS)
+        since = lookback if since is None else max(since, lookback)
+    conditions = [Conversation.timestamp < now + timedelta(days=1)]
+    if since is not None:
+        conditions.append(Conversation.timestamp >= since)
+    return conditions
+
+
+class ContextBuilder:
+    """Summary + recent turns within a token budget, with background summary updates"""
+
+    def __init__(self, token_budget=CONTEXT_TOKEN_BUDGET, recent_turns=CONTEXT_RECENT_TURNS,
+                 turn_max_tokens=CONTEXT_TURN_MAX_TOKENS):
+        self.token_budget = token_budget
+        self.recent_turns = recent_turns
+        self.turn_max_tokens = turn_max_tokens
+        self._summaries = OrderedDict()  # (user_id, type) -> (summary, fetched_at)
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._executor = None
+        self._executor_pid = None
+        self._counters = {'summary_updates': 0, 'summary_conflicts': 0, 'summary_errors': 0, 'turns_dropped': 0}
+
+    # Prompt assembly
+
+    def build(self, db, user_id, conversation_type, recent_turns=None):
+        """History section for a prompt (summary first, then recent turns oldest to newest)"""
+        recent_turns = recent_turns or self.recent_turns
+        remaining = self.token_budget
+        parts = []
+
+        summary = self.get_summary(db, user_id, conversation_type)
+        if summary:
+            line = f"Summary of earlier chats: {clip(summary, remaining // 2)}"
+            parts.append(line)
+            remaining -= estimate_tokens(line)
+
+        turns = history_cache.get(db, user_id, conversation_type, recent_turns)
+        kept = []
+        for user_message, bot_response in reversed(turns):
+            lines = (f"User: {clip(user_message or '', self.turn_max_tokens)}\n"
+                     f"Gachirat: {clip(bot_response or '', self.turn_max_tokens)}")
+            cost = estimate_tokens(lines)
+            if cost > remaining:
+                with self._lock:
+                    self._counters['turns_dropped'] += len(turns) - len(kept)
+                break
+            kept.append(lines)
+            remaining -= cost
+        parts.extend(reversed(kept))
+        return "\n".join(parts)
+
+    def get_summary(self, db, user_id, conversation_type):
+        from database import ConversationSummary
+
+        key = (user_id, conversation_type)
+        now = time.time()
+        with self._lock:
+            cached = self._summaries.get(key)
+            if cached is not None and now - cached[1] <= SUMMARY_CACHE_TTL:
+                self._summaries.move_to_end(key)
+                return cached[0]
+        row = db.query(ConversationSummary.summary).filter(
+            ConversationSummary.user_id == user_id,
+            ConversationSummary.conversation_type == conversation_type
+        ).first()
+        summary = row[0] if row else ''
+        self._remember(key, summary, now)
+        return summary
+
+    def _remember(self, key, summary, now):
+        with self._lock:
+            self._summaries[key] = (summary, now)
+            self._summaries.move_to_end(key)
+            while len(self._summaries) > SUMMARY_CACHE_MAX_ENTRIES:
+                self._summaries.popitem(last=False)
+
+    # Background summary updates
+
+    def _get_executor(self):
+        # Per process so pre-forked workers don't inherit dead threads
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=SUMMARY_WORKERS, thread_name_prefix='context-summary')
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def schedule_summary(self, user_id, conversation_state):
+        """Queue a summary check after a turn is saved (no-op if one is already queued for this user/type)"""
+        conversation_type = STATE_TYPES.get(conversation_state)
+        if conversation_type is None:
+            return
+        key = (user_id, conversation_type)
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+        self._get_executor().submit(self._update_summary, key)
+
+    def _update_summary(self, key):
+        from database import session_scope, Conversation, ConversationSummary
+
+        user_id, conversation_type = key
+        try:
+            with session_scope() as db:
+                row = db.query(
+                    ConversationSummary.summary, ConversationSummary.last_conversation_id,
+                    ConversationSummary.last_conversation_at
+                ).filter(
+                    ConversationSummary.user_id == user_id,
+                    ConversationSummary.conversation_type == conversation_type
+                ).first()
+                previous, last_id, last_at = tuple(row) if row else ('', None, None)
+                turns = db.query(
+                    Conversation.id, Conversation.user_message, Conversation.bot_response, Conversation.timestamp
+                ).filter(
+                    Conversation.user_id == user_id,
+                    Conversation.conversation_state.in_(HISTORY_TYPES[conversation_type]),
+                    Conversation.id > (last_id or 0),
+                    *summary_scan_bounds(last_at)
+                ).order_by(Conversation.timestamp.desc()).limit(self.recent_turns + SUMMARY_MAX_BATCH).all()
+            turns.reverse()
+
+            # Only turns that have left the verbatim window get folded in; a
+            # backlog bigger than one batch keeps just its newest part
+            folding = turns[:-self.recent_turns] if len(turns) > self.recent_turns else []
+            if len(folding) < SUMMARY_MIN_TURNS:
+                return
+
+            exchanges = "\n".join(
+                f"User: {clip(message or '', 100)}\nGachirat: {clip(response or '', 100)}"
+                for _, message, response, _ in folding
+            )
+            prompt = (
+                f"You keep a short memory for Gachirat, a digital pet rat, about one user's {conversation_type} chats. "
+                f"Current memory: {previous or 'none yet'}\n\nNew exchanges:\n{exchanges}\n\n"
+                f"Write the updated memory in at most {SUMMARY_MAX_WORDS} words, third person, plain text. "
+                f"Keep lasting facts (preferences, habits, goals, recurring topics) and drop small talk."
+            )
+            log_prompt_tokens(prompt, 'summary')
+            summary = llm.generate(prompt)
+            new_last_id, new_last_at = folding[-1][0], folding[-1][3]
+
+            with session_scope() as db:
+                if row is None:
+                    updated = db.execute(insert(ConversationSummary).values(
+                        user_id=user_id, conversation_type=conversation_type, summary=summary,
+                        last_conversation_id=new_last_id, last_conversation_at=new_last_at, updated_at=datetime.utcnow()
+                    ).on_conflict_do_nothing(constraint='uq_conversation_summaries_user_type')).rowcount
+                else:
+                    # Only replace the summary we started from; another worker may have moved on
+                    updated = db.query(ConversationSummary).filter(
+                        ConversationSummary.user_id == user_id,
+                        ConversationSummary.conversation_type == conversation_type,
+                        ConversationSummary.last_conversation_id == last_id
+                    ).update({'summary': summary, 'last_conversation_id': new_last_id,
+                              'last_conversation_at': new_last_at, 'updated_at': datetime.utcnow()},
+                             synchronize_session=False)
+                db.commit()
+
+            applied = updated == 1
+            with self._lock:
+                self._counters['summary_updates' if applied else 'summary_conflicts'] += 1
+            if applied:
+                self._remember(key, summary, time.time())
+                print(f"[DEBUG] Summarized {len(folding)} turns for user {user_id} ({conversation_type})")
+        except Exception as e:
+            print(f"[ERROR] Conversation summary update failed for {key}: {e}")
+            with self._lock:
+                self._counters['summary_errors'] += 1
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['cached_summaries'] = len(self._summaries)
+            stats['pending'] = len(self._pending)
+        stats['token_budget'] = self.token_budget
+        stats['recent_turns'] = self.recent_turns
+        return stats
+
+
+context_builder = ContextBuilder()
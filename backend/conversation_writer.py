@@ -0,0 +1,325 @@
+"""
+Write-behind persistence for Conversation rows.
+
+By default every chat turn is inserted and committed inline, so the reply
+waits on a Postgres round trip and an fsync. With CONVERSATION_WRITE_BEHIND=1
+turns go into a bounded queue instead, and one writer thread per process
+inserts them as multi-row INSERTs in a single transaction, at most
+CONVERSATION_BATCH_SIZE rows at a time.
+
+CONVERSATION_DURABILITY picks what the request waits for:
+
+- sync: the request blocks until the batch holding its row has committed
+  (group commit - concurrent turns share one fsync; nothing is lost). Each
+  flush takes whatever is queued; turns arriving meanwhile form the next one.
+- async: the request returns as soon as the row is queued, and the writer
+  waits up to CONVERSATION_FLUSH_MS after the first row to fill a batch. A
+  crash loses at most the queued rows, and a turn can be missing from the
+  very next prompt's history if that request runs before the flush.
+
+The queue holds at most CONVERSATION_QUEUE_MAX rows. When it is full the
+request writes its row inline rather than wait or drop it. close() drains
+the queue on shutdown (atexit and gunicorn's worker_exit).
+
+    DB_MAX_OVERFLOW=20 python conversation_writer.py --rows 5000 --threads 16   # per-row vs batched
+"""
+
+import atexit
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime
+
+from sqlalchemy import insert
+
+from context_builder import context_builder
+from database import Conversation, session_scope
+from history_cache import history_cache
+from metrics import observe_stage, registry
+
+CONVERSATION_WRITE_BEHIND = os.environ.get('CONVERSATION_WRITE_BEHIND', '0') == '1'
+CONVERSATION_DURABILITY = os.environ.get('CONVERSATION_DURABILITY', 'sync')  # sync or async
+CONVERSATION_BATCH_SIZE = int(os.environ.get('CONVERSATION_BATCH_SIZE', 100))
+CONVERSATION_FLUSH_MS = float(os.environ.get('CONVERSATION_FLUSH_MS', 50))
+CONVERSATION_QUEUE_MAX = int(os.environ.get('CONVERSATION_QUEUE_MAX', 10000))
+# Upper bound on how long a sync-durability request waits for its batch
+CONVERSATION_SYNC_TIMEOUT = float(os.environ.get('CONVERSATION_SYNC_TIMEOUT', 10))
+
+batch_rows = registry.histogram(
+    'gachirat_conversation_batch_rows', 'Conversation rows per write-behind flush',
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500)
+)
+
+_STOP = object()
+
+
+class _PendingTurn:
+    __slots__ = ('values', 'future')
+
+    def __init__(self, values):
+        self.values = values
+        self.future = Future()
+
+
+def after_commit(conversations):
+    """History cache write-through and summary scheduling for committed turns"""
+    for conversation in conversations:
+        history_cache.record(conversation)
+        # Fold turns that left the verbatim window into the rolling summary (background)
+        context_builder.schedule_summary(conversation.user_id, conversation.conversation_state)
+
+
+class ConversationWriter:
+    """Queues Conversation rows and commits them in batches on a background thread"""
+
+    def __init__(self, enabled=CONVERSATION_WRITE_BEHIND, durability=CONVERSATION_DURABILITY,
+                 batch_size=CONVERSATION_BATCH_SIZE, flush_ms=CONVERSATION_FLUSH_MS, max_queued=CONVERSATION_QUEUE_MAX):
+        if durability not in ('sync', 'async'):
+            raise ValueError(f"CONVERSATION_DURABILITY must be 'sync' or 'async', got {durability!r}")
+        self.enabled = enabled
+        self.durability = durability
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = max(0.0, flush_ms) / 1000.0
+        self.max_queued = max_queued
+
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._stats_lock = threading.Lock()
+        self._counters = {'queued': 0, 'written': 0, 'inline': 0, 'overflow': 0, 'batches': 0, 'failed': 0}
+
+    def _count(self, name, amount=1):
+        with self._stats_lock:
+            self._counters[name] += amount
+
+    def _ensure_started(self):
+        # Started lazily (and re-started after fork) like the inference batcher
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.max_queued)
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._loop, name='conversation-writer', daemon=True)
+            self._thread.start()
+            print(f"[DEBUG] Conversation writer started ({self.durability}, batch {self.batch_size}, "
+                  f"flush {self.flush_interval * 1000:.0f}ms)")
+
+    # Producers
+
+    def write(self, db, user_id, user_message, bot_response, conversation_state):
+        """Persist one chat turn; inline on `db` unless write-behind is on (and has room)"""
+        values = {
+            'user_id': user_id,
+            'user_message': user_message,
+            'bot_response': bot_response,
+            'conversation_state': conversation_state,
+            # Stamped now, so history order follows the turns rather than the flushes
+            'timestamp': datetime.utcnow(),
+        }
+        if not self.enabled:
+            return self.write_inline(db, values)
+
+        self._ensure_started()
+        # The writer thread inserts on its own connection, so whatever the request
+        # flushed (a new user, a health reset) must be committed before its row
+        # references it
+        db.commit()
+        turn = _PendingTurn(values)
+        try:
+            self._queue.put_nowait(turn)
+        except queue.Full:
+            # Bounded memory: past the limit, pay for a direct write instead of queueing more
+            self._count('overflow')
+            return self.write_inline(db, values)
+        self._count('queued')
+        if self.durability == 'sync':
+            return turn.future.result(timeout=CONVERSATION_SYNC_TIMEOUT)
+        return None
+
+    def write_inline(self, db, values):
+        """The per-row path: add, notify other workers, commit, write through"""
+        conversation = Conversation(**values)
+        db.add(conversation)
+        # Tell other workers' history caches in the same transaction
+        history_cache.notify(db, values['user_id'], values['conversation_state'])
+        db.commit()
+        self._count('inline')
+        after_commit([conversation])
+        return conversation
+
+    # Writer thread
+
+    def _collect(self):
+        """Block for the first turn, then gather more until the batch is full or the interval ends"""
+        batch = [self._queue.get()]
+        if batch[0] is _STOP:
+            return batch
+        # Sync requests are blocked on the flush, so don't linger for more rows:
+        # take what is already queued and let turns that arrive during this
+        # commit form the next batch (group commit)
+        linger = self.flush_interval if self.durability == 'async' else 0.0
+        deadline = time.perf_counter() + linger
+        while len(batch) < self.batch_size:
+            try:
+                turn = self._queue.get_nowait()
+            except queue.Empty:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    turn = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            batch.append(turn)
+            if turn is _STOP:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            stop = batch[-1] is _STOP
+            turns = [turn for turn in batch if turn is not _STOP]
+            if turns:
+                self._flush(turns)
+            if stop:
+                return
+
+    def _flush(self, turns):
+        started = time.perf_counter()
+        try:
+            conversations = self._insert([turn.values for turn in turns])
+        except Exception as e:
+            print(f"[ERROR] Conversation batch of {len(turns)} failed, retrying row by row: {e}")
+            self._flush_rows(turns)
+            return
+        observe_stage('conversation_flush', time.perf_counter() - started)
+        batch_rows.observe(len(turns))
+        self._count('batches')
+        self._count('written', len(turns))
+        for turn, conversation in zip(turns, conversations):
+            turn.future.set_result(conversation)
+        try:
+            after_commit(conversations)
+        except Exception as e:
+            print(f"[ERROR] Conversation write-through failed: {e}")
+
+    def _flush_rows(self, turns):
+        # Isolates a bad row so one failure doesn't lose the whole batch
+        for turn in turns:
+            try:
+                conversation = self._insert([turn.values])[0]
+                self._count('written')
+                turn.future.set_result(conversation)
+                after_commit([conversation])
+            except Exception as e:
+                print(f"[ERROR] Conversation row for user {turn.values['user_id']} dropped: {e}")
+                self._count('failed')
+                if not turn.future.done():
+                    turn.future.set_exception(e)
+
+    def _insert(self, rows):
+        """One multi-row INSERT ... RETURNING id and one commit; returns detached Conversations in order"""
+        with session_scope() as db:
+            ids = db.execute(insert(Conversation).returning(Conversation.id, sort_by_parameter_order=True), rows).scalars().all()
+            for key in {(row['user_id'], row['conversation_state']) for row in rows}:
+                history_cache.notify(db, *key)
+            db.commit()
+        return [Conversation(id=conversation_id, **row) for conversation_id, row in zip(ids, rows)]
+
+    # Shutdown
+
+    def close(self, timeout=10):
+        """Flush everything queued and stop the writer thread"""
+        thread = self._thread
+        if thread is None or self._pid != os.getpid() or not thread.is_alive():
+            return
+        pending = self._queue.qsize()
+        self._queue.put(_STOP)
+        thread.join(timeout)
+        self._thread = None
+        print(f"[DEBUG] Conversation writer drained ({pending} queued at shutdown)")
+
+    def get_stats(self):
+        with self._stats_lock:
+            stats = dict(self._counters)
+        stats['enabled'] = self.enabled
+        stats['durability'] = self.durability
+        stats['queue_depth'] = self._queue.qsize()
+        stats['avg_batch_rows'] = stats['written'] / stats['batches'] if stats['batches'] else 0.0
+        return stats
+
+
+conversation_writer = ConversationWriter()
+atexit.register(conversation_writer.close)
+
+
+if __name__ == '__main__':
+    # Compare per-row commits with batched writes against a throwaway database
+    import argparse
+
+    from database import User, init_db
+
+    parser = argparse.ArgumentParser(description='Conversation insert throughput: per-row commits vs write-behind')
+    parser.add_argument('--rows', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--keep', action='store_true', help='keep the rows written by the benchmark')
+    args = parser.parse_args()
+
+    init_db()
+    with session_scope() as db:
+        user = db.query(User).filter(User.username == 'conversation_writer_bench').first()
+        if user is None:
+            user = User(username='conversation_writer_bench')
+            db.add(user)
+            db.commit()
+        user_id = user.id
+
+    def run(writer):
+        per_thread = args.rows // args.threads
+        latencies = []
+        lock = threading.Lock()
+
+        def worker():
+            local = []
+            for i in range(per_thread):
+                # One session per turn, like a request's
+                with session_scope() as db:
+                    started = time.perf_counter()
+                    writer.write(db, user_id, f'bench message {i}', 'squeak', 'bench')
+                    local.append(time.perf_counter() - started)
+            with lock:
+                latencies.extend(local)
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        writer.close()
+        elapsed = time.perf_counter() - started
+        latencies.sort()
+        p50 = latencies[len(latencies) // 2] * 1000
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+        return len(latencies) / elapsed, p50, p99
+
+    print(f"{args.rows} rows from {args.threads} threads")
+    for label, writer in (
+        ('per-row commit', ConversationWriter(enabled=False)),
+        ('write-behind sync', ConversationWriter(enabled=True, durability='sync')),
+        ('write-behind async', ConversationWriter(enabled=True, durability='async')),
+    ):
+        rate, p50, p99 = run(writer)
+        print(f"{label:<20} {rate:8.0f} rows/s   request p50 {p50:6.2f}ms  p99 {p99:6.2f}ms  {writer.get_stats()}")
+
+    if not args.keep:
+        with session_scope() as db:
+            db.query(Conversation).filter(Conversation.user_id == user_id).delete(synchronize_session=False)
+            db.query(User).filter(User.id == user_id).delete(synchronize_session=False)
+            db.commit()
@@ -0,0 +1,328 @@
+"""
+Streaming bulk export and import of conversations and food logs.
+
+Exports read through a server-side cursor (`yield_per`), so only
+EXPORT_BATCH_ROWS rows are in memory at a time whatever the table size, and
+write NDJSON, CSV or Parquet (one row group per batch). Every row carries the
+owner's `username` next to `user_id`, so a dump can be loaded into another
+database whose user ids differ.
+
+Imports stream the file into Postgres `COPY ... FROM STDIN` (no per-row
+INSERTs, at most COPY_CHUNK_BYTES buffered) into a temporary staging table,
+then move the rows across in one INSERT ... SELECT that maps usernames to
+user ids, creating missing users. Food log imports add the rows they
+inserted to the nutrition rollups in that same statement.
+
+    python data_transfer.py export food_logs -o foods.ndjson --user alice --since 2025-01-01
+    python data_transfer.py export conversations -o chats.parquet --until 2025-06-01
+    python data_transfer.py import food_logs foods.ndjson
+    python data_transfer.py import conversations chats.csv --keep-ids
+
+The format comes from the file extension unless --format is given; `-` is
+stdout / stdin (NDJSON or CSV). Parquet needs pyarrow (`pip install pyarrow`).
+"""
+
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import time
+from datetime import date, datetime
+
+from sqlalchemy import select
+
+import nutrition_stats
+from database import engine, init_db, session_scope, Conversation, FoodLog, User
+
+EXPORT_BATCH_ROWS = int(os.environ.get('EXPORT_BATCH_ROWS', 5000))
+# Bytes handed to COPY per read
+COPY_CHUNK_BYTES = 1024 * 1024
+
+TABLES = {'conversations': Conversation, 'food_logs': FoodLog}
+FORMATS = ('ndjson', 'csv', 'parquet')
+EXTENSIONS = {'.ndjson': 'ndjson', '.jsonl': 'ndjson', '.json': 'ndjson', '.csv': 'csv', '.parquet': 'parquet'}
+
+
+def columns_for(model):
+    """Exported columns: the table's own, then the owner's username"""
+    return [column.name for column in model.__table__.columns] + ['username']
+
+
+def detect_format(path, fmt=None):
+    if fmt:
+        return fmt
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in EXTENSIONS:
+        raise SystemExit(f"Can't tell the format of {path!r}; pass --format ({', '.join(FORMATS)})")
+    return EXTENSIONS[extension]
+
+
+def parse_time(value):
+    return datetime.fromisoformat(value) if value else None
+
+
+# Export
+
+def export_rows(model, usernames=None, since=None, until=None, batch_rows=EXPORT_BATCH_ROWS):
+    """Yield row dicts of a table, oldest first, from a server-side cursor"""
+    columns = [column for column in model.__table__.columns]
+    query = select(*columns, User.username).join(User, User.id == model.user_id)
+    if usernames:
+        query = query.where(User.username.in_(usernames))
+    if since is not None:
+        query = query.where(model.timestamp >= since)
+    if until is not None:
+        query = query.where(model.timestamp < until)
+    query = query.order_by(model.timestamp, model.id)
+
+    names = columns_for(model)
+    with session_scope() as db:
+        # yield_per streams from a named (server-side) cursor instead of fetching everything
+        result = db.execute(query.execution_options(yield_per=batch_rows))
+        for row in result:
+            yield dict(zip(names, row))
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def write_ndjson(rows, out):
+    count = 0
+    for row in rows:
+        out.write(json.dumps(row, default=_json_default))
+        out.write('\n')
+        count += 1
+    return count
+
+
+def write_csv(rows, out, names):
+    writer = csv.DictWriter(out, fieldnames=names)
+    writer.writeheader()
+    count = 0
+    for row in rows:
+        writer.writerow({key: value.isoformat() if isinstance(value, (datetime, date)) else value for key, value in row.items()})
+        count += 1
+    return count
+
+
+def _arrow_schema(model):
+    import pyarrow as pa
+
+    types = {'Integer': pa.int64(), 'BigInteger': pa.int64(), 'Float': pa.float64(), 'DateTime': pa.timestamp('us')}
+    fields = [pa.field(column.name, types.get(type(column.type).__name__, pa.string())) for column in model.__table__.columns]
+    return pa.schema(fields + [pa.field('username', pa.string())])
+
+
+def write_parquet(rows, path, model, batch_rows=EXPORT_BATCH_ROWS):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise SystemExit("Parquet export needs pyarrow: pip install pyarrow")
+
+    schema = _arrow_schema(model)
+    count = 0
+    batch = []
+    with pq.ParquetWriter(path, schema, compression='zstd') as writer:
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_rows:
+                writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+                count += len(batch)
+                batch = []
+        if batch:
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+            count += len(batch)
+    return count
+
+
+def export_table(table, path, fmt=None, usernames=None, since=None, until=None):
+    """Stream one table to a file (or stdout for '-'); returns the row count"""
+    model = TABLES[table]
+    fmt = detect_format(path, fmt) if path != '-' else (fmt or 'ndjson')
+    rows = export_rows(model, usernames, since, until)
+    if fmt == 'parquet':
+        if path == '-':
+            raise SystemExit("Parquet can't be written to stdout; pass -o file.parquet")
+        return write_parquet(rows, path, model)
+
+    out = sys.stdout if path == '-' else open(path, 'w', newline='', encoding='utf-8')
+    try:
+        if fmt == 'csv':
+            return write_csv(rows, out, columns_for(model))
+        return write_ndjson(rows, out)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+# Import
+
+def read_ndjson(source):
+    for line in source:
+        if line.strip():
+            yield json.loads(line)
+
+
+def read_csv(source):
+    for row in csv.DictReader(source):
+        # CSV can't tell NULL from '' - empty fields load as NULL
+        yield {key: (value if value != '' else None) for key, value in row.items()}
+
+
+def read_parquet(path, batch_rows=EXPORT_BATCH_ROWS):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise SystemExit("Parquet import needs pyarrow: pip install pyarrow")
+
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_rows):
+        yield from batch.to_pylist()
+
+
+def _copy_value(value):
+    """One field in COPY's text format"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, (datetime, date)):
+        value = value.isoformat()
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+class CopyStream(io.RawIOBase):
+    """File-like view of rows as COPY text lines, produced as COPY reads them"""
+
+    def __init__(self, rows, names):
+        self._lines = ('\t'.join(_copy_value(row.get(name)) for name in names).encode('utf-8') + b'\n' for row in rows)
+        self._buffer = b''
+        self.rows = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, target):
+        chunks, size = [self._buffer], len(self._buffer)
+        while size < len(target):
+            line = next(self._lines, None)
+            if line is None:
+                break
+            chunks.append(line)
+            size += len(line)
+            self.rows += 1
+        data = b''.join(chunks)
+        size = min(len(target), len(data))
+        target[:size] = data[:size]
+        self._buffer = data[size:]
+        return size
+
+
+def import_rows(table, rows, keep_ids=False):
+    """COPY rows into staging, then insert them with user ids looked up by username. Returns (copied, inserted)."""
+    model = TABLES[table]
+    data_columns = [column.name for column in model.__table__.columns if column.name not in ('id', 'user_id')]
+    staging_columns = ['id', 'user_id'] + data_columns + ['username']
+    target_columns = (['id'] if keep_ids else []) + ['user_id'] + data_columns
+
+    connection = engine.raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            # Same column types as the table; dropped at commit
+            cursor.execute(
+                f"CREATE TEMP TABLE import_staging ON COMMIT DROP AS "
+                f"SELECT {', '.join(staging_columns[:-1])}, NULL::varchar(255) AS username "
+                f"FROM {table} WITH NO DATA"
+            )
+            stream = CopyStream(rows, staging_columns)
+            cursor.copy_expert(
+                f"COPY import_staging ({', '.join(staging_columns)}) FROM STDIN", stream, size=COPY_CHUNK_BYTES
+            )
+            cursor.execute(
+                "INSERT INTO users (username, health) SELECT DISTINCT username, 20 FROM import_staging "
+                "WHERE username IS NOT NULL ON CONFLICT (username) DO NOTHING"
+            )
+            selected = ', '.join((['s.id'] if keep_ids else []) + ['u.id'] + [f's.{name}' for name in data_columns])
+            insert_sql = (
+                f"INSERT INTO {table} ({', '.join(target_columns)}) "
+                f"SELECT {selected} FROM import_staging s JOIN users u ON u.username = s.username"
+                # (id, timestamp) is the primary key of the partitioned tables
+                + (' ON CONFLICT (id, "timestamp") DO NOTHING' if keep_ids else "")
+            )
+            if table == 'food_logs':
+                # Roll up exactly the rows inserted (not skipped ids), in the same statement
+                cursor.execute(
+                    f'WITH inserted AS ({insert_sql} RETURNING user_id, category, health_score, "timestamp"), '
+                    f"{nutrition_stats.IMPORT_INCREMENT_CTES} SELECT count(*) FROM inserted"
+                )
+                inserted = cursor.fetchone()[0]
+            else:
+                cursor.execute(insert_sql)
+                inserted = cursor.rowcount
+            if keep_ids:
+                # Explicit ids don't advance the sequence; move it past them
+                cursor.execute(
+                    f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                    f"GREATEST((SELECT max(id) FROM {table}), 1))"
+                )
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    return stream.rows, inserted
+
+
+def import_table(table, path, fmt=None, keep_ids=False):
+    """Load a file (or stdin for '-') written by export_table; returns (copied, inserted)"""
+    fmt = detect_format(path, fmt) if path != '-' else (fmt or 'ndjson')
+    if fmt == 'parquet':
+        if path == '-':
+            raise SystemExit("Parquet can't be read from stdin")
+        copied, inserted = import_rows(table, read_parquet(path), keep_ids)
+    else:
+        source = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+        try:
+            rows = read_csv(source) if fmt == 'csv' else read_ndjson(source)
+            copied, inserted = import_rows(table, rows, keep_ids)
+        finally:
+            if source is not sys.stdin:
+                source.close()
+    return copied, inserted
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stream conversations / food_logs to and from NDJSON, CSV or Parquet')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = commands.add_parser('export', help='stream a table to a file')
+    export_parser.add_argument('table', choices=sorted(TABLES))
+    export_parser.add_argument('-o', '--output', default='-', help="output file, or '-' for stdout (default)")
+    export_parser.add_argument('--format', choices=FORMATS, help='default: from the file extension (ndjson for stdout)')
+    export_parser.add_argument('--user', action='append', dest='users', help='only this username (repeatable)')
+    export_parser.add_argument('--since', help='rows at or after this ISO time, e.g. 2025-01-01')
+    export_parser.add_argument('--until', help='rows before this ISO time')
+
+    import_parser = commands.add_parser('import', help='load a file written by export')
+    import_parser.add_argument('table', choices=sorted(TABLES))
+    import_parser.add_argument('input', help="input file, or '-' for stdin")
+    import_parser.add_argument('--format', choices=FORMATS, help='default: from the file extension (ndjson for stdin)')
+    import_parser.add_argument('--keep-ids', action='store_true',
+                               help='keep exported ids (rows whose id already exists are skipped)')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    if args.command == 'export':
+        count = export_table(args.table, args.output, args.format, args.users,
+                             parse_time(args.since), parse_time(args.until))
+        print(f"[DEBUG] Exported {count} {args.table} rows in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+    else:
+        init_db()
+        copied, inserted = import_table(args.table, args.input, args.format, args.keep_ids)
+        print(f"[DEBUG] Imported {inserted} of {copied} {args.table} rows in {time.perf_counter() - started:.1f}s",
+              file=sys.stderr)
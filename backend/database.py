@@ -2,10 +2,16 @@
 PostgreSQL Database Connection and Models for Flask
 """
 
-from sqlalchemy import text, create_engine, Column, Integer, String, Text, Float, DateTime, ForeignKey, JSON
+from sqlalchemy import text, create_engine, event, Index, UniqueConstraint, Column, Integer, BigInteger, String, Text, Float, Date, DateTime, ForeignKey, JSON
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.orm import declarative_base, sessionmaker, relationship
+from sqlalchemy.pool import QueuePool
+from contextlib import contextmanager
 from datetime import datetime
 import os
+import threading
+import time
+from metrics import observe_stage
 
 # Get DATABASE_URL from environment variable (required)
 DATABASE_URL = os.environ.get('DATABASE_URL')
@@ -13,12 +19,53 @@ DATABASE_URL = os.environ.get('DATABASE_URL')
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL environment variable is required. Please set it in your .env file.")
 
+# Connection pool settings (per process - with gunicorn the total is workers x (size + overflow))
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))  # seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))  # reconnect connections older than this
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', '1') == '1'
+
+class MeteredQueuePool(QueuePool):
+    """QueuePool that counts checkout timeouts (the pool has no event for them)"""
+
+    def _do_get(self):
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            # Every checkout comes through here: session_scope, request sessions, engine.connect()
+            pool_metrics.count('timeouts')
+            raise
+
+
 # Create engine
-engine = create_engine(DATABASE_URL, echo=False)
+engine = create_engine(
+    DATABASE_URL,
+    echo=False,
+    poolclass=MeteredQueuePool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=DB_POOL_PRE_PING
+)
 
 # Create session factory
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Commit latency (flush + COMMIT round trip) for every session
+@event.listens_for(SessionLocal, 'before_commit')
+def _commit_started(session):
+    session.info['commit_started'] = time.perf_counter()
+
+
+@event.listens_for(SessionLocal, 'after_commit')
+def _commit_finished(session):
+    started = session.info.pop('commit_started', None)
+    if started is not None:
+        observe_stage('db_commit', time.perf_counter() - started)
+
+
 # Base class for models
 Base = declarative_base()
 
@@ -43,32 +90,50 @@ class Conversation(Base):
     """Chat conversation history"""
     __tablename__ = 'conversations'
     
-    id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey('users.id'), index=True)
+    # Range-partitioned by month on timestamp (partitions.py), so the partition key
+    # is part of the primary key; ids still come from one sequence
+    id = Column(Integer, primary_key=True, autoincrement=True, index=True)
+    user_id = Column(Integer, ForeignKey('users.id'))
     user_message = Column(Text)
     bot_response = Column(Text)
     conversation_state = Column(String(50))
-    timestamp = Column(DateTime, default=datetime.utcnow, index=True)
+    timestamp = Column(DateTime, primary_key=True, default=datetime.utcnow, index=True)
     
     # Relationship
     user = relationship('User', back_populates='conversations')
+    
+    # RAG history lookup (user + states, newest first) and keyset-paginated history;
+    # kept in sync with migrations.py
+    __table_args__ = (
+        Index('ix_conversations_user_state_timestamp', user_id, conversation_state, timestamp.desc()),
+        Index('ix_conversations_user_timestamp_id', user_id, timestamp.desc(), id.desc()),
+        {'postgresql_partition_by': 'RANGE ("timestamp")'},
+    )
 
 
 class FoodLog(Base):
     """Food consumption log"""
     __tablename__ = 'food_logs'
     
-    id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey('users.id'), index=True)
+    # Partitioned by month like Conversation
+    id = Column(Integer, primary_key=True, autoincrement=True, index=True)
+    user_id = Column(Integer, ForeignKey('users.id'))
     food_name = Column(String(255), index=True)
     category = Column(String(100))
     health_score = Column(Integer)
     confidence = Column(Float)
     image_path = Column(String(500), nullable=True)
-    timestamp = Column(DateTime, default=datetime.utcnow, index=True)
+    timestamp = Column(DateTime, primary_key=True, default=datetime.utcnow, index=True)
     
     # Relationship
     user = relationship('User', back_populates='food_logs')
+    
+    # Last-food / recent-foods lookups and keyset pagination (user, newest first, id as
+    # tie-breaker); kept in sync with migrations.py
+    __table_args__ = (
+        Index('ix_food_logs_user_timestamp_id', user_id, timestamp.desc(), id.desc()),
+        {'postgresql_partition_by': 'RANGE ("timestamp")'},
+    )
 
 
 class PlaidAccount(Base):
@@ -88,29 +153,195 @@ class PlaidAccount(Base):
     # Relationship
     user = relationship('User', back_populates='plaid_accounts')
 
+
+class ConversationSummary(Base):
+    """Rolling summary of a user's older turns of one conversation type (RAG context)"""
+    __tablename__ = 'conversation_summaries'
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'))
+    conversation_type = Column(String(50))  # 'food', 'financial', 'general'
+    summary = Column(Text)
+    last_conversation_id = Column(Integer)  # newest Conversation folded into the summary
+    last_conversation_at = Column(DateTime)  # its timestamp; bounds the next update's scan
+    updated_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        UniqueConstraint('user_id', 'conversation_type', name='uq_conversation_summaries_user_type'),
+    )
+
+
+class ClassificationCacheEntry(Base):
+    """Persistent food classification result keyed by image hashes"""
+    __tablename__ = 'classification_cache'
+    
+    id = Column(Integer, primary_key=True, index=True)
+    content_hash = Column(String(64), unique=True, index=True)  # SHA-256 of the upload
+    phash = Column(BigInteger, index=True)  # 64-bit dHash (stored signed)
+    food_name = Column(String(255))
+    confidence = Column(Float)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class UserStats(Base):
+    """Running food totals per user, updated in the same transaction as each FoodLog"""
+    __tablename__ = 'user_stats'
+    
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    food_count = Column(Integer, default=0)
+    health_score_sum = Column(Integer, default=0)
+    healthy_count = Column(Integer, default=0)  # fruits/vegetables scoring 4+
+    first_food_at = Column(DateTime, nullable=True)
+    last_food_at = Column(DateTime, nullable=True)
+
+
+class UserCategoryStats(Base):
+    """Running food totals per user and category"""
+    __tablename__ = 'user_category_stats'
+    
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    category = Column(String(100), primary_key=True)
+    food_count = Column(Integer, default=0)
+    health_score_sum = Column(Integer, default=0)
+
+
+class UserDailyStats(Base):
+    """Food totals per user and UTC day"""
+    __tablename__ = 'user_daily_stats'
+    
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    day = Column(Date, primary_key=True)
+    food_count = Column(Integer, default=0)
+    health_score_sum = Column(Integer, default=0)
+    healthy_count = Column(Integer, default=0)
+
+
+class UserGreeting(Base):
+    """Materialized chat greeting for a returning user (see greeting_materializer.py)"""
+    __tablename__ = 'user_greetings'
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), unique=True)
+    greeting = Column(Text, nullable=True)
+    version = Column(Integer, default=0)  # requested_version the greeting was generated from
+    requested_version = Column(Integer, default=0)  # bumped by every food log
+    generated_at = Column(DateTime, nullable=True)
+    generation_ms = Column(Float, nullable=True)
+
+
+class Esp32Device(Base):
+    """A user's ESP32 display, sent emotion updates by esp32_manager"""
+    __tablename__ = 'esp32_devices'
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), unique=True)
+    ip = Column(String(64))
+    port = Column(Integer, default=5005)
+    registered_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+# Pool metrics
+
+class PoolMetrics:
+    """Checkout/checkin counters and connection hold times from pool events"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {'connects': 0, 'checkouts': 0, 'checkins': 0, 'invalidations': 0, 'timeouts': 0}
+        self.peak_checked_out = 0
+        self.total_hold = 0.0
+        self.max_hold = 0.0
+
+    def count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        connection_record.info['checkout_time'] = time.perf_counter()
+        with self._lock:
+            self.counters['checkouts'] += 1
+            self.peak_checked_out = max(self.peak_checked_out, engine.pool.checkedout())
+
+    def on_checkin(self, dbapi_connection, connection_record):
+        started = connection_record.info.pop('checkout_time', None)
+        with self._lock:
+            self.counters['checkins'] += 1
+            if started is not None:
+                held = time.perf_counter() - started
+                self.total_hold += held
+                self.max_hold = max(self.max_hold, held)
+
+    def get_stats(self):
+        pool = engine.pool
+        with self._lock:
+            stats = dict(self.counters)
+            stats['peak_checked_out'] = self.peak_checked_out
+            stats['avg_hold_ms'] = (self.total_hold / stats['checkins'] * 1000) if stats['checkins'] else 0.0
+            stats['max_hold_ms'] = self.max_hold * 1000
+        stats['checked_out'] = pool.checkedout()
+        stats['checked_in'] = pool.checkedin()
+        stats['overflow'] = pool.overflow()
+        stats['pool_size'] = pool.size()
+        stats['max_overflow'] = DB_MAX_OVERFLOW
+        stats['pid'] = os.getpid()
+        return stats
+
+
+pool_metrics = PoolMetrics()
+event.listen(engine, 'connect', lambda dbapi_connection, connection_record: pool_metrics.count('connects'))
+event.listen(engine, 'checkout', pool_metrics.on_checkout)
+event.listen(engine, 'checkin', pool_metrics.on_checkin)
+event.listen(engine, 'invalidate', lambda dbapi_connection, connection_record, exception: pool_metrics.count('invalidations'))
+
+
+def get_pool_stats():
+    """Connection pool usage for this process"""
+    return pool_metrics.get_stats()
+
+
 # Utility functions
 
-def init_db():
-    """Create all tables"""
+MIGRATE_ON_STARTUP = os.environ.get('MIGRATE_ON_STARTUP', '1') == '1'
+
+
+def init_db(run_migrations=MIGRATE_ON_STARTUP):
+    """Create missing tables, apply pending schema migrations, then create this month's partitions and the next few"""
+    from partitions import ensure_partitions
+
     Base.metadata.create_all(bind=engine)
     print("[DEBUG] Database tables created")
+    if run_migrations:
+        from migrations import migrate
+        migrate()
+    ensure_partitions()
 
 
-def get_db():
-    """Dependency for getting DB session"""
+@contextmanager
+def session_scope():
+    """
+    Session that is always returned to the pool.
+    
+    Rolls back on an exception; callers commit explicitly.
+    """
     db = SessionLocal()
     try:
         yield db
+    except Exception:
+        db.rollback()
+        raise
     finally:
         db.close()
 
 
+def get_db():
+    """Dependency for getting DB session (generator form of session_scope)"""
+    with session_scope() as db:
+        yield db
+
+
 def test_connection():
     """Test database connection"""
     try:
-        db = SessionLocal()
-        db.execute(text('SELECT 1'))
-        db.close()
+        with session_scope() as db:
+            db.execute(text('SELECT 1'))
         print("[DEBUG] Connected to PostgreSQL successfully")
         return True
     except Exception as e:
@@ -0,0 +1,426 @@
+"""
+Server-side ESP32 device manager.
+
+Each user can register one ESP32 (ip, port). The pet's emotion is a function
+of the user's health, so the server sends it itself instead of every browser
+tab POSTing it every few seconds:
+
+- Health changes that flip the emotion send the transition code at once and
+  the final code ESP32_TRANSITION_SECONDS later. Anything else sends nothing.
+- Registering plays the transition from neutral into the current emotion,
+  and flash() shows another emotion for a few seconds (e.g. happy after a
+  healthy meal while still sad) before going back.
+- One scheduler thread per process re-sends every device's current emotion
+  every ESP32_HEARTBEAT_INTERVAL seconds, since UDP packets can be lost.
+- All packets go out through one long-lived, non-blocking UDP socket.
+
+Registrations are stored in `esp32_devices`. With several gunicorn workers
+only the one holding a Postgres advisory lock sends heartbeats; it reloads the
+registry from the table on each tick. Without a database (manager created
+with use_database=False, as in the self-test below) the in-memory registry is
+the only copy.
+
+    python esp32_manager.py     # exercise it against a local UDP listener
+"""
+
+import heapq
+import itertools
+import os
+import socket
+import threading
+import time
+
+ESP32_HEARTBEAT_INTERVAL = float(os.environ.get('ESP32_HEARTBEAT_INTERVAL', 5))
+ESP32_TRANSITION_SECONDS = float(os.environ.get('ESP32_TRANSITION_SECONDS', 1.5))
+ESP32_ENABLED = os.environ.get('ESP32_ENABLED', '1') == '1'
+# How long a healthy meal shows happy while health is still in the sad range
+ESP32_FLASH_SECONDS = float(os.environ.get('ESP32_FLASH_SECONDS', 3))
+
+# Arbitrary constant key for the heartbeat leader's pg_advisory_lock
+HEARTBEAT_LOCK_ID = 428392
+
+# Emotion codes understood by the firmware (see frontend/script.js ESP32_EMOTIONS)
+SAD = 0
+SAD_NEUTRAL_TRANSITION = 1
+NEUTRAL = 2
+HAPPY_NEUTRAL_TRANSITION = 3
+HAPPY = 4
+
+
+def emotion_for_health(health):
+    """Resting emotion for a health value (same threshold as the frontend GIFs)"""
+    return SAD if health <= 10 else HAPPY
+
+
+def transition_for(old_emotion, new_emotion):
+    """Transition animation code played on the way to `new_emotion`, or None"""
+    if old_emotion == new_emotion:
+        return None
+    return HAPPY_NEUTRAL_TRANSITION if new_emotion == HAPPY else SAD_NEUTRAL_TRANSITION
+
+
+class _Device:
+    __slots__ = ('address', 'emotion', 'settles_at', 'generation')
+
+    def __init__(self, address, emotion):
+        self.address = address  # (ip, port)
+        self.emotion = emotion  # resting emotion; None until known
+        self.settles_at = 0.0  # heartbeats wait until a transition animation (or flash) has finished
+        self.generation = 0  # bumped by every change; scheduled packets of older ones are skipped
+
+
+class DeviceManager:
+    """Registry of per-user ESP32 devices, change-only sends and a heartbeat scheduler"""
+
+    def __init__(self, interval=ESP32_HEARTBEAT_INTERVAL, transition_seconds=ESP32_TRANSITION_SECONDS,
+                 enabled=ESP32_ENABLED, use_database=True):
+        self.interval = interval
+        self.transition_seconds = transition_seconds
+        self.enabled = enabled
+        self.use_database = use_database
+
+        self._devices = {}  # user_id -> _Device
+        self._last_sent = {}  # (ip, port) -> (code, time) for the legacy per-packet endpoint
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._schedule = []  # heap of (due, seq, user_id, code, address, generation); code None = heartbeat tick
+        self._sequence = itertools.count()
+
+        self._socket = None
+        self._thread = None
+        self._pid = None
+        self._leader_connection = None
+        self._leader = False
+        self._counters = {'sent': 0, 'changes': 0, 'heartbeats': 0, 'deduplicated': 0,
+                          'send_errors': 0, 'registrations': 0, 'heartbeat_ticks': 0}
+
+    def _count(self, name, amount=1):
+        self._counters[name] += amount
+
+    # Process-local resources (re-created after fork)
+
+    def _sock(self):
+        if self._socket is None or self._pid != os.getpid():
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            # A full send buffer drops the packet instead of stalling a request thread
+            sock.setblocking(False)
+            self._socket = sock
+        return self._socket
+
+    def start(self):
+        """Start this process's scheduler thread (idempotent, safe after fork)"""
+        if not self.enabled or (self._thread is not None and self._pid == os.getpid()):
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._socket = None
+            self._leader_connection = None
+            self._leader = False
+            self._schedule = [(time.monotonic() + self.interval, next(self._sequence), None, None, None, None)]
+            self._thread = threading.Thread(target=self._run, name='esp32-heartbeat', daemon=True)
+            self._thread.start()
+        print(f"[DEBUG] ESP32 manager started (heartbeat every {self.interval}s)")
+
+    # Sending
+
+    def _send(self, address, code):
+        try:
+            self._sock().sendto(bytes([code]), address)
+        except OSError as e:
+            # Includes BlockingIOError when the socket buffer is full; the next heartbeat repeats it
+            with self._lock:
+                self._count('send_errors')
+            print(f"[ERROR] ESP32 send to {address[0]}:{address[1]} failed: {e}")
+            return False
+        with self._lock:
+            self._count('sent')
+        return True
+
+    def send_code(self, ip, port, code):
+        """
+        Send one code to an address, skipping repeats of the code last sent
+        there within a heartbeat interval. Returns True if a packet went out.
+        """
+        address = (ip, int(port))
+        now = time.monotonic()
+        with self._lock:
+            last = self._last_sent.get(address)
+            if last is not None and last[0] == code and now - last[1] < self.interval:
+                self._count('deduplicated')
+                return False
+            self._last_sent[address] = (code, now)
+        return self._send(address, code)
+
+    # Registry
+
+    def register(self, user_id, ip, port, health, db=None):
+        """Register (or move) a user's device and play the transition from neutral into its current emotion"""
+        if not self.enabled:
+            return
+        self.start()
+        address = (ip, int(port))
+        emotion = emotion_for_health(health)
+        if db is not None and self.use_database:
+            self._store(db, user_id, address)
+        with self._lock:
+            device = self._devices.get(user_id)
+            unchanged = device is not None and device.address == address and device.emotion == emotion
+            self._count('registrations')
+            if unchanged:
+                self._count('deduplicated')
+                return
+            previous, device = device, _Device(address, emotion)
+            if previous is not None:
+                device.generation = previous.generation + 1
+            self._devices[user_id] = device
+            device.settles_at = time.monotonic() + self.transition_seconds
+            self._push(device.settles_at, user_id, emotion, address, device.generation)
+        self._send(address, transition_for(NEUTRAL, emotion))
+
+    def unregister(self, user_id, db=None):
+        with self._lock:
+            self._devices.pop(user_id, None)
+        if db is not None and self.use_database:
+            from database import Esp32Device
+            db.query(Esp32Device).filter(Esp32Device.user_id == user_id).delete()
+            db.commit()
+
+    def _store(self, db, user_id, address):
+        from database import Esp32Device
+
+        device = db.query(Esp32Device).filter(Esp32Device.user_id == user_id).first()
+        if device is None:
+            device = Esp32Device(user_id=user_id)
+            db.add(device)
+        device.ip, device.port = address
+        db.commit()
+
+    def _address(self, user_id, db):
+        with self._lock:
+            device = self._devices.get(user_id)
+            if device is not None:
+                return device.address
+        if db is None or not self.use_database:
+            return None
+        from database import Esp32Device
+
+        row = db.query(Esp32Device.ip, Esp32Device.port).filter(Esp32Device.user_id == user_id).first()
+        return (row.ip, row.port) if row else None
+
+    # Change-only updates
+
+    def health_changed(self, user_id, old_health, new_health, db=None):
+        """
+        Send the emotion transition for a health update, if the emotion changed.
+
+        Returns True if packets were sent or scheduled. Call after the health
+        update is committed; the device address is looked up through `db`
+        when this process hasn't seen the registration.
+        """
+        if not self.enabled:
+            return False
+        old_emotion, new_emotion = emotion_for_health(old_health), emotion_for_health(new_health)
+        if old_emotion == new_emotion:
+            with self._lock:
+                self._count('deduplicated')
+            return False
+        address = self._address(user_id, db)
+        if address is None:
+            return False
+        self.start()
+
+        transition = transition_for(old_emotion, new_emotion)
+        settles_at = time.monotonic() + self.transition_seconds
+        with self._lock:
+            device = self._devices.get(user_id)
+            if device is None:
+                device = self._devices[user_id] = _Device(address, new_emotion)
+            device.emotion = new_emotion
+            device.settles_at = settles_at
+            device.generation += 1
+            self._count('changes')
+            self._push(settles_at, user_id, new_emotion, address, device.generation)
+        self._send(address, transition)
+        print(f"[DEBUG] ESP32 emotion for user {user_id}: {old_emotion} -> {new_emotion}")
+        return True
+
+    def flash(self, user_id, emotion, seconds, db=None):
+        """
+        Show `emotion` for `seconds`, then return to the resting emotion - both
+        with their transition animations. No-op if the device already rests in
+        `emotion`; a later health change or flash cuts it short.
+        """
+        if not self.enabled:
+            return False
+        address = self._address(user_id, db)
+        if address is None:
+            return False
+        self.start()
+        now = time.monotonic()
+        with self._lock:
+            device = self._devices.get(user_id)
+            if device is None or device.emotion is None:
+                return False
+            resting = device.emotion
+            if resting == emotion:
+                return False
+            device.generation += 1
+            shown_at = now + self.transition_seconds
+            leaves_at = shown_at + seconds
+            device.settles_at = leaves_at + self.transition_seconds
+            self._push(shown_at, user_id, emotion, address, device.generation)
+            self._push(leaves_at, user_id, transition_for(emotion, resting), address, device.generation)
+            self._push(device.settles_at, user_id, resting, address, device.generation)
+            self._count('changes')
+        self._send(address, transition_for(resting, emotion))
+        print(f"[DEBUG] ESP32 flash for user {user_id}: {emotion} for {seconds}s")
+        return True
+
+    # Scheduler
+
+    def _push(self, due, user_id, code, address, generation=None):
+        # Caller holds self._lock
+        heapq.heappush(self._schedule, (due, next(self._sequence), user_id, code, address, generation))
+        self._wakeup.notify()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while True:
+                    wait = self._schedule[0][0] - time.monotonic() if self._schedule else None
+                    if wait is not None and wait <= 0:
+                        break
+                    self._wakeup.wait(wait)
+                _, _, user_id, code, address, generation = heapq.heappop(self._schedule)
+                if code is None:
+                    self._push(time.monotonic() + self.interval, None, None, None)
+            try:
+                if code is None:
+                    self._heartbeat()
+                else:
+                    # Rest of a transition or flash; skip it if a newer change superseded it
+                    with self._lock:
+                        device = self._devices.get(user_id)
+                        current = device is not None and device.generation == generation
+                    if current:
+                        self._send(address, code)
+            except Exception as e:
+                print(f"[ERROR] ESP32 scheduler task failed: {e}")
+
+    def _heartbeat(self):
+        if self.use_database:
+            if not self._is_leader():
+                return
+            self._reload()
+        now = time.monotonic()
+        with self._lock:
+            self._count('heartbeat_ticks')
+            due = [(device.address, device.emotion) for device in self._devices.values()
+                   if device.emotion is not None and device.settles_at <= now]
+        for address, emotion in due:
+            if self._send(address, emotion):
+                with self._lock:
+                    self._count('heartbeats')
+
+    def _reload(self):
+        """Replace the registry with esp32_devices joined to current health"""
+        from database import Esp32Device, User, session_scope
+
+        with session_scope() as db:
+            rows = db.query(Esp32Device.user_id, Esp32Device.ip, Esp32Device.port, User.health).join(
+                User, User.id == Esp32Device.user_id
+            ).all()
+        with self._lock:
+            devices = {}
+            for user_id, ip, port, health in rows:
+                device = _Device((ip, port), emotion_for_health(health))
+                previous = self._devices.get(user_id)
+                if previous is not None:
+                    device.settles_at = previous.settles_at
+                    device.generation = previous.generation
+                devices[user_id] = device
+            self._devices = devices
+
+    def _is_leader(self):
+        """Hold (or try to take) the heartbeat advisory lock on a dedicated connection"""
+        from database import engine
+
+        if engine.dialect.name != 'postgresql':
+            return True
+        try:
+            if self._leader_connection is None:
+                from sqlalchemy import create_engine
+                from sqlalchemy.pool import NullPool
+
+                # Own unpooled connection: the lock lives exactly as long as it stays open
+                connection = create_engine(engine.url, poolclass=NullPool).raw_connection()
+                connection.dbapi_connection.autocommit = True
+                self._leader_connection = connection
+            with self._leader_connection.cursor() as cursor:
+                # Re-entrant for the holder, so this doubles as the leader's liveness check
+                cursor.execute('SELECT pg_try_advisory_lock(%s)', (HEARTBEAT_LOCK_ID,))
+                acquired = cursor.fetchone()[0]
+                if acquired and self._leader:
+                    # Undo the extra lock level so the lock count stays at one
+                    cursor.execute('SELECT pg_advisory_unlock(%s)', (HEARTBEAT_LOCK_ID,))
+            if acquired and not self._leader:
+                print(f"[DEBUG] ESP32 heartbeat leader is pid {os.getpid()}")
+            self._leader = acquired
+            return acquired
+        except Exception as e:
+            print(f"[ERROR] ESP32 heartbeat leader check failed: {e}")
+            self._leader = False
+            connection, self._leader_connection = self._leader_connection, None
+            try:
+                connection.close()
+            except Exception:
+                pass
+            return False
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['devices'] = len(self._devices)
+            stats['scheduled'] = len(self._schedule)
+        stats['heartbeat_interval'] = self.interval
+        stats['leader'] = self._leader or not self.use_database
+        return stats
+
+
+device_manager = DeviceManager()
+
+
+if __name__ == '__main__':
+    # Stand-in ESP32: a local UDP listener recording every byte it receives
+    received = []
+    listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    listener.bind(('127.0.0.1', 0))
+    port = listener.getsockname()[1]
+
+    def listen():
+        while True:
+            data, _ = listener.recvfrom(16)
+            received.append((round(time.monotonic() - t0, 2), data[0]))
+
+    t0 = time.monotonic()
+    threading.Thread(target=listen, daemon=True).start()
+    manager = DeviceManager(interval=0.5, transition_seconds=0.2, use_database=False)
+
+    manager.register(1, '127.0.0.1', port, health=20)  # neutral -> happy
+    time.sleep(0.3)
+    manager.health_changed(1, 20, 15)  # still happy: nothing sent
+    manager.health_changed(1, 15, 8)  # sad: transition, then final
+    manager.health_changed(1, 8, 5)  # still sad: nothing sent
+    time.sleep(1.3)  # a couple of heartbeats
+    manager.send_code('127.0.0.1', port, SAD)
+    manager.send_code('127.0.0.1', port, SAD)  # repeat within the interval: dropped
+    time.sleep(0.1)
+
+    print(f"Listener on 127.0.0.1:{port} received (seconds, code): {received}")
+    print(f"Stats: {manager.get_stats()}")
+    codes = [code for _, code in received]
+    assert codes[:4] == [HAPPY_NEUTRAL_TRANSITION, HAPPY, SAD_NEUTRAL_TRANSITION, SAD], codes
+    assert codes.count(SAD) >= 3 and HAPPY not in codes[2:], codes
+    print("OK")
@@ -0,0 +1,165 @@
+"""
+Local fake Gemini server for tests and load tests.
+
+Speaks just enough of the Generative Language REST API (v1beta generateContent
+and streamGenerateContent) for the google-generativeai SDK with transport=rest.
+Replies are deterministic for a given prompt. Latency, streaming chunk delay and
+a transient failure rate are configurable; --seed makes the jitter and the
+injected failures repeat exactly from run to run.
+
+    python fake_gemini.py --port 8089 --latency-ms 300
+    GEMINI_API_ENDPOINT=http://localhost:8089 GEMINI_TRANSPORT=rest GEMINI_API_KEY=fake python app.py
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPLIES = [
+    "Squeak! That sounds great, tell me more :3",
+    "Ooh, I love hearing about your day ^_^",
+    "Yum! My whiskers are twitching with curiosity :)",
+    "You're doing great, keep it up! :3",
+    "Hmm, a little balance goes a long way ^_^",
+]
+
+FOODS = ['banana', 'apple', 'broccoli', 'pizza', 'cheeseburger', 'ice cream']
+
+
+class FakeGeminiConfig:
+    latency_ms = 200.0
+    jitter_ms = 50.0
+    chunk_delay_ms = 30.0
+    failure_rate = 0.0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rng = random.Random()
+        self.requests = 0
+        self.failures = 0
+
+    def seed(self, seed):
+        with self.lock:
+            self.rng.seed(seed)
+
+
+config = FakeGeminiConfig()
+
+
+def _prompt_text(body):
+    parts = []
+    has_image = False
+    for content in body.get('contents', []):
+        for part in content.get('parts', []):
+            if 'text' in part:
+                parts.append(part['text'])
+            if 'inlineData' in part or 'inline_data' in part:
+                has_image = True
+    return ' '.join(parts), has_image
+
+
+def fake_reply(prompt, has_image):
+    """Deterministic reply for a prompt; food names for vision requests"""
+    digest = int(hashlib.sha256(prompt.encode()).hexdigest(), 16)
+    if has_image:
+        return FOODS[digest % len(FOODS)]
+    return REPLIES[digest % len(REPLIES)]
+
+
+def _candidate(text, finished=True):
+    candidate = {'content': {'parts': [{'text': text}], 'role': 'model'}, 'index': 0}
+    if finished:
+        candidate['finishReason'] = 'STOP'
+    return {'candidates': [candidate]}
+
+
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length) or b'{}')
+        prompt, has_image = _prompt_text(body)
+
+        with config.lock:
+            config.requests += 1
+            fail = config.rng.random() < config.failure_rate
+            if fail:
+                config.failures += 1
+            jitter = config.rng.uniform(-config.jitter_ms, config.jitter_ms)
+
+        delay = max(0.0, config.latency_ms + jitter) / 1000
+        if fail:
+            time.sleep(delay / 4)
+            self._send_json(503, {'error': {'code': 503, 'message': 'fake overload', 'status': 'UNAVAILABLE'}})
+            return
+
+        text = fake_reply(prompt, has_image)
+        path = self.path.split('?')[0]
+
+        if path.endswith(':streamGenerateContent'):
+            # First token after the configured latency, then one chunk per word
+            time.sleep(delay)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            words = text.split(' ')
+            self.wfile.write(b'[')
+            for i, word in enumerate(words):
+                last = i == len(words) - 1
+                chunk = json.dumps(_candidate(word + ('' if last else ' '), finished=last))
+                self.wfile.write((chunk + ('' if last else ',\r\n')).encode())
+                self.wfile.flush()
+                if not last:
+                    time.sleep(config.chunk_delay_ms / 1000)
+            self.wfile.write(b']')
+        elif path.endswith(':generateContent'):
+            time.sleep(delay + config.chunk_delay_ms * len(text.split(' ')) / 1000)
+            self._send_json(200, _candidate(text))
+        else:
+            self._send_json(404, {'error': {'code': 404, 'message': f'unknown path {path}', 'status': 'NOT_FOUND'}})
+
+
+def start_server(port=8089, host='127.0.0.1'):
+    """Start the fake server in a background thread (for use from other scripts)"""
+    server = ThreadingHTTPServer((host, port), FakeGeminiHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='fake-gemini', daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake Gemini REST server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency-ms', type=float, default=config.latency_ms)
+    parser.add_argument('--jitter-ms', type=float, default=config.jitter_ms)
+    parser.add_argument('--chunk-delay-ms', type=float, default=config.chunk_delay_ms)
+    parser.add_argument('--failure-rate', type=float, default=config.failure_rate)
+    parser.add_argument('--seed', type=int, help='seed for latency jitter and injected failures')
+    args = parser.parse_args()
+
+    config.latency_ms = args.latency_ms
+    config.jitter_ms = args.jitter_ms
+    config.chunk_delay_ms = args.chunk_delay_ms
+    config.failure_rate = args.failure_rate
+    if args.seed is not None:
+        config.seed(args.seed)
+
+    server = ThreadingHTTPServer((args.host, args.port), FakeGeminiHandler)
+    server.daemon_threads = True
+    print(f"[DEBUG] Fake Gemini listening on http://{args.host}:{args.port} (latency {args.latency_ms}ms)")
+    server.serve_forever()
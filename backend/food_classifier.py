@@ -1,35 +1,42 @@
 import torch
 import torchvision.transforms as transforms
-import torchvision.models as models
-from torchvision.models import ResNet50_Weights
 from PIL import Image
 import io
-import urllib.request
 import json
 import os
-import google.generativeai as genai
+import threading
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from inference_batcher import InferenceBatcher
+from classification_cache import ClassificationCache, content_hash, dhash
+from llm_client import llm
+from metrics import registry, time_stage, observe_stage, classifications, fallbacks
+from image_ingest import read_upload, ingest
+from inference_backends import build_model, backend_device, configure_threads, INFERENCE_BACKEND, INFERENCE_CHANNELS_LAST
 
-# Load pre-trained ResNet50 model
-device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-model = models.resnet50(weights=None)
-weights_path = os.path.join(os.path.dirname(__file__), 'trained_weights')
-model.load_state_dict(torch.load(weights_path, map_location=device))
-model = model.to(device)
-model.eval()
+# ResNet answers below this confidence go to the Gemini vision fallback
+CONFIDENCE_THRESHOLD = 0.6
 
-# Configure Gemini API
-GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
-if GEMINI_API_KEY: genai.configure(api_key=GEMINI_API_KEY)
+# Gemini vision fallback: a downscaled JPEG copy instead of the full image, optionally
+# started in parallel with local inference (VISION_HEDGE=1, one vision call per uncached
+# upload), and never waited on longer than VISION_DEADLINE seconds past decode
+VISION_MAX_SIDE = int(os.environ.get('VISION_MAX_SIDE', 512))
+VISION_JPEG_QUALITY = int(os.environ.get('VISION_JPEG_QUALITY', 85))
+VISION_HEDGE = os.environ.get('VISION_HEDGE', '0') == '1'
+VISION_DEADLINE = float(os.environ.get('VISION_DEADLINE', 5.0))
 
-# Load ImageNet class labels
-try:
-    imagenet_labels_url = "https://raw.githubusercontent.com/anishathalye/imagenet-simple-labels/master/imagenet-simple-labels.json"
-    with urllib.request.urlopen(imagenet_labels_url) as url:
-        imagenet_labels = json.loads(url.read().decode())
-    print(f"[DEBUG] Loaded {len(imagenet_labels)} ImageNet labels")
-except Exception as e:
-    print(f"[DEBUG] Warning: Could not load ImageNet labels: {e}")
-    imagenet_labels = []
+VISION_PROMPT = """Identify the main food item in this image. Respond with ONLY the specific food name in lowercase (e.g., 'banana', 'pizza', 'broccoli'). 
+        If multiple foods are present, identify the most prominent one. 
+        If no food is visible, respond with 'unknown'."""
+
+vision_payload_bytes = registry.histogram(
+    'gachirat_vision_payload_bytes', 'Bytes of image data sent per Gemini vision fallback call',
+    buckets=(8 * 1024, 16 * 1024, 32 * 1024, 64 * 1024, 128 * 1024, 256 * 1024, 1024 * 1024)
+)
+vision_fallback_outcomes = registry.counter(
+    'gachirat_vision_fallback_total', 'Gemini vision fallback calls by outcome (used, cancelled, unused, deadline, failed)',
+    labels=('outcome',)
+)
 
 # Image preprocessing
 preprocess = transforms.Compose([
@@ -39,6 +46,108 @@ preprocess = transforms.Compose([
     transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
 ])
 
+# ResNet50 model - loaded lazily (or by the background warm-up) instead of at import
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+device = backend_device(INFERENCE_BACKEND, device)
+weights_path = os.path.join(os.path.dirname(__file__), 'trained_weights')
+model = None
+model_error = None
+_model_lock = threading.Lock()
+_warmup_thread = None
+_warmed_pid = None  # process that has run the warm-up forward pass (forked workers run their own)
+
+def load_model():
+    """
+    Load trained_weights and build the configured inference backend.
+
+    Weights are mmap-loaded and assigned straight into the module. Only the
+    eager backend with INFERENCE_CHANNELS_LAST off (its default) keeps the
+    parameters backed by the file's page cache, shared by every process that
+    loads it. Channels-last, quantized and traced backends allocate their own
+    tensors; workers share those only when the master built the model before
+    forking (MODEL_PRELOAD=1, as gunicorn.conf.py sets), otherwise each worker
+    holds a private copy.
+    """
+    configure_threads()
+    started = time.perf_counter()
+    trained_weights = torch.load(weights_path, map_location='cpu', mmap=True)
+    loaded_model = build_model(trained_weights, INFERENCE_BACKEND, device, preprocess=preprocess)
+    print(f"[DEBUG] Model loaded in {time.perf_counter() - started:.2f}s")
+    return loaded_model
+
+def get_model():
+    """Return the loaded model, loading it on first use"""
+    global model, model_error
+    if model is not None:
+        return model
+    with _model_lock:
+        if model is None:
+            try:
+                model = load_model()
+                model_error = None
+            except Exception as e:
+                model_error = str(e)
+                raise
+    return model
+
+def _warmup():
+    global _warmed_pid
+    try:
+        warm_model = get_model()
+        # One dummy forward pass so tracing/compilation costs are paid before traffic
+        with torch.no_grad():
+            dummy = torch.zeros(1, 3, 224, 224, device=device)
+            if INFERENCE_CHANNELS_LAST:
+                dummy = dummy.contiguous(memory_format=torch.channels_last)
+            warm_model(dummy)
+        _warmed_pid = os.getpid()
+        print("[DEBUG] Model warm-up complete")
+    except Exception as e:
+        print(f"[ERROR] Model warm-up failed: {e}")
+
+def start_warmup(background=True):
+    """Load (if needed) and warm the model in this process, in a background thread unless told otherwise"""
+    global _warmup_thread
+    if _warmed_pid == os.getpid():
+        return
+    if not background:
+        _warmup()
+        return
+    if _warmup_thread is None or not _warmup_thread.is_alive():
+        _warmup_thread = threading.Thread(target=_warmup, name='model-warmup', daemon=True)
+        _warmup_thread.start()
+
+def is_ready():
+    return model is not None
+
+def model_status():
+    """Readiness info for the health endpoint"""
+    if model is not None:
+        state = 'ready'
+    elif model_error:
+        state = 'error'
+    elif _warmup_thread is not None and _warmup_thread.is_alive():
+        state = 'loading'
+    else:
+        state = 'not_loaded'
+    return {
+        'state': state,
+        'backend': INFERENCE_BACKEND,
+        'device': str(device),
+        'labels': len(imagenet_labels),
+        'error': model_error,
+    }
+
+# Load ImageNet class labels (bundled locally, no network needed)
+labels_path = os.path.join(os.path.dirname(__file__), 'imagenet_labels.json')
+try:
+    with open(labels_path, encoding='utf-8') as f:
+        imagenet_labels = json.load(f)
+    print(f"[DEBUG] Loaded {len(imagenet_labels)} ImageNet labels")
+except Exception as e:
+    print(f"[DEBUG] Warning: Could not load ImageNet labels: {e}")
+    imagenet_labels = []
+
 # Nutrition mapping (health score: 1=very unhealthy, 5=very healthy)
 NUTRITION_MAP = {
     # Fruits (4-5)
@@ -91,78 +200,170 @@ def get_nutrition_info(food_name):
     # Default
     return NUTRITION_MAP['unknown']
 
-def classify_food_with_gemini(image_bytes):
-    """Fallback classification using Gemini vision model"""
+def predict_batch(input_tensors, top_k=1):
+    """Run a list of preprocessed images through the model as one stacked batch"""
+    input_batch = torch.stack(input_tensors).to(device)
+    if INFERENCE_CHANNELS_LAST:
+        input_batch = input_batch.contiguous(memory_format=torch.channels_last)
+    
+    with torch.no_grad(), time_stage('forward'):
+        output = get_model()(input_batch)
+    
+    probabilities = torch.nn.functional.softmax(output, dim=1)
+    top_probs, top_idxs = torch.topk(probabilities, top_k, dim=1)
+    
+    results = []
+    for probs, idxs in zip(top_probs.tolist(), top_idxs.tolist()):
+        results.append([
+            (imagenet_labels[idx] if imagenet_labels else "unknown food", prob)
+            for prob, idx in zip(probs, idxs)
+        ])
+    return results
+
+# Shared micro-batching worker: concurrent requests share one forward pass
+batcher = InferenceBatcher(predict_batch)
+
+# Results for repeated / near-duplicate uploads
+classification_cache = ClassificationCache()
+
+def vision_payload(image):
+    """Downscaled JPEG copy of a decoded image, as an inline blob for Gemini vision"""
+    if max(image.size) > VISION_MAX_SIDE:
+        scale = VISION_MAX_SIDE / max(image.size)
+        image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.BICUBIC)
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=VISION_JPEG_QUALITY)
+    data = buffer.getvalue()
+    vision_payload_bytes.observe(len(data))
+    return {'mime_type': 'image/jpeg', 'data': data}
+
+def start_gemini_classification(image):
+    """Submit the vision call on the shared LLM loop; returns a future of the raw reply"""
+    return llm.submit([VISION_PROMPT, vision_payload(image)])
+
+def classify_food_with_gemini(image, future=None, timeout=None):
+    """
+    Fallback classification using Gemini vision.
+
+    Waits on `future` (a hedged call started earlier) or starts a new call.
+    Given a `timeout`, raises concurrent.futures.TimeoutError (not the builtin
+    before Python 3.11) - after cancelling the call - if no answer arrives
+    within it, so the caller can use its local answer instead.
+    Any other failure, including the LLM client's own timeouts, returns
+    ("unknown food", 0.0).
+    """
+    print(f"[DEBUG] Using Gemini vision fallback for classification...")
+    started = time.perf_counter()
     try:
-        print(f"[DEBUG] Using Gemini vision fallback for classification...")
-        
-        # Load image from bytes
-        image = Image.open(io.BytesIO(image_bytes))
-        
-        # Use Gemini vision model
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        prompt = """Identify the main food item in this image. Respond with ONLY the specific food name in lowercase (e.g., 'banana', 'pizza', 'broccoli'). 
-        If multiple foods are present, identify the most prominent one. 
-        If no food is visible, respond with 'unknown'."""
-        
-        response = model.generate_content([prompt, image])
-        food_name = response.text.strip().lower()
-        
+        if future is None:
+            future = start_gemini_classification(image)
+        food_name = future.result(timeout=timeout).lower()
+        vision_fallback_outcomes.inc('used')
         print(f"[DEBUG] Gemini classified as: {food_name}")
         return food_name, 0.75  # Assign a reasonable confidence for Gemini results
-        
+    except FutureTimeoutError:
+        if timeout is None:
+            # No caller deadline (the error path): the client gave up after its retries
+            vision_fallback_outcomes.inc('failed')
+            print(f"[ERROR] Gemini vision classification timed out")
+            return "unknown food", 0.0
+        future.cancel()
+        vision_fallback_outcomes.inc('deadline')
+        print(f"[DEBUG] Gemini vision missed the {VISION_DEADLINE}s deadline")
+        raise
     except Exception as e:
+        vision_fallback_outcomes.inc('failed')
         print(f"[ERROR] Gemini vision classification failed: {e}")
         import traceback
         traceback.print_exc()
         return "unknown food", 0.0
+    finally:
+        # Time the request actually waited on the fallback (a hedged call may have started earlier)
+        observe_stage('vision_fallback', time.perf_counter() - started)
 
 def classify_food(image_file):
-    """Classify food image using ResNet50"""
+    """
+    Classify food image using ResNet50.
+
+    Raises image_ingest.ImageRejected for uploads over the size/pixel limits
+    or that aren't images; everything after ingest falls back to Gemini.
+    """
+    print(f"[DEBUG] Starting classification...")
+    
+    # One bounded read; every stage below (hashes, decode, fallback) shares this buffer
+    image_bytes = read_upload(image_file)
+    print(f"[DEBUG] Read {len(image_bytes)} bytes from image file")
+    
+    # Same file uploaded before? Skip decoding and inference entirely
+    image_key = content_hash(image_bytes)
+    cached = classification_cache.get_exact(image_key)
+    if cached:
+        print(f"[DEBUG] Classification cache hit: {cached[0]}")
+        classifications.inc('cache')
+        return cached
+    
+    # Header check against the pixel limit, then a reduced-resolution decode
+    image = ingest(image_bytes).image
+    
+    hedge = None
     try:
-        print(f"[DEBUG] Starting classification...")
-        print(f"[DEBUG] Image file type: {type(image_file)}")
+        # Near-identical shot of something we've already classified?
+        image_phash = dhash(image)
+        cached = classification_cache.get_similar(image_key, image_phash)
+        if cached:
+            classifications.inc('cache')
+            return cached
         
-        # Load and preprocess image
-        image_bytes = image_file.read()
-        print(f"[DEBUG] Read {len(image_bytes)} bytes from image file")
+        # Past this point Gemini may be needed; the deadline bounds how long we wait for it
+        deadline = time.perf_counter() + VISION_DEADLINE
+        if VISION_HEDGE:
+            hedge = start_gemini_classification(image)
         
-        image = Image.open(io.BytesIO(image_bytes)).convert('RGB')
-        print(f"[DEBUG] Image loaded successfully: {image.size}")
+        with time_stage('preprocess'):
+            input_tensor = preprocess(image)
         
-        input_tensor = preprocess(image)
-        input_batch = input_tensor.unsqueeze(0).to(device)
-        
-        # Predict
-        with torch.no_grad():
-            output = model(input_batch)
-        
-        # Get top prediction
-        probabilities = torch.nn.functional.softmax(output[0], dim=0)
-        top_prob, top_idx = torch.topk(probabilities, 1)
-        
-        predicted_label = imagenet_labels[top_idx.item()] if imagenet_labels else "unknown food"
-        confidence = top_prob.item()
+        # Predict (batched together with any concurrent requests)
+        top_predictions = batcher.infer(input_tensor, top_k=1)
+        predicted_label, confidence = top_predictions[0]
         
         print(f"[DEBUG] Classified as: {predicted_label} with confidence: {confidence:.2f}")
         
         # If confidence is too low, use Gemini vision as fallback
-        if confidence < 0.6:
-            print(f"[DEBUG] Confidence {confidence:.2f} < 0.6, trying Gemini vision...")
-            return classify_food_with_gemini(image_bytes)
+        if confidence < CONFIDENCE_THRESHOLD:
+            print(f"[DEBUG] Confidence {confidence:.2f} < {CONFIDENCE_THRESHOLD}, trying Gemini vision...")
+            fallbacks.inc('low_confidence')
+            try:
+                predicted_label, confidence = classify_food_with_gemini(
+                    image, hedge, timeout=max(0.0, deadline - time.perf_counter())
+                )
+            except FutureTimeoutError:
+                # Out of time: answer with the local top-1, uncached so a retry can still reach Gemini
+                classifications.inc('deadline_local')
+                return predicted_label, confidence
+            if confidence == 0.0:
+                # Fallback failed - don't cache the failure
+                classifications.inc('failed')
+                return predicted_label, confidence
+            classifications.inc('gemini_fallback')
+        else:
+            classifications.inc('resnet')
+            if hedge is not None:
+                # Local answer won the race; the call may already have finished, unused
+                vision_fallback_outcomes.inc('cancelled' if hedge.cancel() else 'unused')
         
+        classification_cache.put(image_key, image_phash, predicted_label, confidence)
         return predicted_label, confidence
     except Exception as e:
         print(f"[ERROR] Classification failed: {e}")
         import traceback
         traceback.print_exc()
-        # Try Gemini vision as fallback on error
-        try:
-            image_file.seek(0)
-            image_bytes = image_file.read()
-            return classify_food_with_gemini(image_bytes)
-        except:
-            return "unknown food", 0.0
+        # Try Gemini vision as fallback on error (no local answer, so no deadline)
+        fallbacks.inc('error')
+        if hedge is not None and hedge.cancelled():
+            hedge = None
+        result = classify_food_with_gemini(image, hedge)
+        classifications.inc('gemini_fallback' if result[1] > 0 else 'failed')
+        return result
 
 if __name__ == "__main__":
     pass    
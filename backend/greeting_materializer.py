@@ -0,0 +1,219 @@
+"""
+Precomputed chat greetings for returning users.
+
+The personalized login greeting depends on the user's health and recent
+foods, so it used to be generated during /api/login - three FoodLog rows
+and a 50-word Gemini call before the UI could open. It is now materialized
+off the request path into `user_greetings`:
+
+- Each food log bumps the row's requested_version in the same transaction
+  and queues a regeneration. The background job stamps the greeting with
+  the version it was built from.
+- Chat turns queue a refresh too (at most every GREETING_CHAT_REFRESH
+  seconds per user). They don't change the greeting's inputs, so the stored
+  greeting stays servable meanwhile.
+- Login serves the stored text when version == requested_version. When the
+  greeting is missing or stale, login generates it synchronously, as before,
+  and stores it.
+
+Hits are credited with the time the stored greeting took to generate - the
+latency the login would otherwise have spent.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from sqlalchemy.dialects.postgresql import insert
+
+from metrics import observe_stage
+
+GREETING_MATERIALIZE = os.environ.get('GREETING_MATERIALIZE', '1') == '1'
+GREETING_WORKERS = int(os.environ.get('GREETING_WORKERS', 2))
+GREETING_CHAT_REFRESH = float(os.environ.get('GREETING_CHAT_REFRESH', 600))
+
+
+def build_greeting_prompt(username, health, recent_foods):
+    """Returning-user greeting prompt from health and the last few FoodLogs (newest first)"""
+    context = f"User {username} is returning. Health: {health}/20."
+    if recent_foods:
+        avg_health_score = sum(f.health_score for f in recent_foods) / len(recent_foods)
+        context += f" Recent food health average: {avg_health_score:.1f}/5."
+        food_list = ", ".join([f.food_name for f in recent_foods])
+        context += f" Recent foods: {food_list}."
+
+    return f"""You are Gachirat, a friendly digital pet rat. {context}
+
+Generate a warm welcome message that:
+1. Greets {username} by name
+2. Briefly explains what you can help with (chat, food tracking, health advice)
+3. Personalizes the end based on their recent behavior:
+   - If health is high (11+) and recent foods were healthy (avg 4+): Praise and encourage them
+   - If health is medium (7-10) or mixed foods: Gently motivate balance
+   - If health is low (<7) or unhealthy foods: Motivate change with empathy
+
+Keep it under 50 words, friendly, and use text emoticons like :3 or ^_^. Do NOT use emoji or asterisks for actions."""
+
+
+class GreetingMaterializer:
+    """Keeps each returning user's chat greeting generated ahead of login"""
+
+    def __init__(self, generate, enabled=GREETING_MATERIALIZE, chat_refresh=GREETING_CHAT_REFRESH):
+        # generate(prompt) -> greeting text
+        self.generate = generate
+        self.enabled = enabled
+        self.chat_refresh = chat_refresh
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._rerun = set()
+        self._last_chat_refresh = OrderedDict()  # user_id -> time, oldest first; only the last chat_refresh seconds
+        self._executor = None
+        self._executor_pid = None
+        self._saved_ms = 0.0
+        self._counters = {'hits': 0, 'missing': 0, 'stale': 0, 'materialized': 0, 'errors': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    # Generation
+
+    def _render(self, db, user):
+        """Generate a greeting for a user from current data; returns (text, milliseconds)"""
+        from database import FoodLog
+
+        recent_foods = db.query(FoodLog).filter(
+            FoodLog.user_id == user.id
+        ).order_by(FoodLog.timestamp.desc()).limit(3).all()
+        started = time.perf_counter()
+        greeting = self.generate(build_greeting_prompt(user.username, user.health, recent_foods))
+        return greeting, (time.perf_counter() - started) * 1000
+
+    def _store(self, db, user_id, greeting, version, generation_ms):
+        """Save a greeting built from `version`, unless a newer one is already stored"""
+        from database import UserGreeting
+
+        now = datetime.utcnow()
+        statement = insert(UserGreeting).values(
+            user_id=user_id, greeting=greeting, version=version, requested_version=version,
+            generated_at=now, generation_ms=generation_ms
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=[UserGreeting.user_id],
+            set_={'greeting': greeting, 'version': version, 'generated_at': now, 'generation_ms': generation_ms},
+            where=UserGreeting.version <= version
+        )
+        db.execute(statement)
+        db.commit()
+
+    # Login
+
+    def get(self, db, user):
+        """Chat greeting for a returning user: the stored one if current, else generated now"""
+        from database import UserGreeting
+
+        row = db.query(UserGreeting).filter(UserGreeting.user_id == user.id).first() if self.enabled else None
+        if row is not None and row.greeting and row.version == row.requested_version:
+            with self._lock:
+                self._counters['hits'] += 1
+                self._saved_ms += row.generation_ms or 0.0
+            return row.greeting
+
+        if self.enabled:
+            self._count('missing' if row is None or not row.greeting else 'stale')
+        version = row.requested_version if row is not None else 0
+        started = time.perf_counter()
+        greeting, generation_ms = self._render(db, user)
+        observe_stage('greeting_sync', time.perf_counter() - started)
+        if self.enabled:
+            try:
+                self._store(db, user.id, greeting, version, generation_ms)
+            except Exception as e:
+                db.rollback()
+                print(f"[ERROR] Storing greeting for user {user.id} failed: {e}")
+        return greeting
+
+    # Events
+
+    def food_logged(self, db, user_id):
+        """Mark the greeting stale in the caller's transaction (call before its commit)"""
+        if not self.enabled:
+            return
+        from database import UserGreeting
+
+        db.execute(insert(UserGreeting).values(user_id=user_id, version=0, requested_version=1).on_conflict_do_update(
+            index_elements=[UserGreeting.user_id],
+            set_={'requested_version': UserGreeting.requested_version + 1}
+        ))
+
+    def chat_logged(self, user_id):
+        """Refresh a user's greeting after chatting, at most every chat_refresh seconds"""
+        if not self.enabled:
+            return
+        now = time.time()
+        with self._lock:
+            # Entries past the interval no longer throttle anything; drop them so the map stays bounded
+            while self._last_chat_refresh and now - next(iter(self._last_chat_refresh.values())) >= self.chat_refresh:
+                self._last_chat_refresh.popitem(last=False)
+            if user_id in self._last_chat_refresh:
+                return
+            self._last_chat_refresh[user_id] = now
+        self.schedule(user_id)
+
+    def _get_executor(self):
+        # Per process so pre-forked workers don't inherit dead threads
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=GREETING_WORKERS, thread_name_prefix='greeting')
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def schedule(self, user_id):
+        """Queue a regeneration (coalesced: one more run if already queued or running)"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if user_id in self._pending:
+                self._rerun.add(user_id)
+                return
+            self._pending.add(user_id)
+        self._get_executor().submit(self._materialize, user_id)
+
+    def _materialize(self, user_id):
+        from database import session_scope, User, UserGreeting
+
+        try:
+            with session_scope() as db:
+                user = db.query(User).filter(User.id == user_id).first()
+                if user is None:
+                    return
+                row = db.query(UserGreeting.requested_version).filter(UserGreeting.user_id == user_id).first()
+                version = row[0] if row else 0
+                started = time.perf_counter()
+                greeting, generation_ms = self._render(db, user)
+                self._store(db, user_id, greeting, version, generation_ms)
+            observe_stage('greeting_materialize', time.perf_counter() - started)
+            self._count('materialized')
+        except Exception as e:
+            print(f"[ERROR] Greeting materialization failed for user {user_id}: {e}")
+            self._count('errors')
+        finally:
+            with self._lock:
+                self._pending.discard(user_id)
+                rerun = user_id in self._rerun
+                self._rerun.discard(user_id)
+            if rerun:
+                self.schedule(user_id)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['pending'] = len(self._pending)
+            saved_ms = self._saved_ms
+        logins = stats['hits'] + stats['missing'] + stats['stale']
+        stats['hit_rate'] = stats['hits'] / logins if logins else 0.0
+        stats['latency_saved_ms'] = round(saved_ms, 1)
+        stats['avg_latency_saved_ms'] = round(saved_ms / stats['hits'], 1) if stats['hits'] else 0.0
+        return stats
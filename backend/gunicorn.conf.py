@@ -0,0 +1,80 @@
+"""
+Gunicorn configuration for production serving.
+
+The app (ResNet50 model, label table, DB engine) is loaded once in the master
+with preload_app and MODEL_PRELOAD=1 and then forked, so workers share those
+memory pages copy-on-write. Any backend's weights are shared this way only
+because they are built before the fork; with MODEL_PRELOAD=0 each worker
+builds (and, unless eager keeps them mmap-backed, owns) its own copy. Worker processes, threads per worker and torch intra-op threads
+are sized together so that workers * torch threads never exceeds the cores.
+
+    gunicorn -c gunicorn.conf.py app:app
+"""
+
+import gc
+import os
+
+cpu_count = os.cpu_count() or 1
+
+# WEB_WORKERS processes, each running WEB_THREADS request threads.
+# Each worker gets TORCH_NUM_THREADS intra-op threads (default: an equal share of the cores).
+workers = int(os.environ.get('WEB_WORKERS', cpu_count))
+threads = int(os.environ.get('WEB_THREADS', 4))
+torch_threads = int(os.environ.get('TORCH_NUM_THREADS', max(1, cpu_count // workers)))
+
+if workers * torch_threads > cpu_count:
+    print(f"[DEBUG] Warning: {workers} workers x {torch_threads} torch threads oversubscribes {cpu_count} cores")
+
+# Read by inference_backends.configure_threads() and app.py during preload
+os.environ['TORCH_NUM_THREADS'] = str(torch_threads)
+os.environ.setdefault('MODEL_PRELOAD', '1')
+# OpenMP/MKL pools must not be larger than the torch share either
+os.environ.setdefault('OMP_NUM_THREADS', str(torch_threads))
+os.environ.setdefault('MKL_NUM_THREADS', str(torch_threads))
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+worker_class = 'gthread'
+preload_app = True
+timeout = int(os.environ.get('WEB_TIMEOUT', 120))
+graceful_timeout = 30
+keepalive = 5
+accesslog = '-'
+errorlog = '-'
+
+print(f"[DEBUG] Gunicorn: {workers} workers x {threads} threads, {torch_threads} torch threads each ({cpu_count} cores)")
+
+
+def pre_fork(server, worker):
+    # Move everything loaded so far (model, labels, modules) out of the GC's
+    # generations so collections in workers don't write to the shared pages
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import torch
+    from database import engine
+
+    torch.set_num_threads(torch_threads)
+    # Pooled connections opened in the master must not be shared across processes
+    engine.dispose(close=False)
+
+
+def post_worker_init(worker):
+    import food_classifier
+    from esp32_manager import device_manager
+    from partitions import partition_maintainer
+
+    # Model is already loaded in the master; run the warm-up forward pass here, before
+    # the worker accepts requests, so torchscript/compile optimize off live traffic
+    food_classifier.start_warmup(background=False)
+    # Every worker runs a scheduler; only the advisory-lock holder sends heartbeats
+    device_manager.start()
+    # Partition DDL is serialized by an advisory lock, so every worker can run it
+    partition_maintainer.start()
+
+
+def worker_exit(server, worker):
+    from conversation_writer import conversation_writer
+
+    # Commit write-behind Conversation rows before the worker goes away
+    conversation_writer.close()
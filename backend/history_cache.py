@@ -0,0 +1,280 @@
+"""
+In-process cache of recent conversation turns for RAG context.
+
+Each (user, conversation type) keeps a ring buffer of its last
+HISTORY_CACHE_TURNS turns. Buffers are filled from Postgres on a miss,
+appended to write-through when a Conversation is committed, and evicted LRU
+once HISTORY_CACHE_MAX_ENTRIES buffers are held. In the steady state a chat
+turn builds its context without querying `conversations`.
+
+Several workers can write for the same user, so every commit also sends a
+Postgres NOTIFY inside its transaction. Each process LISTENs on a dedicated
+connection and drops the buffers other processes wrote to; the next read
+reloads them. HISTORY_CACHE_TTL bounds staleness if a notification is ever
+missed (e.g. while the listener reconnects - it also clears the cache then).
+"""
+
+import os
+import select
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, select as sql_select, text, union_all
+from sqlalchemy.pool import NullPool
+
+HISTORY_CACHE_TURNS = int(os.environ.get('HISTORY_CACHE_TURNS', 10))
+HISTORY_CACHE_MAX_ENTRIES = int(os.environ.get('HISTORY_CACHE_MAX_ENTRIES', 3000))
+HISTORY_CACHE_TTL = float(os.environ.get('HISTORY_CACHE_TTL', 300))
+HISTORY_CACHE_ENABLED = os.environ.get('HISTORY_CACHE_ENABLED', '1') == '1'
+# Cold loads only read turns this recent, so they touch the newest monthly partitions (0: no bound)
+HISTORY_LOOKBACK_DAYS = int(os.environ.get('HISTORY_LOOKBACK_DAYS', 90))
+
+NOTIFY_CHANNEL = 'conversation_history'
+
+# Conversation states that make up each RAG context type
+HISTORY_TYPES = {
+    'food': ('food_discussion', 'food_image_request'),
+    'financial': ('financial_advice',),
+    'general': ('general_chat',),
+}
+STATE_TYPES = {state: history_type for history_type, states in HISTORY_TYPES.items() for state in states}
+
+
+def recent_turns_query(user_id, conversation_type, limit):
+    """
+    Newest `limit` turns of a type as a select of (id, user_message, bot_response, timestamp).
+
+    Types spanning several states are a UNION ALL of one ordered, limited
+    select per state: each branch is a range scan on
+    ix_conversations_user_state_timestamp, where a single IN (...) filter
+    would have to read every matching row and sort them.
+
+    Only turns from the last HISTORY_LOOKBACK_DAYS are read, which lets
+    Postgres prune every other monthly partition of `conversations` (query
+    planning time grows with the partitions left in).
+    """
+    from database import Conversation
+
+    columns = (Conversation.id, Conversation.user_message, Conversation.bot_response, Conversation.timestamp)
+    conditions = [Conversation.user_id == user_id]
+    if HISTORY_LOOKBACK_DAYS > 0:
+        now = datetime.utcnow()
+        # The upper bound (a day of slack for clock skew) prunes the empty partitions created ahead
+        conditions += [Conversation.timestamp >= now - timedelta(days=HISTORY_LOOKBACK_DAYS),
+                       Conversation.timestamp < now + timedelta(days=1)]
+    branches = [
+        sql_select(*columns).where(*conditions, Conversation.conversation_state == state)
+        .order_by(Conversation.timestamp.desc()).limit(limit)
+        for state in HISTORY_TYPES.get(conversation_type, HISTORY_TYPES['general'])
+    ]
+    if len(branches) == 1:
+        return branches[0]
+    merged = union_all(*branches).subquery()
+    return sql_select(merged.c.id, merged.c.user_message, merged.c.bot_response, merged.c.timestamp).order_by(
+        merged.c.timestamp.desc()
+    ).limit(limit)
+
+
+class _Buffer:
+    __slots__ = ('turns', 'loaded_at')
+
+    def __init__(self, turns, loaded_at):
+        self.turns = turns  # deque of (conversation id, user_message, bot_response), oldest first
+        self.loaded_at = loaded_at
+
+
+class _Load:
+    __slots__ = ('readers', 'stale')
+
+    def __init__(self):
+        self.readers = 0  # cold loads of the key in flight
+        self.stale = False  # a turn was committed meanwhile, so their snapshot may miss it
+
+
+class HistoryCache:
+    """Per-user, per-type ring buffers of recent turns with LRU eviction"""
+
+    def __init__(self, turns=HISTORY_CACHE_TURNS, max_entries=HISTORY_CACHE_MAX_ENTRIES, ttl=HISTORY_CACHE_TTL,
+                 enabled=HISTORY_CACHE_ENABLED):
+        self.turns = turns
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.enabled = enabled
+        self._buffers = OrderedDict()
+        self._lock = threading.Lock()
+        self._epoch = 0  # bumped on every invalidation so in-flight cold loads aren't cached stale
+        self._loads = {}  # (user_id, type) -> _Load, while a cold load of it runs
+        self._listener = None
+        self._listener_pid = None
+        self._listening = threading.Event()
+        self._counters = {'hits': 0, 'misses': 0, 'appends': 0, 'invalidations': 0, 'evictions': 0, 'listener_errors': 0}
+
+    def _count(self, name):
+        self._counters[name] += 1
+
+    # Reads
+
+    def get(self, db, user_id, conversation_type, limit):
+        """Last `limit` (user_message, bot_response) turns of a type, oldest first"""
+        if not self.enabled or limit > self.turns:
+            return self._query(db, user_id, conversation_type, limit)
+        if not self._ensure_listener(db):
+            # Invalidations can't be heard right now, so don't trust or fill the cache
+            return self._query(db, user_id, conversation_type, limit)
+
+        key = (user_id, conversation_type)
+        now = time.time()
+        with self._lock:
+            buffer = self._buffers.get(key)
+            if buffer is not None and (self.ttl <= 0 or now - buffer.loaded_at <= self.ttl):
+                self._buffers.move_to_end(key)
+                self._count('hits')
+                return [(message, response) for _, message, response in list(buffer.turns)[-limit:]]
+            self._count('misses')
+            epoch = self._epoch
+            load = self._loads.setdefault(key, _Load())
+            load.readers += 1
+
+        try:
+            rows = self._query(db, user_id, conversation_type, self.turns, with_ids=True)
+        finally:
+            with self._lock:
+                load.readers -= 1
+                if load.readers == 0:
+                    self._loads.pop(key, None)
+        with self._lock:
+            if self._epoch == epoch and not load.stale:
+                self._buffers[key] = _Buffer(deque(rows, maxlen=self.turns), now)
+                self._buffers.move_to_end(key)
+                while len(self._buffers) > self.max_entries:
+                    self._buffers.popitem(last=False)
+                    self._count('evictions')
+        return [(message, response) for _, message, response in rows[-limit:]]
+
+    def _query(self, db, user_id, conversation_type, limit, with_ids=False):
+        rows = db.execute(recent_turns_query(user_id, conversation_type, limit)).all()
+        rows.reverse()
+        if with_ids:
+            return [(conversation_id, message, response) for conversation_id, message, response, _ in rows]
+        return [(message, response) for _, message, response, _ in rows]
+
+    # Writes
+
+    def notify(self, db, user_id, conversation_state):
+        """Queue a cross-worker invalidation in the caller's transaction (sent on commit)"""
+        conversation_type = STATE_TYPES.get(conversation_state)
+        if not self.enabled or conversation_type is None or db.bind.dialect.name != 'postgresql':
+            return
+        db.execute(text('SELECT pg_notify(:channel, :payload)'), {
+            'channel': NOTIFY_CHANNEL,
+            'payload': f"{os.getpid()}:{user_id}:{conversation_type}"
+        })
+
+    def record(self, conversation):
+        """Write-through after a Conversation commit"""
+        conversation_type = STATE_TYPES.get(conversation.conversation_state)
+        if not self.enabled or conversation_type is None:
+            return
+        key = (conversation.user_id, conversation_type)
+        with self._lock:
+            load = self._loads.get(key)
+            if load is not None:
+                # A cold load may have read before this commit; don't let it cache that snapshot
+                load.stale = True
+            buffer = self._buffers.get(key)
+            # Not cached: the next read loads it, including this turn
+            if buffer is None:
+                return
+            if any(turn[0] == conversation.id for turn in buffer.turns):
+                # A cold load that raced with this commit already holds the row
+                return
+            if buffer.turns and buffer.turns[-1][0] > conversation.id:
+                # Concurrent commits finished out of order: reload rather than misorder
+                del self._buffers[key]
+                return
+            buffer.turns.append((conversation.id, conversation.user_message, conversation.bot_response))
+            self._count('appends')
+
+    def invalidate(self, user_id=None, conversation_type=None):
+        """Drop one buffer, all of a user's buffers, or everything"""
+        with self._lock:
+            self._epoch += 1
+            self._count('invalidations')
+            if user_id is None:
+                self._buffers.clear()
+                return
+            for key in [k for k in self._buffers if k[0] == user_id and conversation_type in (None, k[1])]:
+                del self._buffers[key]
+
+    # Cross-worker invalidation
+
+    def _ensure_listener(self, db):
+        """Start this process's LISTEN thread if needed; True once invalidations are being received"""
+        if db.bind.dialect.name != 'postgresql':
+            # No NOTIFY support: rely on the TTL alone
+            return True
+        if self._listener_pid == os.getpid():
+            return self._listening.is_set()
+        with self._lock:
+            if self._listener_pid == os.getpid():
+                return self._listening.is_set()
+            self._listener_pid = os.getpid()
+            self._listening = threading.Event()
+        self._listener = threading.Thread(target=self._listen, args=(db.bind,), name='history-cache-listener', daemon=True)
+        self._listener.start()
+        # Don't cache anything before LISTEN is in place, or its invalidations could be missed
+        return self._listening.wait(timeout=2)
+
+    def _listen(self, engine):
+        pid = str(os.getpid())
+        # Own unpooled connection so the long-lived LISTEN doesn't hold a pool slot
+        listen_engine = create_engine(engine.url, poolclass=NullPool)
+        while True:
+            connection = None
+            try:
+                connection = listen_engine.raw_connection()
+                dbapi_connection = connection.dbapi_connection
+                dbapi_connection.autocommit = True
+                with dbapi_connection.cursor() as cursor:
+                    cursor.execute(f'LISTEN {NOTIFY_CHANNEL}')
+                # Buffers loaded before this point (inherited across fork, or filled
+                # while reconnecting) may have missed notifications
+                self.invalidate()
+                self._listening.set()
+                print(f"[DEBUG] History cache listening for invalidations (pid {pid})")
+                while True:
+                    if select.select([dbapi_connection], [], [], 30) == ([], [], []):
+                        continue
+                    dbapi_connection.poll()
+                    while dbapi_connection.notifies:
+                        notification = dbapi_connection.notifies.pop(0)
+                        origin, user_id, conversation_type = notification.payload.split(':')
+                        if origin != pid:
+                            self.invalidate(int(user_id), conversation_type)
+            except Exception as e:
+                print(f"[ERROR] History cache listener failed: {e}")
+                self._listening.clear()
+                with self._lock:
+                    self._count('listener_errors')
+                time.sleep(1)
+            finally:
+                if connection is not None:
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['entries'] = len(self._buffers)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        stats['turns_per_entry'] = self.turns
+        stats['listening'] = self._listener_pid == os.getpid() and self._listening.is_set()
+        return stats
+
+
+history_cache = HistoryCache()
@@ -0,0 +1,169 @@
+"""
+Bounded image ingest for /api/feed.
+
+An upload is read once into a single bytes buffer (refusing anything over
+MAX_UPLOAD_BYTES, even without a Content-Length), its header is checked
+against MAX_IMAGE_PIXELS before any pixel is decoded, and the decode itself
+asks the JPEG loader for a reduced-resolution image: libjpeg scales by 1/2,
+1/4 or 1/8 during the IDCT, so a 12 MP phone photo comes out at ~500x375
+instead of 4032x3024 - still at least DECODE_TARGET_SIZE on the short side
+for transforms.Resize(256), at a fraction of the time and memory.
+
+The content hash, the decode and the Gemini fallback all read the same
+buffer, so the upload is never seeked or re-read. Decode time and the
+decoded bytes (width x height x bands of the result, versus what a full
+decode would have produced) are logged per image and exported as metrics.
+These are sizes of the pixel data, not a measurement of process memory.
+
+PIL's process-wide Image.MAX_IMAGE_PIXELS is left alone; decode() applies
+max_pixels itself from the header. PIL's own bomb guard (89M pixels by
+default) still refuses anything past twice its limit while opening.
+"""
+
+import io
+import os
+import time
+
+from PIL import Image
+
+from metrics import registry, observe_stage
+
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', 10 * 1024 * 1024))
+MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS', 40_000_000))
+DECODE_TARGET_SIZE = int(os.environ.get('DECODE_TARGET_SIZE', 256))
+DECODE_DRAFT = os.environ.get('DECODE_DRAFT', '1') == '1'
+
+decoded_bytes = registry.histogram(
+    'gachirat_image_decoded_bytes', 'Decoded bytes per uploaded image (width x height x bands of the decode)',
+    buckets=(64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024, 64 * 1024 * 1024)
+)
+rejected_uploads = registry.counter(
+    'gachirat_image_rejected_total', 'Uploads refused by the ingest stage by reason (too_large, too_many_pixels, invalid)',
+    labels=('reason',)
+)
+
+
+class ImageRejected(ValueError):
+    """Upload refused before decoding; `status` is the HTTP status to answer with"""
+
+    def __init__(self, message, reason, status=400):
+        super().__init__(message)
+        self.reason = reason
+        self.status = status
+
+
+class IngestedImage:
+    """One upload: the raw bytes plus the (reduced) RGB decode, both shared by every consumer"""
+
+    __slots__ = ('data', 'format', 'original_size', 'image', 'decode_ms', 'decoded_bytes')
+
+    def __init__(self, data, image_format, original_size, image, decode_ms):
+        self.data = data
+        self.format = image_format
+        self.original_size = original_size
+        self.image = image
+        self.decode_ms = decode_ms
+        self.decoded_bytes = image.width * image.height * len(image.getbands())
+
+    @property
+    def full_decode_bytes(self):
+        """What decoding at full resolution would have taken (RGB)"""
+        return self.original_size[0] * self.original_size[1] * 3
+
+
+def read_upload(file, max_bytes=MAX_UPLOAD_BYTES):
+    """Read a file-like object into one bytes buffer, refusing more than max_bytes"""
+    data = file.read(max_bytes + 1)
+    if len(data) > max_bytes:
+        rejected_uploads.inc('too_large')
+        raise ImageRejected(f'Image is larger than {max_bytes // (1024 * 1024)} MB.', 'too_large', status=413)
+    if not data:
+        rejected_uploads.inc('invalid')
+        raise ImageRejected('Image file is empty.', 'invalid')
+    return data
+
+
+def decode(data, target_size=DECODE_TARGET_SIZE, max_pixels=MAX_IMAGE_PIXELS, draft=DECODE_DRAFT):
+    """
+    Decode image bytes to RGB, at reduced resolution where the format allows.
+
+    Returns (image, format, original size). The short side of the result stays
+    >= target_size (unless the original is smaller), so Resize(target_size)
+    sees the same framing as with a full decode.
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+    except Image.DecompressionBombError:
+        # Past twice PIL's own limit it refuses before the header check below
+        rejected_uploads.inc('too_many_pixels')
+        raise ImageRejected('Image has too many pixels to decode.', 'too_many_pixels', status=413)
+    except Exception as e:
+        print(f"[ERROR] Unreadable upload: {e}")
+        rejected_uploads.inc('invalid')
+        raise ImageRejected('Could not read image.', 'invalid')
+
+    width, height = image.size
+    if width * height > max_pixels:
+        rejected_uploads.inc('too_many_pixels')
+        raise ImageRejected(f'Image is {width}x{height}; the limit is {max_pixels} pixels.', 'too_many_pixels', status=413)
+
+    image_format = image.format
+    if draft and image_format == 'JPEG':
+        # Request the smallest DCT scale whose short side still covers target_size
+        short = min(width, height)
+        if short > target_size:
+            scale = short / target_size
+            image.draft('RGB', (int(width / scale), int(height / scale)))
+    try:
+        image = image.convert('RGB')
+    except Exception as e:
+        print(f"[ERROR] Image decode failed: {e}")
+        rejected_uploads.inc('invalid')
+        raise ImageRejected('Could not decode image.', 'invalid')
+    return image, image_format, (width, height)
+
+
+def ingest(file):
+    """Read, validate and decode an upload (file-like object or bytes)"""
+    data = file if isinstance(file, bytes) else read_upload(file)
+    started = time.perf_counter()
+    image, image_format, original_size = decode(data)
+    seconds = time.perf_counter() - started
+    observe_stage('decode', seconds)
+
+    ingested = IngestedImage(data, image_format, original_size, image, round(seconds * 1000, 1))
+    decoded_bytes.observe(ingested.decoded_bytes)
+    print(f"[DEBUG] Decoded {image_format} {original_size[0]}x{original_size[1]} -> {image.width}x{image.height} "
+          f"in {ingested.decode_ms}ms ({ingested.decoded_bytes / 1024:.0f} KB decoded, "
+          f"full decode {ingested.full_decode_bytes / 1024:.0f} KB)")
+    return ingested
+
+
+if __name__ == '__main__':
+    # Compare full and reduced decodes of a synthetic 12 MP photo
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Time full vs draft-mode decode of a JPEG')
+    parser.add_argument('path', nargs='?', help='JPEG to decode (default: synthetic 4032x3024)')
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    if args.path:
+        with open(args.path, 'rb') as f:
+            sample = f.read()
+    else:
+        buffer = io.BytesIO()
+        Image.radial_gradient('L').resize((4032, 3024)).convert('RGB').save(buffer, 'JPEG', quality=90)
+        sample = buffer.getvalue()
+    print(f"Sample: {len(sample) / 1024:.0f} KB")
+
+    for label, use_draft in (('full', False), ('draft', True)):
+        timings = []
+        for _ in range(args.runs):
+            started = time.perf_counter()
+            image, _, original = decode(sample, draft=use_draft)
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        decoded = image.width * image.height * 3
+        print(f"{label:<6} {original[0]}x{original[1]} -> {image.width}x{image.height}  "
+              f"p50 {timings[len(timings) // 2]:.1f}ms  decoded bytes {decoded / (1024 * 1024):.1f} MB")
@@ -0,0 +1,222 @@
+"""
+Selectable CPU inference backends for the food classifier.
+
+INFERENCE_BACKEND picks how the ResNet50 built from `trained_weights` is run:
+  eager        - plain fp32 nn.Module (default)
+  torchscript  - traced, frozen and optimized TorchScript graph
+  compile      - torch.compile (inductor); first call pays the compile cost
+  dynamic_int8 - dynamically quantized Linear layers (only the fc head changes)
+  static_int8  - fused, statically quantized conv/linear layers calibrated on
+                 INFERENCE_CALIBRATION_DIR images (fbgemm/x86 kernels)
+
+Run `python inference_backends.py [image_dir]` to compare each backend's top-1
+predictions and latency against the fp32 model before switching.
+"""
+
+import os
+import sys
+import time
+
+import torch
+import torchvision.models as models
+import torchvision.models.quantization as quantized_models
+from PIL import Image
+
+INFERENCE_BACKENDS = ['eager', 'torchscript', 'compile', 'dynamic_int8', 'static_int8']
+QUANTIZED_BACKENDS = ['dynamic_int8', 'static_int8']
+
+INFERENCE_BACKEND = os.environ.get('INFERENCE_BACKEND', 'eager').lower()
+# Off by default for eager: the channels-last copy moves every conv weight out of the
+# mmap-backed checkpoint, so a process that builds the model pays for a private copy.
+# The other backends rewrite the weights anyway.
+INFERENCE_CHANNELS_LAST = os.environ.get(
+    'INFERENCE_CHANNELS_LAST', '0' if INFERENCE_BACKEND == 'eager' else '1'
+) == '1'
+INFERENCE_CALIBRATION_DIR = os.environ.get(
+    'INFERENCE_CALIBRATION_DIR', os.path.join(os.path.dirname(__file__), 'classifier_test')
+)
+TORCH_NUM_THREADS = os.environ.get('TORCH_NUM_THREADS')
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+
+
+def configure_threads(num_threads=None):
+    """Apply TORCH_NUM_THREADS (intra-op parallelism) if configured"""
+    num_threads = num_threads or TORCH_NUM_THREADS
+    if num_threads:
+        torch.set_num_threads(int(num_threads))
+    print(f"[DEBUG] Torch intra-op threads: {torch.get_num_threads()}")
+
+
+def backend_device(backend, device):
+    """Quantized kernels only exist on CPU"""
+    if backend in QUANTIZED_BACKENDS:
+        return torch.device('cpu')
+    return device
+
+
+def load_image_dir(image_dir, preprocess, limit=None):
+    """Load (filename, tensor) pairs from a local image directory"""
+    if not image_dir or not os.path.isdir(image_dir):
+        return []
+    images = []
+    for name in sorted(os.listdir(image_dir)):
+        if not name.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        try:
+            with Image.open(os.path.join(image_dir, name)) as image:
+                images.append((name, preprocess(image.convert('RGB'))))
+        except Exception as e:
+            print(f"[DEBUG] Skipping {name}: {e}")
+        if limit and len(images) >= limit:
+            break
+    return images
+
+
+def _example_batch(channels_last, batch_size=1):
+    example = torch.randn(batch_size, 3, 224, 224)
+    if channels_last:
+        example = example.contiguous(memory_format=torch.channels_last)
+    return example
+
+
+def _build_static_int8(state_dict, calibration_tensors):
+    """Fuse conv/bn/relu, calibrate observers and convert to int8"""
+    engine = 'x86' if 'x86' in torch.backends.quantized.supported_engines else 'fbgemm'
+    torch.backends.quantized.engine = engine
+
+    model = quantized_models.resnet50(weights=None, quantize=False)
+    model.load_state_dict(state_dict)
+    model.eval()
+    model.fuse_model()
+    model.qconfig = torch.ao.quantization.get_default_qconfig(engine)
+    torch.ao.quantization.prepare(model, inplace=True)
+
+    if not calibration_tensors:
+        print("[DEBUG] Warning: no calibration images found, calibrating static_int8 on random inputs")
+        calibration_tensors = [torch.randn(3, 224, 224) for _ in range(8)]
+
+    with torch.no_grad():
+        for start in range(0, len(calibration_tensors), 8):
+            model(torch.stack(calibration_tensors[start:start + 8]))
+
+    torch.ao.quantization.convert(model, inplace=True)
+    print(f"[DEBUG] Built static_int8 model ({engine}, {len(calibration_tensors)} calibration images)")
+    return model
+
+
+def build_model(state_dict, backend=INFERENCE_BACKEND, device=torch.device('cpu'),
+                channels_last=INFERENCE_CHANNELS_LAST, preprocess=None):
+    """Build the ResNet50 classifier for the selected inference backend"""
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError(f"Unknown INFERENCE_BACKEND '{backend}'. Choose one of: {', '.join(INFERENCE_BACKENDS)}")
+
+    if backend == 'static_int8':
+        calibration = load_image_dir(INFERENCE_CALIBRATION_DIR, preprocess, limit=64) if preprocess else []
+        model = _build_static_int8(state_dict, [tensor for _, tensor in calibration])
+    else:
+        model = models.resnet50(weights=None)
+        # assign=True keeps (possibly mmap-backed) weight tensors instead of copying them
+        model.load_state_dict(state_dict, assign=True)
+        model.eval()
+
+        if backend == 'dynamic_int8':
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        else:
+            model = model.to(device)
+
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+
+    if backend == 'torchscript':
+        with torch.no_grad():
+            example = _example_batch(channels_last).to(device)
+            model = torch.jit.trace(model, example)
+            model = torch.jit.optimize_for_inference(torch.jit.freeze(model))
+    elif backend == 'compile':
+        model = torch.compile(model)
+
+    print(f"[DEBUG] Inference backend: {backend} (channels_last={channels_last})")
+    return model
+
+
+def compare_backends(state_dict, preprocess, labels, image_dir, backends=None, tracked_labels=None):
+    """
+    Compare every backend with the fp32 eager model on a local image set.
+
+    Reports top-1 agreement overall and on images whose fp32 prediction is one
+    of `tracked_labels` (the NUTRITION_MAP classes), plus mean latency.
+    """
+    images = load_image_dir(image_dir, preprocess)
+    if not images:
+        print(f"✗ No images found in {image_dir}")
+        return {}
+
+    tracked_labels = set(tracked_labels or [])
+    device = torch.device('cpu')
+
+    def run(model, channels_last):
+        predictions, elapsed = [], 0.0
+        with torch.no_grad():
+            for _, tensor in images:
+                batch = tensor.unsqueeze(0)
+                if channels_last:
+                    batch = batch.contiguous(memory_format=torch.channels_last)
+                started = time.perf_counter()
+                output = model(batch)
+                elapsed += time.perf_counter() - started
+                predictions.append(int(output.argmax(dim=1)[0]))
+        return predictions, elapsed / len(images) * 1000
+
+    def label(idx):
+        return labels[idx] if labels else str(idx)
+
+    reference_model = build_model(state_dict, 'eager', device, channels_last=False)
+    reference, reference_ms = run(reference_model, False)
+    print(f"\nfp32 reference: {len(images)} images, {reference_ms:.1f} ms/image")
+
+    results = {}
+    for backend in backends or INFERENCE_BACKENDS:
+        for channels_last in (False, True):
+            try:
+                model = build_model(state_dict, backend, device, channels_last=channels_last, preprocess=preprocess)
+                run(model, channels_last)  # warm-up (tracing/compilation)
+                predictions, ms = run(model, channels_last)
+            except Exception as e:
+                print(f"✗ {backend} (channels_last={channels_last}) failed: {e}")
+                continue
+
+            agree = [p == r for p, r in zip(predictions, reference)]
+            tracked = [a for a, r in zip(agree, reference) if label(r) in tracked_labels]
+            key = f"{backend}{'+channels_last' if channels_last else ''}"
+            results[key] = {
+                'top1_agreement': sum(agree) / len(agree),
+                'tracked_agreement': (sum(tracked) / len(tracked)) if tracked else None,
+                'tracked_images': len(tracked),
+                'ms_per_image': ms,
+                'speedup': reference_ms / ms if ms else 0.0,
+            }
+            for (name, _), p, r in zip(images, predictions, reference):
+                if p != r:
+                    print(f"  [{key}] {name}: fp32={label(r)} vs {label(p)}")
+
+    print(f"\n{'backend':<30}{'top-1 agree':>12}{'food agree':>12}{'ms/image':>10}{'speedup':>9}")
+    for key, r in results.items():
+        tracked = f"{r['tracked_agreement']:.1%}" if r['tracked_agreement'] is not None else 'n/a'
+        print(f"{key:<30}{r['top1_agreement']:>12.1%}{tracked:>12}{r['ms_per_image']:>10.1f}{r['speedup']:>8.2f}x")
+    return results
+
+
+if __name__ == '__main__':
+    # Accuracy/latency check of every backend against fp32 on a local image set
+    import json
+
+    image_dir = sys.argv[1] if len(sys.argv) > 1 else INFERENCE_CALIBRATION_DIR
+    configure_threads()
+
+    from food_classifier import preprocess, imagenet_labels, get_nutrition_info, weights_path
+
+    state_dict = torch.load(weights_path, map_location='cpu')
+    food_labels = [l for l in imagenet_labels if get_nutrition_info(l)['category'] != 'unknown']
+    results = compare_backends(state_dict, preprocess, imagenet_labels, image_dir, tracked_labels=food_labels)
+    print(json.dumps(results, indent=2))
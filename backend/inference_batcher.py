@@ -0,0 +1,142 @@
+"""
+Micro-batching inference worker for the food classifier.
+
+Concurrent /api/feed requests submit preprocessed image tensors here. A single
+worker thread collects them for up to INFERENCE_MAX_WAIT_MS (or until
+INFERENCE_MAX_BATCH_SIZE items are waiting), runs them through the model as one
+stacked batch and hands every caller its own result.
+"""
+
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+INFERENCE_MAX_BATCH_SIZE = int(os.environ.get('INFERENCE_MAX_BATCH_SIZE', 8))
+INFERENCE_MAX_WAIT_MS = float(os.environ.get('INFERENCE_MAX_WAIT_MS', 5))
+
+
+class _Request:
+    """One queued inference request"""
+
+    def __init__(self, item, top_k):
+        self.item = item
+        self.top_k = top_k
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+class InferenceBatcher:
+    """Collects single-image requests into batches for one forward pass"""
+
+    def __init__(self, run_batch, max_batch_size=INFERENCE_MAX_BATCH_SIZE, max_wait_ms=INFERENCE_MAX_WAIT_MS):
+        # run_batch(items, top_k) -> one top-k list per item, in order
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._items = 0
+        self._batch_sizes = {}
+        self._queue_waits = deque(maxlen=1000)
+        self._batch_times = deque(maxlen=1000)
+
+    def _ensure_started(self):
+        # Started lazily (and re-started after fork) so a pre-forked worker
+        # never inherits a dead thread from its parent process
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._queue = queue.Queue()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._loop, name='inference-batcher', daemon=True)
+            self._thread.start()
+            print(f"[DEBUG] Inference batcher started (max_batch_size={self.max_batch_size}, max_wait_ms={self.max_wait * 1000:.1f})")
+
+    def submit(self, item, top_k=1):
+        """Queue one item and return a Future resolving to its top-k list"""
+        self._ensure_started()
+        request = _Request(item, top_k)
+        self._queue.put(request)
+        return request.future
+
+    def infer(self, item, top_k=1, timeout=None):
+        """Blocking helper: submit one item and wait for its result"""
+        return self.submit(item, top_k).result(timeout=timeout)
+
+    def _collect(self):
+        """Block for the first request, then gather more until full or the wait expires"""
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            started = time.perf_counter()
+            waits = [started - r.enqueued_at for r in batch]
+            try:
+                results = self.run_batch([r.item for r in batch], max(r.top_k for r in batch))
+                for request, result in zip(batch, results):
+                    request.future.set_result(result[:request.top_k])
+            except Exception as e:
+                print(f"[ERROR] Batched inference failed: {e}")
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+            self._record(len(batch), waits, time.perf_counter() - started)
+
+    def _record(self, batch_size, waits, batch_time):
+        with self._stats_lock:
+            self._batches += 1
+            self._items += batch_size
+            self._batch_sizes[batch_size] = self._batch_sizes.get(batch_size, 0) + 1
+            self._queue_waits.extend(waits)
+            self._batch_times.append(batch_time)
+        print(f"[DEBUG] Inference batch: size={batch_size}, max queue wait={max(waits) * 1000:.1f}ms, forward={batch_time * 1000:.1f}ms")
+
+    def get_stats(self):
+        """Batch size and queue wait summary for tuning throughput against p99 latency"""
+        with self._stats_lock:
+            waits = sorted(self._queue_waits)
+            times = sorted(self._batch_times)
+            return {
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000,
+                'batches': self._batches,
+                'items': self._items,
+                'avg_batch_size': (self._items / self._batches) if self._batches else 0.0,
+                'batch_size_counts': dict(sorted(self._batch_sizes.items())),
+                'queue_depth': self._queue.qsize(),
+                'queue_wait_ms': _percentiles(waits),
+                'batch_time_ms': _percentiles(times),
+            }
+
+
+def _percentiles(sorted_values):
+    """p50/p95/p99/max in milliseconds over a sorted window of seconds"""
+    if not sorted_values:
+        return {'p50': 0.0, 'p95': 0.0, 'p99': 0.0, 'max': 0.0}
+
+    def pick(q):
+        return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))] * 1000
+
+    return {'p50': pick(0.50), 'p95': pick(0.95), 'p99': pick(0.99), 'max': sorted_values[-1] * 1000}
@@ -0,0 +1,139 @@
+"""
+Intent routing for chat messages.
+
+All trigger phrases from intents.json are compiled once into a single regex:
+the phrases are merged into a character trie so shared prefixes are only
+tried once, wrapped in word boundaries and matched case-insensitively. One
+scan over the message finds every phrase; each match is mapped back to its
+intent with a dict lookup. Matching is leftmost-longest, so "last meal"
+counts as `last_ate` rather than `food`, and whole words only, so "not" no
+longer matches "nothing" nor "ate" "late".
+
+Add phrases or intents by editing intents.json (or point INTENTS_FILE at
+another file). The routing rules are checked by tests/test_intent_router.py;
+run this module to benchmark the matcher against the old per-list substring
+scans:
+
+    python intent_router.py
+"""
+
+import json
+import os
+import re
+import time
+
+INTENTS_FILE = os.environ.get('INTENTS_FILE', os.path.join(os.path.dirname(__file__), 'intents.json'))
+
+_END = ''  # trie key marking the end of a phrase
+
+
+def normalize_phrase(text):
+    """Lowercase, straighten apostrophes and collapse whitespace"""
+    return ' '.join(text.lower().replace('’', "'").split())
+
+
+def _char_pattern(ch):
+    if ch == ' ':
+        return r'\s+'
+    if ch == "'":
+        return "['’]"
+    return re.escape(ch)
+
+
+def _trie_pattern(node):
+    alternatives = [_char_pattern(ch) + _trie_pattern(child) for ch, child in sorted(node.items()) if ch != _END]
+    if not alternatives:
+        return ''
+    optional = _END in node
+    if len(alternatives) == 1 and not optional:
+        return alternatives[0]
+    # Greedy optional group: the longest phrase is tried first, shorter ones on backtrack
+    return '(?:' + '|'.join(alternatives) + ')' + ('?' if optional else '')
+
+
+class IntentRouter:
+    """Single-pass, word-boundary phrase matcher over a set of intents"""
+
+    def __init__(self, intents):
+        """`intents` maps intent name -> list of phrases, in priority order"""
+        self.priority = list(intents)
+        self._phrase_intent = {}
+        trie = {}
+        for intent, phrases in intents.items():
+            for phrase in phrases:
+                phrase = normalize_phrase(phrase)
+                if not phrase:
+                    continue
+                if phrase in self._phrase_intent and self._phrase_intent[phrase] != intent:
+                    raise ValueError(f"Phrase '{phrase}' is listed under both {self._phrase_intent[phrase]} and {intent}")
+                self._phrase_intent[phrase] = intent
+                node = trie
+                for ch in phrase:
+                    node = node.setdefault(ch, {})
+                node[_END] = {}
+        self.pattern = re.compile(r'\b(?:' + _trie_pattern(trie) + r')\b', re.IGNORECASE) if trie else None
+
+    @classmethod
+    def from_file(cls, path=INTENTS_FILE):
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        return cls(data['intents'])
+
+    def match(self, text):
+        """Set of intents with at least one phrase in `text`"""
+        if self.pattern is None:
+            return set()
+        return {self._phrase_intent[normalize_phrase(m.group(0))] for m in self.pattern.finditer(text)}
+
+    def classify(self, text):
+        """Highest-priority intent in `text`, or None"""
+        found = self.match(text)
+        for intent in self.priority:
+            if intent in found:
+                return intent
+        return None
+
+    def phrases(self, text):
+        """Matched phrases with their intents, for debugging routing decisions"""
+        if self.pattern is None:
+            return []
+        return [(m.group(0), self._phrase_intent[normalize_phrase(m.group(0))]) for m in self.pattern.finditer(text)]
+
+
+# Shared router, compiled once at import
+router = IntentRouter.from_file()
+
+# Sample messages for the `python intent_router.py` benchmark
+BENCHMARK_MESSAGES = [
+    "I'm so hungry",
+    "sorry I'm late",
+    "nothing much, you?",
+    "I'm not hungry",
+    "What did I eat?",
+    "how do I start investing in mutual funds",
+    "buying a dinner costs too much",
+    "Hey Gachirat! Today I went for a long walk in the park and then came home and watched a movie with my friends. " * 3,
+]
+
+
+def _benchmark(iterations=20000):
+    with open(INTENTS_FILE, encoding='utf-8') as f:
+        intents = json.load(f)['intents']
+    messages = BENCHMARK_MESSAGES
+
+    def keyword_scan(text):
+        # What plan_chat_reply used to do: one lowercase + substring scan per list
+        return {intent for intent, phrases in intents.items() if any(p in text.lower() for p in phrases)}
+
+    for name, func in [('substring scans', keyword_scan), ('compiled router', router.match)]:
+        started = time.perf_counter()
+        for _ in range(iterations):
+            for text in messages:
+                func(text)
+        elapsed = time.perf_counter() - started
+        print(f"[DEBUG] {name}: {elapsed / (iterations * len(messages)) * 1e6:.2f} us/message")
+
+
+if __name__ == '__main__':
+    print(f"[DEBUG] Intent router: {len(router._phrase_intent)} phrases, intents {router.priority}")
+    _benchmark()
@@ -0,0 +1,327 @@
+"""
+Shared Gemini client: one reusable model per process, an asyncio API with
+per-call timeouts, a bounded concurrency semaphore and retry with jittered
+exponential backoff.
+
+Calls run on a single background event loop per process, so one worker can
+hold many in-flight Gemini requests without tying up a thread per call. Flask
+code uses the blocking `generate()`, the non-blocking `submit()` (returns a
+concurrent.futures.Future) or the `stream()` chunk generator - thin wrappers
+over `generate_async()` / `stream_async()`.
+
+Point GEMINI_API_ENDPOINT (plus GEMINI_TRANSPORT=rest) at a local fake server
+to test without the real API.
+"""
+
+import asyncio
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+
+from metrics import observe_stage
+
+GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
+GEMINI_MODEL = os.environ.get('GEMINI_MODEL', 'gemini-2.5-flash')
+GEMINI_API_ENDPOINT = os.environ.get('GEMINI_API_ENDPOINT')
+GEMINI_TRANSPORT = os.environ.get('GEMINI_TRANSPORT')  # grpc (default), grpc_asyncio or rest
+
+LLM_TIMEOUT = float(os.environ.get('LLM_TIMEOUT', 20))
+LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', 32))
+LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', 2))
+LLM_BACKOFF_BASE = float(os.environ.get('LLM_BACKOFF_BASE', 0.25))
+LLM_BACKOFF_MAX = float(os.environ.get('LLM_BACKOFF_MAX', 4.0))
+
+# Errors worth retrying: rate limits, overload, transient server failures, timeouts
+RETRYABLE_ERRORS = (
+    asyncio.TimeoutError,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.GatewayTimeout,
+    ConnectionError,
+)
+
+
+def configure_gemini():
+    """Configure the Gemini SDK once per process"""
+    options = {}
+    if GEMINI_API_ENDPOINT:
+        options['client_options'] = {'api_endpoint': GEMINI_API_ENDPOINT}
+    if GEMINI_TRANSPORT:
+        options['transport'] = GEMINI_TRANSPORT
+    if GEMINI_API_KEY or options:
+        genai.configure(api_key=GEMINI_API_KEY, **options)
+
+
+def response_text(response):
+    return response.text.strip() if hasattr(response, 'text') else str(response)
+
+
+def call_stage(contents):
+    """Metrics stage name for a call: vision when the contents carry an image"""
+    if isinstance(contents, (list, tuple)) and any(not isinstance(part, str) for part in contents):
+        return 'gemini_vision'
+    return 'gemini_text'
+
+
+def chunk_text(chunk):
+    """Text of one streamed chunk ('' for chunks without text parts)"""
+    try:
+        return chunk.text
+    except (ValueError, IndexError):
+        return ''
+
+
+class LLMClient:
+    """Reusable Gemini model with an asyncio call layer"""
+
+    def __init__(self, model_name=GEMINI_MODEL, timeout=LLM_TIMEOUT, max_concurrency=LLM_MAX_CONCURRENCY,
+                 max_retries=LLM_MAX_RETRIES, backoff_base=LLM_BACKOFF_BASE, backoff_max=LLM_BACKOFF_MAX):
+        self.model_name = model_name
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._loop = None
+        self._semaphore = None
+        self._model = None
+        self._executor = None
+
+        self._stats_lock = threading.Lock()
+        self._stats = {'calls': 0, 'succeeded': 0, 'failed': 0, 'retries': 0, 'timeouts': 0, 'in_flight': 0}
+        self._total_latency = 0.0
+
+    # Event loop / model lifecycle
+
+    def _ensure_started(self):
+        # One loop thread per process; re-created after fork
+        if self._loop is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._loop is not None and self._pid == os.getpid():
+                return
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+
+            def run():
+                asyncio.set_event_loop(loop)
+                self._semaphore = asyncio.Semaphore(self.max_concurrency)
+                ready.set()
+                loop.run_forever()
+
+            threading.Thread(target=run, name='llm-client-loop', daemon=True).start()
+            ready.wait()
+            if self._pid is not None:
+                # Forked from a process that already made calls: its cached asyncio
+                # client is bound to the parent's (now dead) loop
+                genai.client._client_manager.clients.pop('generative_async', None)
+            self._model = genai.GenerativeModel(self.model_name)
+            # Blocking transports (rest) run in a bounded pool instead of native asyncio
+            self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='llm-client')
+            self._pid = os.getpid()
+            self._loop = loop
+            print(f"[DEBUG] LLM client started ({self.model_name}, max_concurrency={self.max_concurrency}, timeout={self.timeout}s)")
+
+    @property
+    def model(self):
+        """The shared GenerativeModel (created once, reused for every call)"""
+        self._ensure_started()
+        return self._model
+
+    @property
+    def _native_async(self):
+        return GEMINI_TRANSPORT != 'rest'
+
+    # Async API
+
+    async def _call_once(self, contents, **kwargs):
+        if self._native_async:
+            return await self._model.generate_content_async(contents, **kwargs)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, lambda: self._model.generate_content(contents, **kwargs))
+
+    def _backoff(self, attempt):
+        # Full jitter: uniform in [0, min(max, base * 2^attempt)]
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    async def generate_async(self, contents, timeout=None, **kwargs):
+        """Generate text for a prompt (or [prompt, image] list) with timeout, concurrency limit and retries"""
+        timeout = timeout or self.timeout
+        self._count('calls')
+        started = time.perf_counter()
+        async with self._semaphore:
+            self._count('in_flight', 1)
+            try:
+                attempt = 0
+                while True:
+                    try:
+                        response = await asyncio.wait_for(self._call_once(contents, **kwargs), timeout)
+                        text = response_text(response)
+                        self._count('succeeded')
+                        return text
+                    except RETRYABLE_ERRORS as e:
+                        if isinstance(e, asyncio.TimeoutError):
+                            self._count('timeouts')
+                        if attempt >= self.max_retries:
+                            self._count('failed')
+                            raise
+                        delay = self._backoff(attempt)
+                        attempt += 1
+                        self._count('retries')
+                        print(f"[DEBUG] LLM call failed ({type(e).__name__}), retry {attempt}/{self.max_retries} in {delay:.2f}s")
+                        await asyncio.sleep(delay)
+                    except Exception:
+                        self._count('failed')
+                        raise
+            finally:
+                self._count('in_flight', -1)
+                elapsed = time.perf_counter() - started
+                observe_stage(call_stage(contents), elapsed)
+                with self._stats_lock:
+                    self._total_latency += elapsed
+
+    async def _stream_chunks(self, contents, **kwargs):
+        if self._native_async:
+            response = await self._model.generate_content_async(contents, stream=True, **kwargs)
+            async for chunk in response:
+                yield chunk_text(chunk)
+            return
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(
+            self._executor, lambda: self._model.generate_content(contents, stream=True, **kwargs)
+        )
+        iterator = iter(response)
+        finished = object()
+        while True:
+            chunk = await loop.run_in_executor(self._executor, next, iterator, finished)
+            if chunk is finished:
+                return
+            yield chunk_text(chunk)
+
+    async def stream_async(self, contents, timeout=None, **kwargs):
+        """
+        Async generator of text chunks as Gemini produces them.
+
+        `timeout` bounds the wait for each chunk. Retries only happen before the
+        first chunk arrives - after that a partial reply can't be replayed.
+        """
+        timeout = timeout or self.timeout
+        self._count('calls')
+        started = time.perf_counter()
+        async with self._semaphore:
+            self._count('in_flight', 1)
+            try:
+                attempt = 0
+                while True:
+                    chunks = self._stream_chunks(contents, **kwargs)
+                    try:
+                        first = await asyncio.wait_for(chunks.__anext__(), timeout)
+                        break
+                    except StopAsyncIteration:
+                        self._count('succeeded')
+                        return
+                    except RETRYABLE_ERRORS as e:
+                        if isinstance(e, asyncio.TimeoutError):
+                            self._count('timeouts')
+                        if attempt >= self.max_retries:
+                            self._count('failed')
+                            raise
+                        delay = self._backoff(attempt)
+                        attempt += 1
+                        self._count('retries')
+                        print(f"[DEBUG] LLM stream failed ({type(e).__name__}), retry {attempt}/{self.max_retries} in {delay:.2f}s")
+                        await asyncio.sleep(delay)
+                    except Exception:
+                        self._count('failed')
+                        raise
+
+                yield first
+                try:
+                    while True:
+                        try:
+                            yield await asyncio.wait_for(chunks.__anext__(), timeout)
+                        except StopAsyncIteration:
+                            break
+                except Exception:
+                    self._count('failed')
+                    raise
+                self._count('succeeded')
+            finally:
+                self._count('in_flight', -1)
+                elapsed = time.perf_counter() - started
+                observe_stage('gemini_stream', elapsed)
+                with self._stats_lock:
+                    self._total_latency += elapsed
+
+    # Sync wrappers for Flask request threads
+
+    def submit(self, contents, timeout=None, **kwargs):
+        """Schedule a call on the client loop; returns a concurrent.futures.Future of the text"""
+        self._ensure_started()
+        return asyncio.run_coroutine_threadsafe(self.generate_async(contents, timeout=timeout, **kwargs), self._loop)
+
+    def generate(self, contents, timeout=None, **kwargs):
+        """Blocking call; the wait is bounded by the retries' timeouts and backoff"""
+        return self.submit(contents, timeout=timeout, **kwargs).result()
+
+    def stream(self, contents, timeout=None, **kwargs):
+        """Blocking generator of text chunks, fed from the client loop"""
+        self._ensure_started()
+        chunks = queue.Queue()
+        finished = object()
+
+        async def pump():
+            try:
+                async for text in self.stream_async(contents, timeout=timeout, **kwargs):
+                    if text:
+                        chunks.put(text)
+                chunks.put(finished)
+            except BaseException as e:
+                chunks.put(e)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+
+        future = asyncio.run_coroutine_threadsafe(pump(), self._loop)
+        try:
+            while True:
+                item = chunks.get()
+                if item is finished:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            # Consumer went away (e.g. client disconnected): stop generating
+            future.cancel()
+
+    # Stats
+
+    def _count(self, name, delta=1):
+        with self._stats_lock:
+            self._stats[name] += delta
+
+    def get_stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+            finished = stats['succeeded'] + stats['failed']
+            stats['avg_latency_ms'] = (self._total_latency / finished * 1000) if finished else 0.0
+        stats['max_concurrency'] = self.max_concurrency
+        stats['timeout'] = self.timeout
+        return stats
+
+
+configure_gemini()
+
+# Shared client for the whole process
+llm = LLMClient()
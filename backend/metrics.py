@@ -0,0 +1,210 @@
+"""
+Lightweight Prometheus-style metrics for the hot paths.
+
+Counters and histograms are plain in-process numbers behind a lock: recording
+is a dict lookup, a bisect over the bucket bounds and a few additions, so it
+is cheap enough to leave on in production. Stats that other modules already
+keep (caches, DB pool, Gemini client) are read through callbacks at scrape
+time instead of being duplicated here.
+
+`render()` returns the Prometheus text exposition format served at /metrics.
+Values are per process - with several gunicorn workers each scrape sees the
+worker that answered it, so aggregate with sum()/rate() across scrapes or run
+Prometheus against each worker.
+"""
+
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+
+# Seconds; covers cache hits (~ms) up to slow Gemini calls
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic count, optionally split by labels"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for label_values, value in items:
+            yield self.name, _format_labels(self.label_names, label_values), value
+
+
+class Histogram:
+    """Bucketed distribution with _bucket/_sum/_count series, optionally split by labels"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # label values -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        if not METRICS_ENABLED:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                series = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        """Observe the duration of the with-block"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def samples(self):
+        with self._lock:
+            items = [(label_values, list(series)) for label_values, series in self._values.items()]
+        for label_values, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series[:-1]):
+                cumulative += count
+                le = ('le', _format_value(bound))
+                yield self.name + '_bucket', _format_labels(self.label_names, label_values, le), cumulative
+            yield self.name + '_sum', _format_labels(self.label_names, label_values), series[-1]
+            yield self.name + '_count', _format_labels(self.label_names, label_values), cumulative
+
+
+class CallbackMetric:
+    """Counter or gauge whose values come from `func()` at scrape time ({label values tuple: value})"""
+
+    def __init__(self, name, help_text, kind, func, labels=()):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.func = func
+        self.label_names = tuple(labels)
+
+    def samples(self):
+        try:
+            values = self.func()
+        except Exception as e:
+            print(f"[ERROR] Metric {self.name} failed: {e}")
+            return
+        for label_values, value in values.items():
+            yield self.name, _format_labels(self.label_names, label_values), value
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self._register(Counter(name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, labels, buckets))
+
+    def callback(self, name, help_text, kind, func, labels=()):
+        with self._lock:
+            # Re-registering replaces the callback (e.g. after a module reload)
+            self._metrics[name] = CallbackMetric(name, help_text, kind, func, labels)
+
+    def render(self):
+        """Prometheus text exposition format (version 0.0.4)"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Hot-path metrics shared by the app modules
+request_duration = registry.histogram(
+    'gachirat_http_request_duration_seconds', 'HTTP request latency by route',
+    labels=('method', 'route', 'status')
+)
+stage_duration = registry.histogram(
+    'gachirat_stage_duration_seconds',
+    'Time spent in one pipeline stage (decode, preprocess, forward, gemini_text, gemini_vision, db_commit, ...)',
+    labels=('stage',)
+)
+classifications = registry.counter(
+    'gachirat_classifications_total', 'Food classifications by source (cache, resnet, gemini_fallback, failed)',
+    labels=('source',)
+)
+prompt_tokens = registry.histogram(
+    'gachirat_prompt_tokens', 'Estimated tokens per Gemini prompt by purpose (chat, summary, ...)',
+    labels=('purpose',), buckets=(32, 64, 128, 256, 512, 1024, 2048, 4096)
+)
+fallbacks = registry.counter(
+    'gachirat_classifier_fallbacks_total', 'Gemini vision fallbacks by reason (low_confidence, error)',
+    labels=('reason',)
+)
+
+
+def time_stage(stage):
+    """Context manager timing one stage into gachirat_stage_duration_seconds"""
+    return stage_duration.time(stage)
+
+
+def observe_stage(stage, seconds):
+    stage_duration.observe(seconds, stage)
+
+
+def render():
+    return registry.render()
@@ -0,0 +1,174 @@
+"""
+Versioned schema migrations.
+
+`create_all` only creates missing tables - it never changes an existing one,
+so indexes and other schema changes for live databases go here. Each
+migration has an increasing version and is recorded in `schema_migrations`
+once applied. Runs hold a Postgres advisory lock, so several containers
+starting at once apply each migration exactly once.
+
+Run at deploy (also called from init_db on startup unless MIGRATE_ON_STARTUP=0):
+
+    python migrations.py            # apply pending migrations
+    python migrations.py --status   # list applied / pending versions
+"""
+
+import argparse
+import time
+
+from sqlalchemy import text
+
+from database import engine
+
+# Arbitrary constant key for pg_advisory_lock
+MIGRATION_LOCK_ID = 428391
+
+
+def _is_partitioned(conn, table):
+    return conn.execute(text(
+        "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = :table"
+    ), {'table': table}).first() is not None
+
+
+def create_index_concurrently(conn, name, table, columns):
+    """
+    CREATE INDEX CONCURRENTLY (no write lock on the table) if it doesn't exist.
+
+    A failed concurrent build leaves an INVALID index behind that IF NOT EXISTS
+    would skip, so drop such leftovers first. Partitioned tables don't support
+    CONCURRENTLY; their indexes are built with a plain CREATE INDEX.
+    """
+    if _is_partitioned(conn, table):
+        conn.execute(text(f'CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})'))
+        return
+    invalid = conn.execute(text(
+        "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+        "WHERE c.relname = :name AND NOT i.indisvalid"
+    ), {'name': name}).first()
+    if invalid:
+        print(f"[DEBUG] Dropping invalid index {name} from an interrupted build")
+        conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {name}'))
+    conn.execute(text(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({columns})'))
+
+
+def drop_index_concurrently(conn, name):
+    """DROP INDEX CONCURRENTLY if it exists (plainly for an index on a partitioned table)"""
+    partitioned = conn.execute(text(
+        "SELECT 1 FROM pg_class WHERE relname = :name AND relkind = 'I'"
+    ), {'name': name}).first()
+    conn.execute(text(f"DROP INDEX {'' if partitioned else 'CONCURRENTLY '}IF EXISTS {name}"))
+
+
+def migration_composite_history_indexes(conn):
+    # get_relevant_history: WHERE user_id = ? AND conversation_state IN (...) ORDER BY timestamp DESC LIMIT n
+    create_index_concurrently(conn, 'ix_conversations_user_state_timestamp', 'conversations',
+                              'user_id, conversation_state, "timestamp" DESC')
+    # Last-food lookup and login recent foods: WHERE user_id = ? ORDER BY timestamp DESC LIMIT n
+    create_index_concurrently(conn, 'ix_food_logs_user_timestamp', 'food_logs', 'user_id, "timestamp" DESC')
+    # The composites' leading user_id column covers these, so they only cost writes now
+    drop_index_concurrently(conn, 'ix_conversations_user_id')
+    drop_index_concurrently(conn, 'ix_food_logs_user_id')
+
+
+def migration_keyset_indexes_and_rollups(conn):
+    # Keyset history pages: WHERE user_id = ? AND (timestamp, id) < (?, ?) ORDER BY timestamp DESC, id DESC
+    create_index_concurrently(conn, 'ix_conversations_user_timestamp_id', 'conversations',
+                              'user_id, "timestamp" DESC, id DESC')
+    create_index_concurrently(conn, 'ix_food_logs_user_timestamp_id', 'food_logs', 'user_id, "timestamp" DESC, id DESC')
+    # Same leading columns, so it serves every query the old (user_id, timestamp) index did
+    drop_index_concurrently(conn, 'ix_food_logs_user_timestamp')
+    # Rollups for food logged before they were maintained on insert (create_all made the tables)
+    import nutrition_stats
+    nutrition_stats.backfill(conn)
+
+
+def migration_partition_by_month(conn):
+    # Rebuilds both tables as monthly range partitions and copies the rows across
+    # (partitions.convert_table, one transaction per table; a no-op once partitioned)
+    from database import Conversation, FoodLog
+    from partitions import convert_table, ensure_partitions
+
+    convert_table(Conversation)
+    convert_table(FoodLog)
+    ensure_partitions()
+
+
+def migration_summary_last_conversation_at(conn):
+    # Lets summary updates bound their scan of `conversations` by timestamp (partition pruning)
+    conn.execute(text('ALTER TABLE conversation_summaries ADD COLUMN IF NOT EXISTS last_conversation_at TIMESTAMP'))
+    conn.execute(text(
+        'UPDATE conversation_summaries s SET last_conversation_at = c."timestamp" FROM conversations c '
+        'WHERE c.id = s.last_conversation_id AND c.user_id = s.user_id AND s.last_conversation_at IS NULL'
+    ))
+
+
+# (version, name, function(connection)). Functions run on an autocommit connection
+# (needed for CONCURRENTLY) and must be safe to re-run if interrupted.
+MIGRATIONS = [
+    (1, 'composite_history_indexes', migration_composite_history_indexes),
+    (2, 'keyset_indexes_and_rollups', migration_keyset_indexes_and_rollups),
+    (3, 'partition_by_month', migration_partition_by_month),
+    (4, 'summary_last_conversation_at', migration_summary_last_conversation_at),
+]
+
+
+def _ensure_table(conn):
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "version INTEGER PRIMARY KEY, name VARCHAR(255) NOT NULL, applied_at TIMESTAMP NOT NULL DEFAULT NOW())"
+    ))
+
+
+def applied_versions(conn):
+    _ensure_table(conn)
+    return {row[0] for row in conn.execute(text('SELECT version FROM schema_migrations'))}
+
+
+def migrate(target=None):
+    """Apply pending migrations up to `target` (default: all). Returns the versions applied."""
+    if engine.dialect.name != 'postgresql':
+        print(f"[DEBUG] Skipping migrations on {engine.dialect.name}")
+        return []
+    applied = []
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+        conn.execute(text('SELECT pg_advisory_lock(:id)'), {'id': MIGRATION_LOCK_ID})
+        try:
+            done = applied_versions(conn)
+            for version, name, apply in sorted(MIGRATIONS):
+                if version in done or (target is not None and version > target):
+                    continue
+                print(f"[DEBUG] Applying migration {version}: {name}")
+                started = time.perf_counter()
+                apply(conn)
+                conn.execute(text('INSERT INTO schema_migrations (version, name) VALUES (:version, :name)'),
+                             {'version': version, 'name': name})
+                print(f"[DEBUG] Migration {version} applied in {time.perf_counter() - started:.2f}s")
+                applied.append(version)
+        finally:
+            conn.execute(text('SELECT pg_advisory_unlock(:id)'), {'id': MIGRATION_LOCK_ID})
+    if not applied:
+        print("[DEBUG] Schema is up to date")
+    return applied
+
+
+def status():
+    with engine.connect() as conn:
+        done = applied_versions(conn)
+        conn.commit()
+    return [(version, name, version in done) for version, name, _ in sorted(MIGRATIONS)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Apply schema migrations')
+    parser.add_argument('--status', action='store_true', help='list migrations without applying them')
+    parser.add_argument('--target', type=int, help='apply up to this version only')
+    args = parser.parse_args()
+
+    if args.status:
+        for version, name, is_applied in status():
+            print(f"{version:>4}  {'applied' if is_applied else 'pending':<8} {name}")
+    else:
+        from database import init_db
+        init_db(run_migrations=False)
+        migrate(args.target)
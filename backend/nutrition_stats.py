@@ -0,0 +1,159 @@
+"""
+Per-user nutrition rollups.
+
+`user_stats` (totals), `user_category_stats` (per category) and
+`user_daily_stats` (per UTC day) are incremented by upserts in the same
+transaction as each FoodLog insert, so they always agree with `food_logs`
+and reading a user's aggregates costs a primary-key lookup - not a scan
+over years of logs.
+
+Bulk imports add their rows with IMPORT_INCREMENT_CTES in the statement that
+inserts them. `backfill()` recomputes every rollup from `food_logs`;
+migration 2 runs it once for logs written before the rollups existed.
+"""
+
+from datetime import timedelta
+
+from sqlalchemy import func, text
+from sqlalchemy.dialects.postgresql import insert
+
+HEALTHY_CATEGORIES = ('fruit', 'vegetable')
+
+
+def is_healthy(category, health_score):
+    """Fruits and vegetables scoring 4+ (the foods that raise health)"""
+    return category in HEALTHY_CATEGORIES and health_score >= 4
+
+
+def record(db, user_id, category, health_score, timestamp):
+    """Add one food to the user's rollups; call in the transaction that inserts its FoodLog"""
+    from database import UserStats, UserCategoryStats, UserDailyStats
+
+    category = category or 'unknown'
+    healthy = 1 if is_healthy(category, health_score) else 0
+
+    totals = insert(UserStats).values(
+        user_id=user_id, food_count=1, health_score_sum=health_score, healthy_count=healthy,
+        first_food_at=timestamp, last_food_at=timestamp
+    )
+    db.execute(totals.on_conflict_do_update(index_elements=[UserStats.user_id], set_={
+        'food_count': UserStats.food_count + 1,
+        'health_score_sum': UserStats.health_score_sum + health_score,
+        'healthy_count': UserStats.healthy_count + healthy,
+        # Logs can arrive out of order (imports, backfills)
+        'first_food_at': func.least(UserStats.first_food_at, timestamp),
+        'last_food_at': func.greatest(UserStats.last_food_at, timestamp),
+    }))
+
+    per_category = insert(UserCategoryStats).values(
+        user_id=user_id, category=category, food_count=1, health_score_sum=health_score
+    )
+    db.execute(per_category.on_conflict_do_update(index_elements=[UserCategoryStats.user_id, UserCategoryStats.category], set_={
+        'food_count': UserCategoryStats.food_count + 1,
+        'health_score_sum': UserCategoryStats.health_score_sum + health_score,
+    }))
+
+    daily = insert(UserDailyStats).values(
+        user_id=user_id, day=timestamp.date(), food_count=1, health_score_sum=health_score, healthy_count=healthy
+    )
+    db.execute(daily.on_conflict_do_update(index_elements=[UserDailyStats.user_id, UserDailyStats.day], set_={
+        'food_count': UserDailyStats.food_count + 1,
+        'health_score_sum': UserDailyStats.health_score_sum + health_score,
+        'healthy_count': UserDailyStats.healthy_count + healthy,
+    }))
+
+
+def _average(total, count):
+    return round(total / count, 2) if count else None
+
+
+def get_stats(db, user_id, days=30):
+    """Totals, per-category counts and the last `days` daily buckets for a user"""
+    from database import UserStats, UserCategoryStats, UserDailyStats
+
+    totals = db.query(UserStats).filter(UserStats.user_id == user_id).first()
+    categories = db.query(UserCategoryStats).filter(UserCategoryStats.user_id == user_id).all()
+    daily = []
+    if totals is not None and totals.last_food_at is not None:
+        since = totals.last_food_at.date() - timedelta(days=days - 1)
+        daily = db.query(UserDailyStats).filter(
+            UserDailyStats.user_id == user_id, UserDailyStats.day >= since
+        ).order_by(UserDailyStats.day.desc()).all()
+
+    food_count = totals.food_count if totals else 0
+    return {
+        'food_count': food_count,
+        'healthy_count': totals.healthy_count if totals else 0,
+        'avg_health_score': _average(totals.health_score_sum, food_count) if totals else None,
+        'first_food_at': totals.first_food_at.isoformat() if totals and totals.first_food_at else None,
+        'last_food_at': totals.last_food_at.isoformat() if totals and totals.last_food_at else None,
+        'categories': {
+            c.category: {'food_count': c.food_count, 'avg_health_score': _average(c.health_score_sum, c.food_count)}
+            for c in sorted(categories, key=lambda c: -c.food_count)
+        },
+        'daily': [
+            {'day': d.day.isoformat(), 'food_count': d.food_count, 'healthy_count': d.healthy_count,
+             'avg_health_score': _average(d.health_score_sum, d.food_count)}
+            for d in daily
+        ],
+    }
+
+
+BACKFILL_SQL = [
+    """INSERT INTO user_stats (user_id, food_count, health_score_sum, healthy_count, first_food_at, last_food_at)
+       SELECT user_id, count(*), coalesce(sum(health_score), 0),
+              count(*) FILTER (WHERE category IN ('fruit', 'vegetable') AND health_score >= 4),
+              min("timestamp"), max("timestamp")
+       FROM food_logs WHERE user_id IS NOT NULL GROUP BY user_id
+       ON CONFLICT (user_id) DO UPDATE SET food_count = excluded.food_count,
+           health_score_sum = excluded.health_score_sum, healthy_count = excluded.healthy_count,
+           first_food_at = excluded.first_food_at, last_food_at = excluded.last_food_at""",
+    """INSERT INTO user_category_stats (user_id, category, food_count, health_score_sum)
+       SELECT user_id, coalesce(category, 'unknown'), count(*), coalesce(sum(health_score), 0)
+       FROM food_logs WHERE user_id IS NOT NULL GROUP BY user_id, coalesce(category, 'unknown')
+       ON CONFLICT (user_id, category) DO UPDATE SET food_count = excluded.food_count,
+           health_score_sum = excluded.health_score_sum""",
+    """INSERT INTO user_daily_stats (user_id, day, food_count, health_score_sum, healthy_count)
+       SELECT user_id, "timestamp"::date, count(*), coalesce(sum(health_score), 0),
+              count(*) FILTER (WHERE category IN ('fruit', 'vegetable') AND health_score >= 4)
+       FROM food_logs WHERE user_id IS NOT NULL AND "timestamp" IS NOT NULL GROUP BY user_id, "timestamp"::date
+       ON CONFLICT (user_id, day) DO UPDATE SET food_count = excluded.food_count,
+           health_score_sum = excluded.health_score_sum, healthy_count = excluded.healthy_count""",
+]
+
+
+# Data-modifying CTEs that add the rows of a preceding CTE named `inserted`
+# (user_id, category, health_score, "timestamp" - an INSERT ... RETURNING)
+# to the rollups, as increments like record() rather than recomputed totals
+IMPORT_INCREMENT_CTES = """
+    import_totals AS (
+       INSERT INTO user_stats (user_id, food_count, health_score_sum, healthy_count, first_food_at, last_food_at)
+       SELECT user_id, count(*), coalesce(sum(health_score), 0),
+              count(*) FILTER (WHERE category IN ('fruit', 'vegetable') AND health_score >= 4),
+              min("timestamp"), max("timestamp")
+       FROM inserted WHERE user_id IS NOT NULL GROUP BY user_id
+       ON CONFLICT (user_id) DO UPDATE SET food_count = user_stats.food_count + excluded.food_count,
+           health_score_sum = user_stats.health_score_sum + excluded.health_score_sum,
+           healthy_count = user_stats.healthy_count + excluded.healthy_count,
+           first_food_at = least(user_stats.first_food_at, excluded.first_food_at),
+           last_food_at = greatest(user_stats.last_food_at, excluded.last_food_at)),
+    import_categories AS (
+       INSERT INTO user_category_stats (user_id, category, food_count, health_score_sum)
+       SELECT user_id, coalesce(category, 'unknown'), count(*), coalesce(sum(health_score), 0)
+       FROM inserted WHERE user_id IS NOT NULL GROUP BY user_id, coalesce(category, 'unknown')
+       ON CONFLICT (user_id, category) DO UPDATE SET food_count = user_category_stats.food_count + excluded.food_count,
+           health_score_sum = user_category_stats.health_score_sum + excluded.health_score_sum),
+    import_daily AS (
+       INSERT INTO user_daily_stats (user_id, day, food_count, health_score_sum, healthy_count)
+       SELECT user_id, "timestamp"::date, count(*), coalesce(sum(health_score), 0),
+              count(*) FILTER (WHERE category IN ('fruit', 'vegetable') AND health_score >= 4)
+       FROM inserted WHERE user_id IS NOT NULL AND "timestamp" IS NOT NULL GROUP BY user_id, "timestamp"::date
+       ON CONFLICT (user_id, day) DO UPDATE SET food_count = user_daily_stats.food_count + excluded.food_count,
+           health_score_sum = user_daily_stats.health_score_sum + excluded.health_score_sum,
+           healthy_count = user_daily_stats.healthy_count + excluded.healthy_count)"""
+
+
+def backfill(conn):
+    """Recompute every rollup from food_logs (idempotent; run while food logs aren't being written)"""
+    for statement in BACKFILL_SQL:
+        conn.execute(text(statement))
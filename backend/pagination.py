@@ -0,0 +1,65 @@
+"""
+Keyset pagination over (timestamp, id), newest first.
+
+OFFSET pages get slower the deeper they go - Postgres still reads and
+discards every skipped row - and shift when rows are inserted between
+requests. A keyset page instead starts right after the last row of the
+previous one:
+
+    WHERE (timestamp, id) < (:ts, :id) ORDER BY timestamp DESC, id DESC LIMIT n + 1
+
+which is one descent of the (user_id, timestamp DESC, id DESC) index at any
+depth. The cursor is the last row's timestamp and id, url-safe base64 encoded
+so clients treat it as opaque.
+"""
+
+import base64
+import binascii
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+class InvalidCursor(ValueError):
+    """The cursor or page size a client sent can't be used"""
+
+
+def encode_cursor(timestamp, row_id):
+    raw = f"{timestamp.isoformat()},{row_id}".encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """(timestamp, id) from a cursor made by encode_cursor"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        timestamp, row_id = raw.rsplit(',', 1)
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise InvalidCursor(f"Invalid cursor: {cursor!r}") from e
+
+
+def parse_limit(value):
+    if value is None:
+        return DEFAULT_PAGE_SIZE
+    try:
+        limit = int(value)
+    except ValueError:
+        raise InvalidCursor(f"Invalid limit: {value!r}")
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def keyset_page(query, model, cursor=None, limit=DEFAULT_PAGE_SIZE):
+    """One page of `query` newest first; returns (rows, next_cursor or None)"""
+    if cursor:
+        timestamp, row_id = decode_cursor(cursor)
+        query = query.filter(tuple_(model.timestamp, model.id) < tuple_(timestamp, row_id))
+    # One extra row says whether another page exists without a COUNT
+    rows = query.order_by(model.timestamp.desc(), model.id.desc()).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1].timestamp, rows[-1].id)
@@ -0,0 +1,395 @@
+"""
+Monthly range partitioning of conversations and food_logs.
+
+Both tables are partitioned on `timestamp`. There is one partition per
+calendar month (`conversations_2025_06`) plus a DEFAULT partition that
+catches rows outside them, so an insert never fails for lack of a partition.
+Every month's indexes are small, inserts only touch the current month's
+indexes, and vacuum works on one month at a time. History lookups that bound
+`timestamp` (get_relevant_history, see HISTORY_LOOKBACK_DAYS) are pruned to
+the recent partitions.
+
+- ensure_partitions() creates the current month and the next
+  PARTITION_MONTHS_AHEAD. If the default partition holds rows for a month,
+  that month's partition is created with the rows moved into it. It runs
+  from init_db, and every PARTITION_MAINTENANCE_INTERVAL seconds in each
+  worker (partition_maintainer).
+- archive_expired() streams each partition older than
+  CONVERSATION_RETENTION_MONTHS / FOOD_LOG_RETENTION_MONTHS (0 keeps
+  everything, the default) to ARCHIVE_DIR/<partition>.csv.gz with COPY,
+  then detaches and drops it. Nutrition rollups keep counting archived food.
+- restore_archive() loads such a file back into its month.
+
+DDL is serialized across processes with a transaction-scoped advisory lock.
+
+    python partitions.py --status
+    python partitions.py --ensure
+    python partitions.py --archive                 # apply the retention settings now
+    python partitions.py --restore archive/conversations_2024_01.csv.gz
+"""
+
+import argparse
+import gzip
+import os
+import re
+import threading
+import time
+from datetime import date, datetime
+
+from sqlalchemy import text
+
+from database import engine
+
+PARTITIONED_TABLES = ('conversations', 'food_logs')
+PARTITION_MONTHS_AHEAD = int(os.environ.get('PARTITION_MONTHS_AHEAD', 3))
+PARTITION_MAINTENANCE_INTERVAL = float(os.environ.get('PARTITION_MAINTENANCE_INTERVAL', 6 * 3600))
+CONVERSATION_RETENTION_MONTHS = int(os.environ.get('CONVERSATION_RETENTION_MONTHS', 0))
+FOOD_LOG_RETENTION_MONTHS = int(os.environ.get('FOOD_LOG_RETENTION_MONTHS', 0))
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', 'archive')
+
+RETENTION_MONTHS = {'conversations': CONVERSATION_RETENTION_MONTHS, 'food_logs': FOOD_LOG_RETENTION_MONTHS}
+
+# Arbitrary constant key for pg_advisory_xact_lock (migrations use 428391, ESP32 heartbeats 428392)
+PARTITION_LOCK_ID = 428393
+
+_PARTITION_NAME = re.compile(r'^(?P<table>\w+)_(?P<year>\d{4})_(?P<month>\d{2})$')
+
+
+def month_start(value):
+    return date(value.year, value.month, 1)
+
+
+def add_months(month, months):
+    years, index = divmod(month.month - 1 + months, 12)
+    return date(month.year + years, index + 1, 1)
+
+
+def partition_name(table, month):
+    return f"{table}_{month:%Y_%m}"
+
+
+def default_partition(table):
+    return f"{table}_default"
+
+
+def parse_partition_name(name):
+    """(table, month) for a monthly partition name, or None"""
+    match = _PARTITION_NAME.match(name)
+    if not match or match.group('table') not in PARTITIONED_TABLES:
+        return None
+    return match.group('table'), date(int(match.group('year')), int(match.group('month')), 1)
+
+
+def _lock(conn):
+    conn.execute(text('SELECT pg_advisory_xact_lock(:id)'), {'id': PARTITION_LOCK_ID})
+
+
+def is_partitioned(conn, table):
+    return conn.execute(text(
+        "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = :table"
+    ), {'table': table}).first() is not None
+
+
+def list_partitions(conn, table):
+    """{month: partition name} of a table's monthly partitions (the default partition is left out)"""
+    names = conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = :table"
+    ), {'table': table}).scalars().all()
+    months = {}
+    for name in names:
+        parsed = parse_partition_name(name)
+        if parsed is not None and parsed[0] == table:
+            months[parsed[1]] = name
+    return months
+
+
+def _default_has_rows(conn, table, month):
+    default = default_partition(table)
+    if conn.execute(text('SELECT to_regclass(:name)'), {'name': default}).scalar() is None:
+        return False
+    return conn.execute(text(
+        f'SELECT 1 FROM {default} WHERE "timestamp" >= :lo AND "timestamp" < :hi LIMIT 1'
+    ), {'lo': month, 'hi': add_months(month, 1)}).first() is not None
+
+
+def create_month(conn, table, month):
+    """Create one month's partition, moving any of its rows out of the default partition"""
+    name = partition_name(table, month)
+    bounds = {'lo': month, 'hi': add_months(month, 1)}
+    default = default_partition(table)
+    values = f"FOR VALUES FROM ('{bounds['lo']}') TO ('{bounds['hi']}')"
+    if not _default_has_rows(conn, table, month):
+        conn.execute(text(f'CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} {values}'))
+        return 0
+    # Postgres refuses to add a partition while the default one holds rows for its range
+    conn.execute(text(f'CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'))
+    moved = conn.execute(text(
+        f'WITH moved AS (DELETE FROM {default} WHERE "timestamp" >= :lo AND "timestamp" < :hi RETURNING *) '
+        f'INSERT INTO {name} SELECT * FROM moved'
+    ), bounds).rowcount
+    conn.execute(text(f'ALTER TABLE {table} ATTACH PARTITION {name} {values}'))
+    print(f"[DEBUG] Moved {moved} rows from {default} into {name}")
+    return moved
+
+
+def ensure_partitions(now=None, months_ahead=PARTITION_MONTHS_AHEAD, since=None):
+    """
+    Create the default partition, the monthly ones from this month (or
+    `since`) to `months_ahead` months ahead, and past months the default
+    partition holds rows for. Tables that aren't partitioned yet are
+    skipped. Returns the names created.
+    """
+    if engine.dialect.name != 'postgresql':
+        return []
+    current = month_start(now or datetime.utcnow())
+    created = []
+    with engine.begin() as conn:
+        _lock(conn)
+        for table in PARTITIONED_TABLES:
+            if not is_partitioned(conn, table):
+                continue
+            conn.execute(text(f'CREATE TABLE IF NOT EXISTS {default_partition(table)} PARTITION OF {table} DEFAULT'))
+            first = first_wanted = current if since is None else min(current, month_start(since))
+            oldest_stray = conn.execute(text(f'SELECT min("timestamp") FROM {default_partition(table)}')).scalar()
+            if oldest_stray is not None:
+                first = min(first, month_start(oldest_stray))
+            existing = list_partitions(conn, table)
+            month = first
+            while month <= add_months(current, months_ahead):
+                # Past months without stray rows stay absent (they may have been archived)
+                if month not in existing and (month >= first_wanted or _default_has_rows(conn, table, month)):
+                    create_month(conn, table, month)
+                    created.append(partition_name(table, month))
+                month = add_months(month, 1)
+    if created:
+        print(f"[DEBUG] Created partitions: {', '.join(created)}")
+    return created
+
+
+def convert_table(model, months_ahead=PARTITION_MONTHS_AHEAD):
+    """
+    Replace an unpartitioned table with the model's partitioned one, copying
+    every row across in one transaction. Holds an ACCESS EXCLUSIVE lock for
+    the copy, so run it in a quiet window on large tables. Returns False if
+    the table was already partitioned.
+    """
+    table = model.__tablename__
+    legacy = f"{table}_unpartitioned"
+    columns = [column.name for column in model.__table__.columns]
+    with engine.begin() as conn:
+        _lock(conn)
+        if is_partitioned(conn, table):
+            return False
+        started = time.perf_counter()
+        # Free the names (table, sequence, indexes) the partitioned table is created with
+        conn.execute(text(f'ALTER TABLE {table} RENAME TO {legacy}'))
+        conn.execute(text(f'ALTER SEQUENCE IF EXISTS {table}_id_seq RENAME TO {legacy}_id_seq'))
+        for index_name in conn.execute(text('SELECT indexname FROM pg_indexes WHERE tablename = :legacy'),
+                                       {'legacy': legacy}).scalars().all():
+            if index_name == f"{table}_pkey":
+                conn.execute(text(f'ALTER TABLE {legacy} RENAME CONSTRAINT {table}_pkey TO {legacy}_pkey'))
+            else:
+                conn.execute(text(f'DROP INDEX {index_name}'))
+        model.__table__.create(conn)
+        conn.execute(text(f'CREATE TABLE {default_partition(table)} PARTITION OF {table} DEFAULT'))
+
+        oldest = conn.execute(text(f'SELECT min("timestamp") FROM {legacy}')).scalar()
+        current = month_start(datetime.utcnow())
+        month = min(current, month_start(oldest)) if oldest else current
+        while month <= add_months(current, months_ahead):
+            create_month(conn, table, month)
+            month = add_months(month, 1)
+
+        # The partition key is NOT NULL now
+        quoted = [f'"{name}"' for name in columns]
+        selected = ["COALESCE(\"timestamp\", now() AT TIME ZONE 'utc')" if name == 'timestamp' else f'"{name}"'
+                    for name in columns]
+        copied = conn.execute(text(
+            f"INSERT INTO {table} ({', '.join(quoted)}) SELECT {', '.join(selected)} FROM {legacy}"
+        )).rowcount
+        conn.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), GREATEST((SELECT max(id) FROM {table}), 1))"
+        ))
+        conn.execute(text(f'DROP TABLE {legacy}'))
+    print(f"[DEBUG] Partitioned {table} by month ({copied} rows) in {time.perf_counter() - started:.1f}s")
+    return True
+
+
+# Retention
+
+def archive_path(name, archive_dir=ARCHIVE_DIR):
+    """<archive_dir>/<name>.csv.gz, or <name>.<n>.csv.gz if the month was archived before"""
+    path = os.path.join(archive_dir, f"{name}.csv.gz")
+    copy = 1
+    while os.path.exists(path):
+        copy += 1
+        path = os.path.join(archive_dir, f"{name}.{copy}.csv.gz")
+    return path
+
+
+def archive_partition(table, name, archive_dir=ARCHIVE_DIR):
+    """COPY one partition to a .csv.gz in archive_dir, then detach and drop it. Returns (rows, path)."""
+    os.makedirs(archive_dir, exist_ok=True)
+    path = archive_path(name, archive_dir)
+    partial = path + '.partial'
+    connection = engine.raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s)', (PARTITION_LOCK_ID,))
+            cursor.execute('SELECT to_regclass(%s)', (name,))
+            if cursor.fetchone()[0] is None:
+                connection.rollback()
+                return 0, None
+            # No writes to the partition between the copy and the drop
+            cursor.execute(f'LOCK TABLE {name} IN SHARE MODE')
+            cursor.execute(f'SELECT count(*) FROM {name}')
+            rows = cursor.fetchone()[0]
+            with open(partial, 'wb') as raw:
+                with gzip.GzipFile(fileobj=raw, mode='wb') as out:
+                    cursor.copy_expert(f'COPY {name} TO STDOUT WITH (FORMAT csv, HEADER)', out)
+                raw.flush()
+                os.fsync(raw.fileno())
+            # The file is complete and on disk before the rows go
+            os.replace(partial, path)
+            cursor.execute(f'ALTER TABLE {table} DETACH PARTITION {name}')
+            cursor.execute(f'DROP TABLE {name}')
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    finally:
+        connection.close()
+    print(f"[DEBUG] Archived {rows} rows of {name} to {path}")
+    return rows, path
+
+
+def archive_expired(now=None, archive_dir=ARCHIVE_DIR, retention=None):
+    """Archive every partition whose month ended before its table's retention window. Returns [(name, rows, path)]."""
+    if engine.dialect.name != 'postgresql':
+        return []
+    current = month_start(now or datetime.utcnow())
+    archived = []
+    for table, months in (retention or RETENTION_MONTHS).items():
+        if months <= 0:
+            continue
+        cutoff = add_months(current, -months)
+        with engine.connect() as conn:
+            if not is_partitioned(conn, table):
+                continue
+            expired = sorted((month, name) for month, name in list_partitions(conn, table).items()
+                             if add_months(month, 1) <= cutoff)
+        for month, name in expired:
+            archived.append((name, *archive_partition(table, name, archive_dir)))
+    return archived
+
+
+def restore_archive(path):
+    """Load an archive written by archive_partition back into its month's partition. Returns rows loaded."""
+    name = os.path.basename(path).split('.')[0]
+    parsed = parse_partition_name(name)
+    if parsed is None:
+        raise ValueError(f"{path} is not named like a partition archive (<table>_YYYY_MM.csv.gz)")
+    table, month = parsed
+    with engine.begin() as conn:
+        _lock(conn)
+        create_month(conn, table, month)
+        with conn.connection.dbapi_connection.cursor() as cursor, gzip.open(path, 'rb') as source:
+            cursor.copy_expert(f'COPY {table} FROM STDIN WITH (FORMAT csv, HEADER)', source)
+            rows = cursor.rowcount
+    print(f"[DEBUG] Restored {rows} rows into {name} (archived again by the next maintenance run "
+          f"if it is still outside the retention window)")
+    return rows
+
+
+def status():
+    """Per table: partitions with estimated rows and size, oldest first"""
+    result = {}
+    with engine.connect() as conn:
+        for table in PARTITIONED_TABLES:
+            if not is_partitioned(conn, table):
+                result[table] = {'partitioned': False}
+                continue
+            rows = conn.execute(text(
+                "SELECT c.relname, greatest(c.reltuples, 0)::bigint, pg_total_relation_size(c.oid) "
+                "FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                "JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = :table ORDER BY c.relname"
+            ), {'table': table}).all()
+            result[table] = {
+                'partitioned': True,
+                'retention_months': RETENTION_MONTHS[table],
+                'partitions': [{'name': name, 'estimated_rows': estimate, 'bytes': size} for name, estimate, size in rows],
+            }
+    return result
+
+
+class PartitionMaintainer:
+    """Background thread that keeps partitions ahead of time and applies retention"""
+
+    def __init__(self, interval=PARTITION_MAINTENANCE_INTERVAL):
+        self.interval = interval
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.last_run = None
+        self.last_error = None
+
+    def start(self):
+        """Start this process's maintenance thread (idempotent; re-started after fork)"""
+        if engine.dialect.name != 'postgresql' or self.interval <= 0:
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._loop, name='partition-maintainer', daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        # init_db already ran a pass at startup
+        while True:
+            time.sleep(self.interval)
+            self.run_once()
+
+    def run_once(self):
+        try:
+            ensure_partitions()
+            archive_expired()
+            self.last_error = None
+        except Exception as e:
+            print(f"[ERROR] Partition maintenance failed: {e}")
+            self.last_error = str(e)
+        self.runs += 1
+        self.last_run = datetime.utcnow().isoformat()
+
+
+partition_maintainer = PartitionMaintainer()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Monthly partitions of conversations and food_logs')
+    parser.add_argument('--status', action='store_true', help='list partitions with estimated rows and size')
+    parser.add_argument('--ensure', action='store_true', help='create the partitions for the coming months')
+    parser.add_argument('--archive', action='store_true', help='archive partitions outside the retention window')
+    parser.add_argument('--archive-dir', default=ARCHIVE_DIR)
+    parser.add_argument('--restore', metavar='FILE', help='load an archived partition back')
+    args = parser.parse_args()
+
+    if args.ensure:
+        ensure_partitions()
+    if args.archive:
+        for name, rows, path in archive_expired(archive_dir=args.archive_dir):
+            print(f"{name}: {rows} rows -> {path}")
+    if args.restore:
+        restore_archive(args.restore)
+    if args.status or not (args.ensure or args.archive or args.restore):
+        for table, info in status().items():
+            if not info['partitioned']:
+                print(f"{table}: not partitioned (run python migrations.py)")
+                continue
+            print(f"{table} (retention: {info['retention_months'] or 'keep all'} months)")
+            for partition in info['partitions']:
+                print(f"  {partition['name']:<28} ~{partition['estimated_rows']:>10} rows  {partition['bytes'] / 1e6:9.1f} MB")
@@ -0,0 +1,304 @@
+"""
+Push channel: Socket.IO events for health changes, emotion transitions and
+streamed bot replies.
+
+Browsers hold a WebSocket to the push service (push_server.py, gevent
+workers), never to the API workers. Events cross processes through Postgres
+LISTEN/NOTIFY - the same mechanism the history cache uses for invalidations -
+so no extra broker is needed:
+
+- API workers publish with a write-only PostgresNotifyManager: one
+  pg_notify on a dedicated connection per event, sent from a background
+  thread (PushQueue) so requests never wait on it. A streamed reply's
+  chunks are merged for up to PUSH_COALESCE_MS (at most
+  PUSH_CHUNK_MAX_CHARS per event) rather than sent one NOTIFY per token.
+- Every push worker LISTENs and delivers each event to the sockets it holds
+  in the target room (`user:<username>`).
+
+NOTIFY payloads are limited to 8000 bytes, so larger events are dropped and
+counted; every event here is a few hundred bytes at most.
+
+Sockets join a room only with a push token from /api/login: the username
+signed with SECRET_KEY, which the API and push service must share.
+"""
+
+import json
+import os
+import queue
+import select
+import threading
+import time
+
+import socketio
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from sqlalchemy import create_engine
+from sqlalchemy.pool import NullPool
+
+from esp32_manager import HAPPY, emotion_for_health
+from metrics import registry
+
+PUSH_ENABLED = os.environ.get('PUSH_ENABLED', '1') == '1'
+PUSH_CHANNEL = os.environ.get('PUSH_CHANNEL', 'push_events')
+
+# How long a reply chunk waits for later ones of its stream to be merged with it
+PUSH_COALESCE_MS = float(os.environ.get('PUSH_COALESCE_MS', 50))
+# Characters per merged chunk; JSON-escaped this stays well under the NOTIFY limit
+PUSH_CHUNK_MAX_CHARS = int(os.environ.get('PUSH_CHUNK_MAX_CHARS', 1000))
+PUSH_QUEUE_MAX = int(os.environ.get('PUSH_QUEUE_MAX', 10000))
+
+# Signs push tokens; without it no tokens are issued and every socket is rejected
+SECRET_KEY = os.environ.get('SECRET_KEY')
+PUSH_TOKEN_MAX_AGE = int(os.environ.get('PUSH_TOKEN_MAX_AGE', 7 * 24 * 3600))
+
+# Postgres rejects NOTIFY payloads of 8000 bytes or more
+NOTIFY_MAX_BYTES = 7900
+
+push_events = registry.counter(
+    'gachirat_push_events_total', 'Push channel events by type and result (published, dropped, coalesced)',
+    labels=('event', 'result')
+)
+
+
+def user_room(username):
+    return f"user:{username}"
+
+
+def _token_serializer():
+    return URLSafeTimedSerializer(SECRET_KEY, salt='push-channel')
+
+
+def issue_push_token(username):
+    """Signed token that lets a socket join `username`'s room (None without SECRET_KEY)"""
+    if not SECRET_KEY:
+        return None
+    return _token_serializer().dumps(username)
+
+
+def verify_push_token(token, max_age=PUSH_TOKEN_MAX_AGE):
+    """Username a push token was issued for, or None if it is missing, forged or expired"""
+    if not SECRET_KEY or not isinstance(token, str) or not token:
+        return None
+    try:
+        username = _token_serializer().loads(token, max_age=max_age)
+    except BadSignature:
+        return None
+    return username if isinstance(username, str) and username else None
+
+
+def mood_name(emotion):
+    # Frontend STATE_TABLE state for a resting emotion code
+    return 'happy' if emotion == HAPPY else 'sad'
+
+
+class PostgresNotifyManager(socketio.PubSubManager):
+    """Socket.IO client manager that fans events out across processes with LISTEN/NOTIFY"""
+
+    name = 'postgres'
+
+    def __init__(self, url=None, channel=PUSH_CHANNEL, write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.url = url
+        self._engine = None
+        self._connection = None
+        self._pid = None
+        self._publish_lock = threading.Lock()
+
+    def _connect(self):
+        if self._engine is None:
+            if self.url is None:
+                from database import engine
+                self.url = engine.url
+            # Unpooled: publisher and listener each keep one long-lived connection
+            self._engine = create_engine(self.url, poolclass=NullPool)
+        connection = self._engine.raw_connection()
+        connection.dbapi_connection.autocommit = True
+        return connection
+
+    def _close(self):
+        connection, self._connection = self._connection, None
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+    def _publish(self, data):
+        event = data.get('event') or data.get('method')
+        payload = json.dumps(data)
+        if len(payload.encode('utf-8')) > NOTIFY_MAX_BYTES:
+            print(f"[ERROR] Push event {event} is too large for NOTIFY ({len(payload)} bytes), dropped")
+            push_events.inc(event, 'dropped')
+            return
+        with self._publish_lock:
+            # One reconnect attempt: the connection may have been dropped or inherited across fork
+            for attempt in range(2):
+                try:
+                    if self._connection is None or self._pid != os.getpid():
+                        self._connection = self._connect()
+                        self._pid = os.getpid()
+                    with self._connection.cursor() as cursor:
+                        cursor.execute('SELECT pg_notify(%s, %s)', (self.channel, payload))
+                    push_events.inc(event, 'published')
+                    return
+                except Exception as e:
+                    self._close()
+                    if attempt:
+                        print(f"[ERROR] Push publish failed: {e}")
+                        push_events.inc(event, 'dropped')
+
+    def _listen(self):
+        """Yield NOTIFY payloads forever, reconnecting after errors"""
+        while True:
+            connection = None
+            try:
+                connection = self._connect()
+                dbapi_connection = connection.dbapi_connection
+                with dbapi_connection.cursor() as cursor:
+                    cursor.execute(f'LISTEN {self.channel}')
+                print(f"[DEBUG] Push channel listening on {self.channel} (pid {os.getpid()})")
+                while True:
+                    if select.select([dbapi_connection], [], [], 30) == ([], [], []):
+                        continue
+                    dbapi_connection.poll()
+                    while dbapi_connection.notifies:
+                        yield dbapi_connection.notifies.pop(0).payload
+            except Exception as e:
+                print(f"[ERROR] Push channel listener failed: {e}")
+                time.sleep(1)
+            finally:
+                if connection is not None:
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+
+
+# Write-only publisher for the API workers; created on first use
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+def get_publisher():
+    global _publisher
+    if _publisher is None:
+        with _publisher_lock:
+            if _publisher is None:
+                _publisher = PostgresNotifyManager(write_only=True)
+    return _publisher
+
+
+def emit(event, data, username):
+    try:
+        get_publisher().emit(event, data, room=user_room(username))
+    except Exception as e:
+        print(f"[ERROR] Push {event} for {username} failed: {e}")
+
+
+def coalesce(events, max_chars=PUSH_CHUNK_MAX_CHARS):
+    """Merge each stream's consecutive reply_chunk events, keeping every stream's order"""
+    merged = []
+    open_chunks = {}  # stream_id -> index in merged of the chunk still taking tokens
+    for event, data, username in events:
+        if event == 'reply_chunk':
+            index = open_chunks.get(data['stream_id'])
+            if index is not None and len(merged[index][1]['token']) + len(data['token']) <= max_chars:
+                previous = merged[index][1]
+                merged[index] = (event, {**previous, 'token': previous['token'] + data['token']}, username)
+                push_events.inc(event, 'coalesced')
+                continue
+            open_chunks[data['stream_id']] = len(merged)
+        elif 'stream_id' in data:
+            # reply_done: later chunks of the stream (if any) must not jump ahead of it
+            open_chunks.pop(data['stream_id'], None)
+        merged.append((event, data, username))
+    return merged
+
+
+class PushQueue:
+    """Publishes events from a background thread, coalescing streamed reply chunks"""
+
+    def __init__(self, coalesce_ms=PUSH_COALESCE_MS, max_chars=PUSH_CHUNK_MAX_CHARS, max_queued=PUSH_QUEUE_MAX,
+                 send=emit):
+        self.coalesce_interval = max(0.0, coalesce_ms) / 1000.0
+        self.max_chars = max_chars
+        self.max_queued = max_queued
+        self.send = send
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def _ensure_started(self):
+        # Started lazily (and re-started after fork) like the conversation writer
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.max_queued)
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._loop, name='push-publisher', daemon=True)
+            self._thread.start()
+
+    def put(self, event, data, username):
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((event, data, username))
+        except queue.Full:
+            push_events.inc(event, 'dropped')
+
+    def _collect(self):
+        """Block for the first event; a reply chunk then waits up to the interval for more"""
+        batch = [self._queue.get()]
+        linger = self.coalesce_interval if batch[0][0] == 'reply_chunk' else 0.0
+        deadline = time.perf_counter() + linger
+        while len(batch) < self.max_queued:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+        return batch
+
+    def _loop(self):
+        while True:
+            for event, data, username in coalesce(self._collect(), self.max_chars):
+                self.send(event, data, username)
+
+
+push_queue = PushQueue()
+
+
+def publish(event, data, username):
+    """Queue an event for every socket of a user; never blocks or raises into the request"""
+    if not PUSH_ENABLED:
+        return
+    push_queue.put(event, data, username)
+
+
+def push_health(username, old_health, new_health, health_change, origin=None):
+    """
+    Health update, plus an emotion event when it crosses the happy/sad threshold.
+
+    `origin` is the tab that made the change; it already has the result from
+    its own response and skips events carrying its id.
+    """
+    publish('health', {'health': new_health, 'health_change': health_change, 'origin': origin}, username)
+    old_emotion, new_emotion = emotion_for_health(old_health), emotion_for_health(new_health)
+    if old_emotion != new_emotion:
+        publish('emotion', {
+            'mood': mood_name(new_emotion), 'previous': mood_name(old_emotion), 'code': new_emotion, 'origin': origin
+        }, username)
+
+
+def push_reply_chunk(username, stream_id, token):
+    publish('reply_chunk', {'stream_id': stream_id, 'token': token}, username)
+
+
+def push_reply_done(username, stream_id, response):
+    publish('reply_done', {'stream_id': stream_id, **response}, username)
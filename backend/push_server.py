@@ -0,0 +1,75 @@
+"""
+Socket.IO push service (see push_channel.py).
+
+Runs apart from the API so that thousands of idle WebSockets cost a greenlet
+each instead of a gthread request thread. Clients connect with WebSocket
+transport only, so no sticky sessions are needed and any number of workers
+can sit behind nginx's /socket.io/ location:
+
+    gunicorn -k geventwebsocket.gunicorn.workers.GeventWebSocketWorker -w 2 -b 0.0.0.0:5001 push_server:app
+    python push_server.py     # dev server on PUSH_PORT (default 5001)
+
+Clients pass the push token from /api/login in the connect auth payload and
+are put in the room of the user it was signed for; events published by the
+API workers reach every room member. Connections without a valid token are
+rejected.
+"""
+
+from gevent import monkey
+
+monkey.patch_all()
+
+import os
+
+from flask import Flask, jsonify, request
+from flask_socketio import SocketIO, join_room
+
+from push_channel import SECRET_KEY, PostgresNotifyManager, user_room, verify_push_token
+
+PUSH_PORT = int(os.environ.get('PUSH_PORT', 5001))
+PUSH_PING_INTERVAL = int(os.environ.get('PUSH_PING_INTERVAL', 25))
+PUSH_PING_TIMEOUT = int(os.environ.get('PUSH_PING_TIMEOUT', 20))
+
+app = Flask(__name__)
+
+socketio = SocketIO(
+    app,
+    async_mode='gevent',
+    client_manager=PostgresNotifyManager(),
+    transports=['websocket'],
+    cors_allowed_origins=os.environ.get('PUSH_CORS_ORIGINS', '*'),
+    ping_interval=PUSH_PING_INTERVAL,
+    ping_timeout=PUSH_PING_TIMEOUT,
+)
+
+connections = {'connected': 0, 'rejected': 0, 'disconnected': 0}
+
+if not SECRET_KEY:
+    print("[ERROR] SECRET_KEY is not set: push tokens can't be verified, every connection will be rejected")
+
+
+@socketio.on('connect')
+def on_connect(auth):
+    # Never trust a bare username: only the one a valid token was signed for
+    token = auth.get('token') if isinstance(auth, dict) else None
+    username = verify_push_token(token or request.args.get('token'))
+    if not username:
+        connections['rejected'] += 1
+        return False
+    join_room(user_room(username))
+    connections['connected'] += 1
+
+
+@socketio.on('disconnect')
+def on_disconnect():
+    connections['disconnected'] += 1
+
+
+@app.route('/stats', methods=['GET'])
+def push_stats():
+    """Connections accepted and closed by this push worker"""
+    return jsonify({**connections, 'open': connections['connected'] - connections['disconnected'], 'pid': os.getpid()})
+
+
+if __name__ == '__main__':
+    socketio.run(app, host='0.0.0.0', port=PUSH_PORT)
@@ -0,0 +1,160 @@
+"""
+Response cache for LLM prompts that are determined by a small input space.
+
+The /api/feed verdict depends only on (food_name, category, health bucket) and
+the new-user greeting only on the username (templated out), so their replies
+can be reused. Each key keeps up to RESPONSE_CACHE_VARIANTS distinct replies
+which are handed out round-robin, so users don't see the same line every time.
+Once a key has one reply, the remaining variants are generated in the
+background while cached ones are served.
+
+Keys are evicted LRU (RESPONSE_CACHE_MAX_KEYS) and variants expire after
+RESPONSE_CACHE_TTL seconds.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+RESPONSE_CACHE_VARIANTS = int(os.environ.get('RESPONSE_CACHE_VARIANTS', 3))
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', 24 * 3600))
+RESPONSE_CACHE_MAX_KEYS = int(os.environ.get('RESPONSE_CACHE_MAX_KEYS', 1024))
+RESPONSE_CACHE_FILL_WORKERS = int(os.environ.get('RESPONSE_CACHE_FILL_WORKERS', 4))
+
+
+class _Entry:
+    __slots__ = ('variants', 'next_index', 'filling')
+
+    def __init__(self):
+        self.variants = []  # [(text, created_at)]
+        self.next_index = 0
+        self.filling = False
+
+
+class PromptResponseCache:
+    """Several rotating replies per key with LRU/TTL eviction"""
+
+    def __init__(self, variants=RESPONSE_CACHE_VARIANTS, ttl=RESPONSE_CACHE_TTL, max_keys=RESPONSE_CACHE_MAX_KEYS):
+        self.variants = max(1, variants)
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+        self._counters = {'hits': 0, 'misses': 0, 'background_fills': 0, 'fill_errors': 0, 'evictions': 0}
+
+    def _get_executor(self):
+        # Created per process so a pre-forked worker never inherits dead threads
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=RESPONSE_CACHE_FILL_WORKERS, thread_name_prefix='response-cache')
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def _live_entry(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if self.ttl > 0:
+            entry.variants = [(text, created) for text, created in entry.variants if now - created <= self.ttl]
+        return entry
+
+    def get(self, key, generate):
+        """
+        Return a cached reply for `key`, or call `generate()` (blocking) on a miss.
+
+        On a hit with fewer than the target number of variants, one more is
+        generated in the background.
+        """
+        now = time.time()
+        fill = False
+        with self._lock:
+            entry = self._live_entry(key, now)
+            if entry is not None and entry.variants:
+                self._entries.move_to_end(key)
+                text = entry.variants[entry.next_index % len(entry.variants)][0]
+                entry.next_index += 1
+                if len(entry.variants) < self.variants and not entry.filling:
+                    entry.filling = fill = True
+                self._counters['hits'] += 1
+            else:
+                text = None
+                self._counters['misses'] += 1
+
+        if text is not None:
+            if fill:
+                self._get_executor().submit(self._fill, key, generate)
+            return text
+
+        text = generate()
+        self.add(key, text)
+        return text
+
+    def add(self, key, text):
+        """Store one more variant for `key` (ignored once the key is full)"""
+        now = time.time()
+        with self._lock:
+            entry = self._live_entry(key, now)
+            if entry is None:
+                entry = self._entries[key] = _Entry()
+            self._entries.move_to_end(key)
+            if len(entry.variants) < self.variants and text not in [t for t, _ in entry.variants]:
+                entry.variants.append((text, now))
+            while len(self._entries) > self.max_keys:
+                self._entries.popitem(last=False)
+                self._counters['evictions'] += 1
+
+    def _fill(self, key, generate):
+        try:
+            self.add(key, generate())
+            with self._lock:
+                self._counters['background_fills'] += 1
+        except Exception as e:
+            print(f"[ERROR] Response cache fill failed for {key}: {e}")
+            with self._lock:
+                self._counters['fill_errors'] += 1
+        finally:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    entry.filling = False
+
+    def prewarm(self, items, background=True):
+        """
+        Fill every (key, generate) pair up to the target number of variants.
+
+        Generation runs on the cache's small pool, so with background=False this
+        blocks until all keys are filled.
+        """
+        executor = self._get_executor()
+        futures = []
+        for key, generate in items:
+            with self._lock:
+                entry = self._live_entry(key, time.time())
+                missing = self.variants - (len(entry.variants) if entry else 0)
+            for _ in range(max(0, missing)):
+                futures.append(executor.submit(self._prewarm_one, key, generate))
+        print(f"[DEBUG] Response cache pre-warm: {len(futures)} replies queued")
+        if not background:
+            for future in futures:
+                future.result()
+        return futures
+
+    def _prewarm_one(self, key, generate):
+        try:
+            self.add(key, generate())
+        except Exception as e:
+            print(f"[ERROR] Response cache pre-warm failed for {key}: {e}")
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['keys'] = len(self._entries)
+            stats['variants'] = sum(len(e.variants) for e in self._entries.values())
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        stats['target_variants'] = self.variants
+        stats['ttl_seconds'] = self.ttl
+        return stats
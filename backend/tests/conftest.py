@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+# The backend modules import each other as top-level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def pytest_collection_modifyitems(config, items):
+    if os.environ.get('DATABASE_URL'):
+        return
+    skip = pytest.mark.skip(reason='needs DATABASE_URL pointing at a throwaway Postgres')
+    for item in items:
+        if 'database' in item.keywords:
+            item.add_marker(skip)
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'database: needs a Postgres at DATABASE_URL')
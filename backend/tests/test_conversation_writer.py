@@ -0,0 +1,31 @@
+import uuid
+
+import pytest
+
+pytestmark = pytest.mark.database
+
+
+@pytest.fixture
+def client(monkeypatch):
+    import app as app_module
+    from conversation_writer import ConversationWriter
+
+    writer = ConversationWriter(enabled=True, durability='sync', flush_ms=5)
+    monkeypatch.setattr(app_module, 'conversation_writer', writer)
+    monkeypatch.setattr(app_module, 'generate_llm_response', lambda prompt, word_limit=None: 'Squeak!')
+    monkeypatch.setattr(app_module.greetings, 'chat_logged', lambda user_id: None)
+    yield app_module.app.test_client()
+    writer.close()
+
+
+def test_write_behind_chat_from_new_user(client):
+    from database import Conversation, User, session_scope
+
+    username = f'writer_test_{uuid.uuid4().hex[:8]}'
+    response = client.post('/api/gemini', json={'input': 'hello there', 'username': username})
+
+    assert response.status_code == 200, response.get_json()
+    with session_scope() as db:
+        user = db.query(User).filter(User.username == username).one()
+        turns = db.query(Conversation).filter(Conversation.user_id == user.id).all()
+        assert [(turn.user_message, turn.bot_response) for turn in turns] == [('hello there', 'Squeak!')]
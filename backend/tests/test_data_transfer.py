@@ -0,0 +1,46 @@
+import uuid
+from datetime import datetime
+
+import pytest
+
+pytestmark = pytest.mark.database
+
+
+def test_food_log_import_adds_inserted_rows_to_rollups():
+    import nutrition_stats
+    from data_transfer import import_rows
+    from database import FoodLog, User, init_db, session_scope
+
+    init_db()
+    username = f'import_test_{uuid.uuid4().hex[:8]}'
+    with session_scope() as db:
+        user = User(username=username)
+        db.add(user)
+        db.flush()
+        logged_at = datetime(2026, 10, 5, 12, 0)
+        db.add(FoodLog(user_id=user.id, food_name='apple', category='fruit', health_score=5, timestamp=logged_at))
+        nutrition_stats.record(db, user.id, 'fruit', 5, logged_at)
+        db.commit()
+        user_id = user.id
+
+    rows = [
+        {'food_name': 'pizza', 'category': 'junk', 'health_score': 1, 'timestamp': '2026-09-30T08:00:00', 'username': username},
+        {'food_name': 'kale', 'category': 'vegetable', 'health_score': 5, 'timestamp': '2026-10-07T08:00:00', 'username': username},
+    ]
+    assert import_rows('food_logs', rows) == (2, 2)
+
+    with session_scope() as db:
+        stats = nutrition_stats.get_stats(db, user_id)
+        exported = [dict(row, id=log.id) for row, log in zip(rows, db.query(FoodLog).filter(
+            FoodLog.user_id == user_id, FoodLog.food_name != 'apple').order_by(FoodLog.timestamp))]
+    assert stats['food_count'] == 3
+    assert stats['healthy_count'] == 2
+    assert stats['first_food_at'] == '2026-09-30T08:00:00'
+    assert stats['last_food_at'] == '2026-10-07T08:00:00'
+    assert stats['categories']['fruit']['food_count'] == 1
+    assert stats['categories']['junk']['food_count'] == 1
+
+    # Re-importing the same ids skips them and leaves the rollups alone
+    assert import_rows('food_logs', exported, keep_ids=True) == (2, 0)
+    with session_scope() as db:
+        assert nutrition_stats.get_stats(db, user_id)['food_count'] == 3
@@ -0,0 +1,24 @@
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.orm import sessionmaker
+
+pytestmark = pytest.mark.database
+
+
+def test_pool_timeouts_are_counted_outside_session_scope():
+    from database import DATABASE_URL, MeteredQueuePool, pool_metrics
+
+    engine = create_engine(DATABASE_URL, poolclass=MeteredQueuePool, pool_size=1, max_overflow=0, pool_timeout=0.1)
+    before = pool_metrics.get_stats()['timeouts']
+    held = engine.connect()
+    try:
+        # A plain session, as app.get_request_db() creates, not session_scope
+        db = sessionmaker(bind=engine)()
+        with pytest.raises(PoolTimeoutError):
+            db.execute(text('SELECT 1'))
+        db.close()
+    finally:
+        held.close()
+        engine.dispose()
+    assert pool_metrics.get_stats()['timeouts'] == before + 1
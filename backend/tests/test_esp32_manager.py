@@ -0,0 +1,54 @@
+import socket
+import threading
+import time
+
+from esp32_manager import (DeviceManager, HAPPY, HAPPY_NEUTRAL_TRANSITION, SAD, SAD_NEUTRAL_TRANSITION)
+
+
+def listener():
+    """Stand-in ESP32: a local UDP socket recording every code it receives"""
+    received = []
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+
+    def listen():
+        while True:
+            data, _ = sock.recvfrom(16)
+            received.append(data[0])
+
+    threading.Thread(target=listen, daemon=True).start()
+    return sock.getsockname()[1], received
+
+
+def test_flash_shows_happy_then_returns_to_sad():
+    port, received = listener()
+    manager = DeviceManager(interval=60, transition_seconds=0.05, use_database=False)
+    manager.register(1, '127.0.0.1', port, health=5)
+    time.sleep(0.2)
+
+    assert manager.flash(1, HAPPY, seconds=0.2)
+    time.sleep(0.5)
+    assert received == [SAD_NEUTRAL_TRANSITION, SAD,
+                        HAPPY_NEUTRAL_TRANSITION, HAPPY, SAD_NEUTRAL_TRANSITION, SAD]
+
+
+def test_health_change_cuts_a_flash_short():
+    port, received = listener()
+    manager = DeviceManager(interval=60, transition_seconds=0.05, use_database=False)
+    manager.register(1, '127.0.0.1', port, health=5)
+    time.sleep(0.2)
+
+    manager.flash(1, HAPPY, seconds=0.3)
+    time.sleep(0.1)
+    manager.health_changed(1, 9, 14)
+    time.sleep(0.5)
+    # The flash's return to sad never goes out
+    assert received == [SAD_NEUTRAL_TRANSITION, SAD, HAPPY_NEUTRAL_TRANSITION, HAPPY,
+                        HAPPY_NEUTRAL_TRANSITION, HAPPY]
+
+
+def test_flash_is_a_no_op_when_already_in_that_emotion():
+    port, received = listener()
+    manager = DeviceManager(interval=60, transition_seconds=0.05, use_database=False)
+    manager.register(1, '127.0.0.1', port, health=20)
+    assert not manager.flash(1, HAPPY, seconds=0.2)
@@ -0,0 +1,48 @@
+import io
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+import pytest
+from PIL import Image
+
+food_classifier = pytest.importorskip('food_classifier')
+
+
+class TimingOutLLM:
+    """Stands in for llm_client.llm: every call ends in the client's own timeout
+
+    run_coroutine_threadsafe hands asyncio's timeout to the caller as
+    concurrent.futures.TimeoutError, a distinct class before Python 3.11.
+    """
+
+    def submit(self, contents, timeout=None, **kwargs):
+        future = Future()
+        future.set_exception(FutureTimeoutError())
+        return future
+
+
+class FailingBatcher:
+    def infer(self, input_tensor, top_k=1):
+        raise RuntimeError('inference backend crashed')
+
+
+def jpeg_upload():
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 48), (200, 120, 40)).save(buffer, 'JPEG')
+    buffer.seek(0)
+    return buffer
+
+
+def test_llm_timeout_on_error_path_falls_back_to_unknown(monkeypatch):
+    monkeypatch.setattr(food_classifier, 'llm', TimingOutLLM())
+    monkeypatch.setattr(food_classifier, 'batcher', FailingBatcher())
+    monkeypatch.setattr(food_classifier, 'classification_cache', food_classifier.ClassificationCache())
+
+    assert food_classifier.classify_food(jpeg_upload()) == ("unknown food", 0.0)
+
+
+def test_llm_timeout_past_caller_deadline_is_raised(monkeypatch):
+    monkeypatch.setattr(food_classifier, 'llm', TimingOutLLM())
+    image = Image.new('RGB', (64, 48))
+
+    with pytest.raises(TimeoutError):
+        food_classifier.classify_food_with_gemini(image, timeout=0.5)
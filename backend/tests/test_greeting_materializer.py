@@ -0,0 +1,20 @@
+from greeting_materializer import GreetingMaterializer
+
+
+def test_chat_refresh_throttle_forgets_users_past_the_interval(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr('greeting_materializer.time.time', lambda: clock[0])
+    materializer = GreetingMaterializer(generate=lambda prompt: 'Hi!', enabled=True, chat_refresh=600)
+    scheduled = []
+    materializer.schedule = scheduled.append
+
+    for user_id in range(1000):
+        materializer.chat_logged(user_id)
+    materializer.chat_logged(5)
+    assert len(scheduled) == 1000
+
+    clock[0] += 601
+    materializer.chat_logged(5)
+    assert scheduled[-1] == 5
+    # Everyone else's entry expired and was dropped
+    assert list(materializer._last_chat_refresh) == [5]
@@ -0,0 +1,40 @@
+from types import SimpleNamespace
+
+from history_cache import HistoryCache
+
+# Not Postgres, so the cache relies on its TTL and starts no LISTEN thread
+DB = SimpleNamespace(bind=SimpleNamespace(dialect=SimpleNamespace(name='sqlite')))
+
+
+def turn(conversation_id, message, response, user_id=7, state='food_discussion'):
+    return SimpleNamespace(id=conversation_id, user_id=user_id, conversation_state=state,
+                           user_message=message, bot_response=response)
+
+
+def test_turn_committed_during_cold_load_is_not_lost():
+    cache = HistoryCache(turns=5, ttl=300)
+    stored = [(1, 'hi', 'squeak')]
+
+    def query(db, user_id, conversation_type, limit, with_ids=False):
+        rows = list(stored)
+        if len(stored) == 1:
+            # Another request commits a turn after this cold load has read its rows
+            stored.append((2, 'banana', 'yum'))
+            cache.record(turn(2, 'banana', 'yum'))
+        return rows if with_ids else [(message, response) for _, message, response in rows]
+
+    cache._query = query
+    assert cache.get(DB, 7, 'food', 5) == [('hi', 'squeak')]
+    assert cache.get(DB, 7, 'food', 5) == [('hi', 'squeak'), ('banana', 'yum')]
+    # Cached now (including the raced turn) and nothing left pending
+    assert cache.get(DB, 7, 'food', 5) == [('hi', 'squeak'), ('banana', 'yum')]
+    assert cache.get_stats()['hits'] == 1
+    assert cache._loads == {}
+
+
+def test_write_through_appends_to_cached_buffer():
+    cache = HistoryCache(turns=5, ttl=300)
+    cache._query = lambda db, user_id, conversation_type, limit, with_ids=False: [(1, 'hi', 'squeak')]
+    cache.get(DB, 7, 'food', 5)
+    cache.record(turn(2, 'banana', 'yum'))
+    assert cache.get(DB, 7, 'food', 5) == [('hi', 'squeak'), ('banana', 'yum')]
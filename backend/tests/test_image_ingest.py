@@ -0,0 +1,36 @@
+import io
+
+import pytest
+from PIL import Image
+
+import image_ingest
+from image_ingest import ImageRejected, decode, ingest
+
+PIL_DEFAULT_MAX_PIXELS = int(1024 * 1024 * 1024 // 4 // 3)
+
+
+def jpeg_bytes(size):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, (200, 120, 40)).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+def test_import_leaves_pils_global_limit_alone():
+    assert Image.MAX_IMAGE_PIXELS == PIL_DEFAULT_MAX_PIXELS != image_ingest.MAX_IMAGE_PIXELS
+
+
+def test_decode_applies_the_pixel_limit_it_is_given():
+    with pytest.raises(ImageRejected) as refused:
+        decode(jpeg_bytes((200, 100)), max_pixels=200 * 100 - 1)
+    assert (refused.value.reason, refused.value.status) == ('too_many_pixels', 413)
+    image, image_format, original_size = decode(jpeg_bytes((200, 100)), max_pixels=200 * 100)
+    assert (image_format, original_size) == ('JPEG', (200, 100))
+
+
+def test_draft_decode_keeps_the_short_side_and_reports_decoded_bytes():
+    ingested = ingest(jpeg_bytes((2048, 1024)))
+    assert ingested.original_size == (2048, 1024)
+    assert min(ingested.image.size) >= image_ingest.DECODE_TARGET_SIZE
+    assert ingested.image.size == (512, 256)
+    assert ingested.decoded_bytes == 512 * 256 * 3
+    assert ingested.full_decode_bytes == 2048 * 1024 * 3
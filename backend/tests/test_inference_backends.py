@@ -0,0 +1,26 @@
+import os
+
+import pytest
+
+torch = pytest.importorskip('torch')
+inference_backends = pytest.importorskip('inference_backends')
+
+WEIGHTS_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'trained_weights')
+
+
+@pytest.mark.skipif(not os.path.exists(WEIGHTS_PATH), reason='trained_weights not present')
+@pytest.mark.skipif('INFERENCE_CHANNELS_LAST' in os.environ, reason='default layout overridden')
+def test_eager_default_keeps_weights_on_the_checkpoint_mmap():
+    state_dict = torch.load(WEIGHTS_PATH, map_location='cpu', mmap=True)
+    pointers = {name: tensor.data_ptr() for name, tensor in state_dict.items()}
+    model = inference_backends.build_model(state_dict, 'eager', channels_last=inference_backends.INFERENCE_CHANNELS_LAST)
+    moved = [name for name, tensor in model.state_dict().items() if tensor.data_ptr() != pointers[name]]
+    assert moved == []
+
+
+@pytest.mark.skipif(not os.path.exists(WEIGHTS_PATH), reason='trained_weights not present')
+def test_channels_last_copies_conv_weights():
+    state_dict = torch.load(WEIGHTS_PATH, map_location='cpu', mmap=True)
+    pointer = state_dict['conv1.weight'].data_ptr()
+    model = inference_backends.build_model(state_dict, 'eager', channels_last=True)
+    assert model.conv1.weight.data_ptr() != pointer
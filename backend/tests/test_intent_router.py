@@ -0,0 +1,56 @@
+import pytest
+
+from intent_router import IntentRouter, router
+
+
+@pytest.mark.parametrize('text, expected', [
+    ("I'm so hungry", {'food'}),
+    ("what should I eat for dinner", {'food'}),
+    ("I was eating pizza", {'food'}),
+    ("I ate a banana", {'food'}),
+    ("the weather is great", set()),
+    ("I'm not hungry", {'decline', 'food'}),
+    ("no", {'decline'}),
+    ("Nope.", {'decline'}),
+    ("I don't want to", {'decline'}),
+    ("I don’t want to", {'decline'}),
+    ("never   mind", {'decline'}),
+    ("maybe later", {'decline'}),
+    ("What did I eat?", {'last_ate'}),
+    ("what was my last meal", {'last_ate'}),
+    ("tell me about the last thing I ate yesterday", {'last_ate'}),
+    ("should I buy bitcoin", {'finance'}),
+    ("how do I start investing in mutual funds", {'finance'}),
+    ("I need a budget", {'finance'}),
+    ("my 401k", {'finance'}),
+    ("buying a dinner costs too much", {'finance', 'food'}),
+    ("what a beautiful day", set()),
+])
+def test_routing(text, expected):
+    assert router.match(text) == expected, router.phrases(text)
+
+
+@pytest.mark.parametrize('text', [
+    "sorry I'm late",           # "ate" inside "late"
+    "nothing much, you?",       # "not" inside "nothing"
+    "know what, snow is nice",  # "no" inside "know" and "snow"
+    "piranha",
+])
+def test_phrases_match_whole_words_only(text):
+    assert router.match(text) == set(), router.phrases(text)
+
+
+def test_longest_phrase_wins():
+    # "last meal" rather than "meal" (food)
+    assert router.phrases("my last meal was great") == [("last meal", 'last_ate')]
+
+
+def test_classify_follows_intent_priority():
+    # intents.json lists decline before food
+    assert router.classify("I'm not hungry") == 'decline'
+    assert router.classify("hello there") is None
+
+
+def test_phrase_under_two_intents_is_rejected():
+    with pytest.raises(ValueError):
+        IntentRouter({'food': ['snack'], 'finance': ['Snack']})
@@ -0,0 +1,71 @@
+import threading
+
+import push_channel
+from push_channel import PushQueue, coalesce
+
+
+def chunk(stream_id, token, username='alice'):
+    return ('reply_chunk', {'stream_id': stream_id, 'token': token}, username)
+
+
+def test_coalesce_merges_each_streams_chunks_in_order():
+    events = [
+        chunk('a', 'Squeak'), chunk('b', 'Hi'), chunk('a', ' squeak'),
+        ('health', {'health': 12, 'health_change': 2}, 'alice'),
+        chunk('a', '!'), ('reply_done', {'stream_id': 'a', 'response': 'Squeak squeak!'}, 'alice'),
+        chunk('b', ' there'),
+    ]
+    assert coalesce(events) == [
+        chunk('a', 'Squeak squeak!'), chunk('b', 'Hi there'),
+        ('health', {'health': 12, 'health_change': 2}, 'alice'),
+        ('reply_done', {'stream_id': 'a', 'response': 'Squeak squeak!'}, 'alice'),
+    ]
+
+
+def test_coalesce_caps_merged_chunk_size():
+    merged = coalesce([chunk('a', 'abc'), chunk('a', 'def'), chunk('a', 'gh')], max_chars=6)
+    assert merged == [chunk('a', 'abcdef'), chunk('a', 'gh')]
+
+
+def test_publishing_happens_off_the_callers_thread():
+    sent = []
+    done = threading.Event()
+
+    def send(event, data, username):
+        sent.append((event, data, threading.current_thread().name))
+        if event == 'reply_done':
+            done.set()
+
+    push_queue = PushQueue(coalesce_ms=200, send=send)
+    for token in ('Squ', 'eak', '!'):
+        push_queue.put('reply_chunk', {'stream_id': 's1', 'token': token}, 'alice')
+    push_queue.put('reply_done', {'stream_id': 's1', 'response': 'Squeak!'}, 'alice')
+
+    assert done.wait(5)
+    assert [(event, data) for event, data, _ in sent] == [
+        ('reply_chunk', {'stream_id': 's1', 'token': 'Squeak!'}),
+        ('reply_done', {'stream_id': 's1', 'response': 'Squeak!'}),
+    ]
+    assert {thread for _, _, thread in sent} == {'push-publisher'}
+
+
+def test_push_token_round_trips_to_its_username(monkeypatch):
+    monkeypatch.setattr(push_channel, 'SECRET_KEY', 'test-secret')
+    assert push_channel.verify_push_token(push_channel.issue_push_token('alice')) == 'alice'
+
+
+def test_forged_expired_or_missing_tokens_are_rejected(monkeypatch):
+    monkeypatch.setattr(push_channel, 'SECRET_KEY', 'test-secret')
+    token = push_channel.issue_push_token('alice')
+    assert push_channel.verify_push_token(None) is None
+    assert push_channel.verify_push_token('alice') is None
+    assert push_channel.verify_push_token(token[:-2] + 'xx') is None
+    assert push_channel.verify_push_token(token, max_age=-1) is None
+    monkeypatch.setattr(push_channel, 'SECRET_KEY', 'other-secret')
+    assert push_channel.verify_push_token(token) is None
+
+
+def test_no_tokens_without_a_secret(monkeypatch):
+    monkeypatch.setattr(push_channel, 'SECRET_KEY', None)
+    assert push_channel.issue_push_token('alice') is None
+    assert push_channel.verify_push_token('anything') is None
@@ -3,6 +3,8 @@ let currentUsername = null;  // Track logged in user
 let currentUserId = null;  // Track logged in user ID
 let currentHealth = 20;  // Track current health
 let currentMood = 'happy';  // Track current mood (happy, sad)
+// Identifies this tab to the server, so push events caused by its own requests can be skipped
+const TAB_ID = Math.random().toString(36).slice(2) + Date.now().toString(36);
 
 // ESP32 configuration
 const ESP32_IP = '10.87.41.107';
@@ -69,51 +71,50 @@ const STATE_TABLE = {
   }
 };
 
-// Send emotion signal to ESP32
-async function sendToESP32(emotionCode) {
+// Register this user's ESP32 once; the server then sends emotion changes and heartbeats itself
+async function registerESP32() {
   try {
-    const response = await fetch('/api/esp32', {
+    const response = await fetch('/api/esp32/register', {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify({ 
-        emotion: emotionCode,
+        username: currentUsername,
         ip: ESP32_IP,
         port: ESP32_PORT
       })
     });
     
     if (!response.ok) {
-      console.warn('Failed to send emotion to ESP32:', response.statusText);
+      console.warn('Failed to register ESP32:', response.statusText);
     }
   } catch (err) {
-    console.warn('Error sending to ESP32:', err);
+    console.warn('Error registering ESP32:', err);
   }
 }
 
-// Periodic ESP32 heartbeat - send current state every 5 seconds
-let esp32HeartbeatInterval = null;
+// Push channel: health and mood changes made from any tab or device arrive here
+let pushSocket = null;
+let pushToken = null;  // Signed by /api/login; the push service only trusts this, not a username
 
-function startESP32Heartbeat() {
-  // Clear any existing interval
-  if (esp32HeartbeatInterval) {
-    clearInterval(esp32HeartbeatInterval);
+function connectPushChannel() {
+  if (typeof io === 'undefined' || pushSocket || !pushToken) {
+    return;
   }
+  // WebSocket only: no long-polling fallback, so no sticky sessions behind nginx
+  pushSocket = io({ transports: ['websocket'], auth: { token: pushToken } });
   
-  // Send current state every 5 seconds
-  esp32HeartbeatInterval = setInterval(() => {
-    const currentEmotion = STATE_TABLE[currentMood]?.esp32Emotion;
-    if (currentEmotion !== undefined) {
-      sendToESP32(currentEmotion);
-      console.log(`[ESP32 Heartbeat] Sent ${currentMood} (${currentEmotion})`);
+  // Events from this tab's own requests are already applied from the response
+  pushSocket.on('health', (data) => {
+    if (data.origin !== TAB_ID && data.health !== currentHealth) {
+      updateHealthBar(data.health);
     }
-  }, 5000);
-}
-
-function stopESP32Heartbeat() {
-  if (esp32HeartbeatInterval) {
-    clearInterval(esp32HeartbeatInterval);
-    esp32HeartbeatInterval = null;
-  }
+  });
+  
+  pushSocket.on('emotion', (data) => {
+    if (data.origin !== TAB_ID) {
+      transitionToState(data.mood);
+    }
+  });
 }
 
 // Function to transition between states
@@ -130,9 +131,6 @@ function transitionToState(targetState) {
   const transition = currentStateInfo.transitions[targetState];
   
   if (transition) {
-    // Send transition emotion to ESP32
-    sendToESP32(transition.esp32Emotion);
-    
     // Play transition animation
     leftGif.src = transition.transition;
     
@@ -140,17 +138,11 @@ function transitionToState(targetState) {
     setTimeout(() => {
       leftGif.src = STATE_TABLE[targetState].gif;
       currentMood = targetState;
-      
-      // Send final state emotion to ESP32
-      sendToESP32(STATE_TABLE[targetState].esp32Emotion);
     }, transition.duration);
   } else {
     // Direct transition if no animation defined
     leftGif.src = STATE_TABLE[targetState].gif;
     currentMood = targetState;
-    
-    // Send final state emotion to ESP32
-    sendToESP32(STATE_TABLE[targetState].esp32Emotion);
   }
 }
 
@@ -257,6 +249,7 @@ document.getElementById('loginButton').addEventListener('click', async function(
     if (data.success) {
       currentUsername = username;
       currentUserId = data.user_id;
+      pushToken = data.push_token;
       currentHealth = data.health || 100;
       loginMessage.textContent = data.message;  // Short login screen greeting
       
@@ -329,8 +322,11 @@ function startGame(greetingMessage) {
   // Update health bar with current health
   updateHealthBar(currentHealth);
   
-  // Start ESP32 heartbeat when game starts
-  startESP32Heartbeat();
+  // ESP32 updates (changes and heartbeat) are sent by the server from here on
+  registerESP32();
+  
+  // Receive server-pushed health and mood updates
+  connectPushChannel();
 }
 
 // Handle user input
@@ -440,6 +436,7 @@ document.getElementById('imageUpload').addEventListener('change', async function
     const formData = new FormData();
     formData.append('image', e.target.files[0]);
     formData.append('username', currentUsername);
+    formData.append('tab_id', TAB_ID);
     
     try {
       const res = await fetch('/api/feed', {